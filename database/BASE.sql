@@ -10,7 +10,9 @@ CREATE TABLE usuarios (
     altura DECIMAL(5,2),
     nivel_actividad TINYINT CHECK (nivel_actividad BETWEEN 1 AND 5),
     creado_en TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    foto_perfil VARCHAR(255) DEFAULT NULL
+    foto_perfil VARCHAR(255) DEFAULT NULL,
+    num_amigos INT UNSIGNED NOT NULL DEFAULT 0,
+    num_publicaciones INT UNSIGNED NOT NULL DEFAULT 0
 );
 
 CREATE TABLE comidas (
@@ -33,40 +35,107 @@ CREATE TABLE amigos (
     id INT AUTO_INCREMENT PRIMARY KEY,
     usuario_fk INT NOT NULL,
     amigo_fk INT NOT NULL,
-    estado ENUM('pendiente', 'aceptado') DEFAULT 'pendiente',
+    usuario_menor INT NOT NULL,               -- LEAST(usuario_fk, amigo_fk)
+    usuario_mayor INT NOT NULL,               -- GREATEST(usuario_fk, amigo_fk)
+    estado ENUM('pendiente', 'aceptado') NOT NULL DEFAULT 'pendiente',
     fecha_solicitud TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     fecha_aceptacion TIMESTAMP NULL,
+    UNIQUE KEY uq_amigos_pareja (usuario_menor, usuario_mayor),
+    INDEX idx_amigos_usuario_estado (usuario_fk, estado, amigo_fk),
+    INDEX idx_amigos_amigo_estado (amigo_fk, estado, usuario_fk),
     FOREIGN KEY (usuario_fk) REFERENCES usuarios(id),
     FOREIGN KEY (amigo_fk) REFERENCES usuarios(id)
 );
 
+-- Particionada por mes (ver migraciones/015_mensajes_particionados.sql);
+-- sin claves foraneas, que MySQL no admite en tablas particionadas
 CREATE TABLE mensajes (
-    id INT AUTO_INCREMENT PRIMARY KEY,
+    id INT AUTO_INCREMENT,
     emisor_fk INT NOT NULL,
     receptor_fk INT NOT NULL,
+    usuario_menor INT NOT NULL,               -- LEAST(emisor_fk, receptor_fk)
+    usuario_mayor INT NOT NULL,               -- GREATEST(emisor_fk, receptor_fk)
     mensaje TEXT NOT NULL,
-    fecha_envio TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    leido BOOLEAN DEFAULT FALSE,
-    FOREIGN KEY (emisor_fk) REFERENCES usuarios(id) ON DELETE CASCADE,
-    FOREIGN KEY (receptor_fk) REFERENCES usuarios(id) ON DELETE CASCADE
+    fecha_envio TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, fecha_envio),
+    INDEX idx_mensajes_conversacion (usuario_menor, usuario_mayor, fecha_envio, id),
+    INDEX idx_mensajes_emisor (emisor_fk),
+    INDEX idx_mensajes_receptor (receptor_fk)
+);
+
+-- Las particiones se calculan desde la fecha en que se ejecuta: los 12
+-- meses anteriores, el actual y 3 por delante (como particionar-mensajes
+-- --meses 3). Lo mas antiguo queda en p_anteriores y lo que no tenga
+-- particion mensual cae en p_futuro (MAXVALUE). A partir de aqui hay que
+-- ejecutar `flask --app apis particionar-mensajes` una vez al mes (cron o
+-- similar) para que siempre haya meses preparados por delante.
+SET SESSION group_concat_max_len = 8192;
+SET @mes_actual = DATE(DATE_FORMAT(CURDATE(), '%Y-%m-01'));
+WITH RECURSIVE meses (n) AS (
+    SELECT -12
+    UNION ALL
+    SELECT n + 1 FROM meses WHERE n < 3
+)
+SELECT GROUP_CONCAT(
+    CONCAT('PARTITION p', DATE_FORMAT(@mes_actual + INTERVAL n MONTH, '%Y%m'),
+           ' VALUES LESS THAN (UNIX_TIMESTAMP(''', @mes_actual + INTERVAL n + 1 MONTH, ' 00:00:00''))')
+    ORDER BY n SEPARATOR ', '
+) INTO @particiones_mensuales
+FROM meses;
+
+SET @particionar = CONCAT(
+    'ALTER TABLE mensajes PARTITION BY RANGE (UNIX_TIMESTAMP(fecha_envio)) (',
+    'PARTITION p_anteriores VALUES LESS THAN (UNIX_TIMESTAMP(''', @mes_actual - INTERVAL 12 MONTH, ' 00:00:00'')), ',
+    @particiones_mensuales, ', ',
+    'PARTITION p_futuro VALUES LESS THAN MAXVALUE)'
 );
+PREPARE particionar FROM @particionar;
+EXECUTE particionar;
+DEALLOCATE PREPARE particionar;
+
+-- Meses antiguos de mensajes, comprimidos
+CREATE TABLE mensajes_archivo (
+    id INT NOT NULL,
+    emisor_fk INT NOT NULL,
+    receptor_fk INT NOT NULL,
+    usuario_menor INT NOT NULL,
+    usuario_mayor INT NOT NULL,
+    mensaje TEXT NOT NULL,
+    fecha_envio TIMESTAMP NOT NULL,
+    PRIMARY KEY (id, fecha_envio),
+    INDEX idx_mensajes_archivo_conversacion (usuario_menor, usuario_mayor, fecha_envio, id),
+    INDEX idx_mensajes_archivo_emisor (emisor_fk),
+    INDEX idx_mensajes_archivo_receptor (receptor_fk)
+) ROW_FORMAT=COMPRESSED KEY_BLOCK_SIZE=8;
 
 CREATE TABLE publicaciones (
     id INT AUTO_INCREMENT PRIMARY KEY,
     usuario_id INT NOT NULL,
     duracion TIME NOT NULL,
-    distancia DECIMAL(5,2) DEFAULT 0.00,
+    distancia DECIMAL(8,2) DEFAULT 0.00,
     gps_data JSON NULL,
     fecha TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     tiene_gps BOOLEAN DEFAULT FALSE,
     descripcion TEXT,
-    FOREIGN KEY (usuario_id) REFERENCES usuarios(id)
+    total_likes INT UNSIGNED NOT NULL DEFAULT 0,
+    total_comentarios INT UNSIGNED NOT NULL DEFAULT 0,
+    tiempo_movimiento INT UNSIGNED NULL,      -- segundos
+    desnivel_positivo DECIMAL(7,1) NULL,      -- metros
+    desnivel_negativo DECIMAL(7,1) NULL,
+    velocidad_max DECIMAL(6,2) NULL,          -- km/h
+    velocidad_media DECIMAL(6,2) NULL,
+    parciales_km JSON NULL,                   -- segundos por kilometro
+    clave_idempotencia VARCHAR(64) NULL,      -- cabecera Idempotency-Key de la subida
+    FOREIGN KEY (usuario_id) REFERENCES usuarios(id),
+    UNIQUE KEY uq_publicaciones_idempotencia (usuario_id, clave_idempotencia),
+    INDEX idx_publicaciones_usuario_fecha (usuario_id, fecha, id)
 );
 
 CREATE TABLE imagenes (
     id_imagen INT AUTO_INCREMENT PRIMARY KEY,
     id_publicacion INT NOT NULL,
-    nombre_imagen VARCHAR(255) NOT NULL UNIQUE,
+    nombre_imagen VARCHAR(255) NOT NULL,      -- hash del contenido (ver blobs_imagen)
+    UNIQUE KEY uq_imagenes_publicacion_nombre (id_publicacion, nombre_imagen),
     FOREIGN KEY (id_publicacion) REFERENCES publicaciones(id)
 );
 
@@ -90,5 +159,130 @@ CREATE TABLE me_gustas (
     FOREIGN KEY (id_usuario) REFERENCES usuarios(id)
 );
 
+-- Linea de tiempo materializada: una fila por (lector, publicacion visible)
+CREATE TABLE linea_tiempo (
+    usuario_fk INT NOT NULL,
+    publicacion_fk INT NOT NULL,
+    autor_fk INT NOT NULL,
+    fecha TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (usuario_fk, fecha, publicacion_fk),
+    INDEX idx_linea_tiempo_publicacion (publicacion_fk),
+    INDEX idx_linea_tiempo_autor (autor_fk),
+    FOREIGN KEY (usuario_fk) REFERENCES usuarios(id) ON DELETE CASCADE,
+    FOREIGN KEY (publicacion_fk) REFERENCES publicaciones(id) ON DELETE CASCADE,
+    FOREIGN KEY (autor_fk) REFERENCES usuarios(id) ON DELETE CASCADE
+);
+
+-- Pista GPS en formato binario compacto (ver lib/back/pistas_gps.py)
+CREATE TABLE pistas_gps (
+    publicacion_fk INT PRIMARY KEY,
+    datos MEDIUMBLOB NOT NULL,
+    FOREIGN KEY (publicacion_fk) REFERENCES publicaciones(id) ON DELETE CASCADE
+);
+
+-- Versiones simplificadas (Douglas-Peucker) de cada pista para los mapas
+CREATE TABLE pistas_gps_niveles (
+    publicacion_fk INT NOT NULL,
+    nivel TINYINT NOT NULL,
+    tolerancia_m FLOAT NOT NULL,
+    num_puntos INT NOT NULL,
+    datos MEDIUMBLOB NOT NULL,
+    PRIMARY KEY (publicacion_fk, nivel),
+    FOREIGN KEY (publicacion_fk) REFERENCES publicaciones(id) ON DELETE CASCADE
+);
+
+-- Indice espacial (R-tree) de salida y caja envolvente de cada actividad.
+-- Coordenadas planas x = lon, y = lat.
+CREATE TABLE areas_actividad (
+    publicacion_fk INT PRIMARY KEY,
+    usuario_fk INT NOT NULL,
+    fecha TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    inicio POINT NOT NULL SRID 0,
+    caja POLYGON NOT NULL SRID 0,
+    min_lat DOUBLE NOT NULL,
+    min_lon DOUBLE NOT NULL,
+    max_lat DOUBLE NOT NULL,
+    max_lon DOUBLE NOT NULL,
+    SPATIAL INDEX idx_areas_inicio (inicio),
+    SPATIAL INDEX idx_areas_caja (caja),
+    INDEX idx_areas_usuario (usuario_fk),
+    FOREIGN KEY (publicacion_fk) REFERENCES publicaciones(id) ON DELETE CASCADE,
+    FOREIGN KEY (usuario_fk) REFERENCES usuarios(id) ON DELETE CASCADE
+);
+
+-- Cola de trabajos en segundo plano (procesado de GPX e imagenes)
+CREATE TABLE trabajos (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    tipo VARCHAR(50) NOT NULL,
+    carga JSON NOT NULL,
+    estado ENUM('pendiente', 'en_curso', 'hecho', 'error') NOT NULL DEFAULT 'pendiente',
+    intentos TINYINT UNSIGNED NOT NULL DEFAULT 0,
+    max_intentos TINYINT UNSIGNED NOT NULL DEFAULT 3,
+    clave VARCHAR(100) NOT NULL UNIQUE,       -- evita encolar dos veces el mismo trabajo
+    usuario_fk INT NULL,
+    publicacion_fk INT NULL,
+    error TEXT NULL,
+    disponible_en TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    creado_en TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    INDEX idx_trabajos_disponibles (estado, disponible_en),
+    INDEX idx_trabajos_publicacion (publicacion_fk),
+    FOREIGN KEY (usuario_fk) REFERENCES usuarios(id) ON DELETE CASCADE,
+    FOREIGN KEY (publicacion_fk) REFERENCES publicaciones(id) ON DELETE CASCADE
+);
+
+-- Referencias a cada imagen guardada por contenido (imagenes.nombre_imagen
+-- y usuarios.foto_perfil); a cero se borran sus archivos
+CREATE TABLE blobs_imagen (
+    espacio ENUM('publicaciones', 'fotos_perfil') NOT NULL,
+    hash CHAR(64) NOT NULL,                   -- SHA-256 del archivo subido
+    referencias INT UNSIGNED NOT NULL DEFAULT 0,
+    creado_en TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (espacio, hash)
+);
+
+-- Subidas reanudables por trozos (GPX largos y lotes de fotos) y claves
+-- emitidas para subidas directas ('directa'); se borran al usarse
+CREATE TABLE subidas (
+    id CHAR(32) PRIMARY KEY,
+    usuario_fk INT NOT NULL,
+    extension VARCHAR(10) NOT NULL,
+    bytes_total BIGINT UNSIGNED NOT NULL,
+    bytes_recibidos BIGINT UNSIGNED NOT NULL DEFAULT 0,
+    estado ENUM('abierta', 'completa', 'directa') NOT NULL DEFAULT 'abierta',
+    clave VARCHAR(255) NULL,                  -- clave en pendientes/ al finalizar
+    creado_en TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    actualizado_en TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    INDEX idx_subidas_actualizado (actualizado_en),
+    INDEX idx_subidas_clave (clave),
+    FOREIGN KEY (usuario_fk) REFERENCES usuarios(id) ON DELETE CASCADE
+);
 
+-- Resumen de cada conversacion por usuario para la bandeja de entrada
+CREATE TABLE conversaciones (
+    usuario_fk INT NOT NULL,
+    otro_fk INT NOT NULL,
+    ultimo_mensaje_id INT NOT NULL,
+    ultimo_emisor_fk INT NOT NULL,
+    ultimo_mensaje VARCHAR(255) NOT NULL,     -- vista previa del ultimo mensaje
+    ultima_fecha TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    leido_hasta INT NOT NULL DEFAULT 0,       -- ultimo mensaje del otro ya leido
+    no_leidos INT UNSIGNED NOT NULL DEFAULT 0,
+    PRIMARY KEY (usuario_fk, otro_fk),
+    INDEX idx_conversaciones_fecha (usuario_fk, ultima_fecha, otro_fk),
+    FOREIGN KEY (usuario_fk) REFERENCES usuarios(id) ON DELETE CASCADE,
+    FOREIGN KEY (otro_fk) REFERENCES usuarios(id) ON DELETE CASCADE
+);
 
+-- Sugerencias de amistad precalculadas (amigos de amigos)
+CREATE TABLE sugerencias_amigos (
+    usuario_fk INT NOT NULL,
+    candidato_fk INT NOT NULL,
+    amigos_comunes INT UNSIGNED NOT NULL DEFAULT 0,
+    zonas_comunes INT UNSIGNED NOT NULL DEFAULT 0,
+    puntuacion INT UNSIGNED NOT NULL DEFAULT 0,
+    actualizado_en TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (usuario_fk, candidato_fk),
+    INDEX idx_sugerencias_puntuacion (usuario_fk, puntuacion, candidato_fk),
+    FOREIGN KEY (usuario_fk) REFERENCES usuarios(id) ON DELETE CASCADE,
+    FOREIGN KEY (candidato_fk) REFERENCES usuarios(id) ON DELETE CASCADE
+);
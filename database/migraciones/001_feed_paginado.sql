@@ -0,0 +1,3 @@
+-- Feed paginado por cursor (fecha, id): indice para el rango por autor
+ALTER TABLE publicaciones
+    ADD INDEX idx_publicaciones_usuario_fecha (usuario_id, fecha, id);
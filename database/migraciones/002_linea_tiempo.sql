@@ -0,0 +1,31 @@
+-- Linea de tiempo materializada (fan-out en escritura) para /publicaciones
+CREATE TABLE linea_tiempo (
+    usuario_fk INT NOT NULL,
+    publicacion_fk INT NOT NULL,
+    autor_fk INT NOT NULL,
+    fecha TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (usuario_fk, fecha, publicacion_fk),
+    INDEX idx_linea_tiempo_publicacion (publicacion_fk),
+    INDEX idx_linea_tiempo_autor (autor_fk),
+    FOREIGN KEY (usuario_fk) REFERENCES usuarios(id) ON DELETE CASCADE,
+    FOREIGN KEY (publicacion_fk) REFERENCES publicaciones(id) ON DELETE CASCADE,
+    FOREIGN KEY (autor_fk) REFERENCES usuarios(id) ON DELETE CASCADE
+);
+
+-- Publicaciones propias
+INSERT IGNORE INTO linea_tiempo (usuario_fk, publicacion_fk, autor_fk, fecha)
+SELECT p.usuario_id, p.id, p.usuario_id, p.fecha
+FROM publicaciones p;
+
+-- Publicaciones de amigos (la amistad se guarda en un solo sentido)
+INSERT IGNORE INTO linea_tiempo (usuario_fk, publicacion_fk, autor_fk, fecha)
+SELECT a.usuario_fk, p.id, p.usuario_id, p.fecha
+FROM amigos a
+JOIN publicaciones p ON p.usuario_id = a.amigo_fk
+WHERE a.estado = 'aceptado';
+
+INSERT IGNORE INTO linea_tiempo (usuario_fk, publicacion_fk, autor_fk, fecha)
+SELECT a.amigo_fk, p.id, p.usuario_id, p.fecha
+FROM amigos a
+JOIN publicaciones p ON p.usuario_id = a.usuario_fk
+WHERE a.estado = 'aceptado';
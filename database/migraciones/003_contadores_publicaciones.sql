@@ -0,0 +1,8 @@
+-- Contadores desnormalizados de likes y comentarios
+ALTER TABLE publicaciones
+    ADD COLUMN total_likes INT UNSIGNED NOT NULL DEFAULT 0,
+    ADD COLUMN total_comentarios INT UNSIGNED NOT NULL DEFAULT 0;
+
+UPDATE publicaciones p
+SET p.total_likes = (SELECT COUNT(*) FROM me_gustas m WHERE m.id_publicacion = p.id),
+    p.total_comentarios = (SELECT COUNT(*) FROM comentarios c WHERE c.id_publicacion = p.id);
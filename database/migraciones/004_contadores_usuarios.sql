@@ -0,0 +1,13 @@
+-- Contadores sociales precalculados para el resumen del perfil
+ALTER TABLE usuarios
+    ADD COLUMN num_amigos INT UNSIGNED NOT NULL DEFAULT 0,
+    ADD COLUMN num_publicaciones INT UNSIGNED NOT NULL DEFAULT 0;
+
+UPDATE usuarios u
+SET u.num_amigos = (
+        SELECT COUNT(*) FROM amigos a
+        WHERE (a.usuario_fk = u.id OR a.amigo_fk = u.id) AND a.estado = 'aceptado'
+    ),
+    u.num_publicaciones = (
+        SELECT COUNT(*) FROM publicaciones p WHERE p.usuario_id = u.id
+    );
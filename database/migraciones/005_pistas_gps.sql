@@ -0,0 +1,7 @@
+-- Pistas GPS en binario compacto. Los datos existentes de publicaciones.gps_data
+-- se convierten despues con: flask --app apis migrar-gps
+CREATE TABLE pistas_gps (
+    publicacion_fk INT PRIMARY KEY,
+    datos MEDIUMBLOB NOT NULL,
+    FOREIGN KEY (publicacion_fk) REFERENCES publicaciones(id) ON DELETE CASCADE
+);
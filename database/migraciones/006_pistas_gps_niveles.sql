@@ -0,0 +1,11 @@
+-- Niveles de detalle de las pistas GPS. Para las pistas ya existentes:
+-- flask --app apis generar-niveles-gps
+CREATE TABLE pistas_gps_niveles (
+    publicacion_fk INT NOT NULL,
+    nivel TINYINT NOT NULL,
+    tolerancia_m FLOAT NOT NULL,
+    num_puntos INT NOT NULL,
+    datos MEDIUMBLOB NOT NULL,
+    PRIMARY KEY (publicacion_fk, nivel),
+    FOREIGN KEY (publicacion_fk) REFERENCES publicaciones(id) ON DELETE CASCADE
+);
@@ -0,0 +1,9 @@
+-- Estadisticas calculadas al subir el GPX. Para las actividades existentes:
+-- flask --app apis calcular-estadisticas
+ALTER TABLE publicaciones
+    ADD COLUMN tiempo_movimiento INT UNSIGNED NULL,
+    ADD COLUMN desnivel_positivo DECIMAL(7,1) NULL,
+    ADD COLUMN desnivel_negativo DECIMAL(7,1) NULL,
+    ADD COLUMN velocidad_max DECIMAL(5,2) NULL,
+    ADD COLUMN velocidad_media DECIMAL(5,2) NULL,
+    ADD COLUMN parciales_km JSON NULL;
@@ -0,0 +1,18 @@
+-- Indice espacial de actividades (MySQL 8). Para las pistas existentes:
+-- flask --app apis indexar-areas
+CREATE TABLE areas_actividad (
+    publicacion_fk INT PRIMARY KEY,
+    usuario_fk INT NOT NULL,
+    fecha TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    inicio POINT NOT NULL SRID 0,
+    caja POLYGON NOT NULL SRID 0,
+    min_lat DOUBLE NOT NULL,
+    min_lon DOUBLE NOT NULL,
+    max_lat DOUBLE NOT NULL,
+    max_lon DOUBLE NOT NULL,
+    SPATIAL INDEX idx_areas_inicio (inicio),
+    SPATIAL INDEX idx_areas_caja (caja),
+    INDEX idx_areas_usuario (usuario_fk),
+    FOREIGN KEY (publicacion_fk) REFERENCES publicaciones(id) ON DELETE CASCADE,
+    FOREIGN KEY (usuario_fk) REFERENCES usuarios(id) ON DELETE CASCADE
+);
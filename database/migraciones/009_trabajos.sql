@@ -0,0 +1,23 @@
+-- Cola de trabajos en segundo plano e idempotencia de /crear_actividad
+ALTER TABLE publicaciones
+    ADD COLUMN clave_idempotencia VARCHAR(64) NULL,
+    ADD UNIQUE KEY uq_publicaciones_idempotencia (usuario_id, clave_idempotencia);
+
+CREATE TABLE trabajos (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    tipo VARCHAR(50) NOT NULL,
+    carga JSON NOT NULL,
+    estado ENUM('pendiente', 'en_curso', 'hecho', 'error') NOT NULL DEFAULT 'pendiente',
+    intentos TINYINT UNSIGNED NOT NULL DEFAULT 0,
+    max_intentos TINYINT UNSIGNED NOT NULL DEFAULT 3,
+    clave VARCHAR(100) NOT NULL UNIQUE,       -- evita encolar dos veces el mismo trabajo
+    usuario_fk INT NULL,
+    publicacion_fk INT NULL,
+    error TEXT NULL,
+    disponible_en TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    creado_en TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    INDEX idx_trabajos_disponibles (estado, disponible_en),
+    INDEX idx_trabajos_publicacion (publicacion_fk),
+    FOREIGN KEY (usuario_fk) REFERENCES usuarios(id) ON DELETE CASCADE,
+    FOREIGN KEY (publicacion_fk) REFERENCES publicaciones(id) ON DELETE CASCADE
+);
@@ -0,0 +1,13 @@
+-- Imagenes direccionadas por contenido: varias filas pueden compartir el
+-- mismo archivo, asi que nombre_imagen deja de ser unico globalmente
+ALTER TABLE imagenes
+    DROP INDEX nombre_imagen,
+    ADD UNIQUE KEY uq_imagenes_publicacion_nombre (id_publicacion, nombre_imagen);
+
+CREATE TABLE blobs_imagen (
+    espacio ENUM('publicaciones', 'fotos_perfil') NOT NULL,
+    hash CHAR(64) NOT NULL,                   -- SHA-256 del archivo subido
+    referencias INT UNSIGNED NOT NULL DEFAULT 0,
+    creado_en TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (espacio, hash)
+);
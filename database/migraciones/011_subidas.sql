@@ -0,0 +1,14 @@
+-- Subidas reanudables por trozos (GPX largos y lotes de fotos)
+CREATE TABLE subidas (
+    id CHAR(32) PRIMARY KEY,
+    usuario_fk INT NOT NULL,
+    extension VARCHAR(10) NOT NULL,
+    bytes_total BIGINT UNSIGNED NOT NULL,
+    bytes_recibidos BIGINT UNSIGNED NOT NULL DEFAULT 0,
+    estado ENUM('abierta', 'completa') NOT NULL DEFAULT 'abierta',
+    clave VARCHAR(255) NULL,                  -- clave en pendientes/ al finalizar
+    creado_en TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    actualizado_en TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    INDEX idx_subidas_actualizado (actualizado_en),
+    FOREIGN KEY (usuario_fk) REFERENCES usuarios(id) ON DELETE CASCADE
+);
@@ -0,0 +1,29 @@
+-- Resumen de cada conversacion por usuario para la bandeja de entrada
+CREATE TABLE conversaciones (
+    usuario_fk INT NOT NULL,
+    otro_fk INT NOT NULL,
+    ultimo_mensaje_id INT NOT NULL,
+    ultimo_emisor_fk INT NOT NULL,
+    ultimo_mensaje VARCHAR(255) NOT NULL,     -- vista previa del ultimo mensaje
+    ultima_fecha TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    no_leidos INT UNSIGNED NOT NULL DEFAULT 0,
+    PRIMARY KEY (usuario_fk, otro_fk),
+    INDEX idx_conversaciones_fecha (usuario_fk, ultima_fecha, otro_fk),
+    FOREIGN KEY (usuario_fk) REFERENCES usuarios(id) ON DELETE CASCADE,
+    FOREIGN KEY (otro_fk) REFERENCES usuarios(id) ON DELETE CASCADE
+);
+
+-- Una fila por cada lado de cada conversacion existente
+INSERT INTO conversaciones (usuario_fk, otro_fk, ultimo_mensaje_id, ultimo_emisor_fk,
+                            ultimo_mensaje, ultima_fecha, no_leidos)
+SELECT c.usuario_fk, c.otro_fk, m.id, m.emisor_fk, LEFT(m.mensaje, 255), m.fecha_envio, c.no_leidos
+FROM (
+    SELECT usuario_fk, otro_fk, MAX(id) AS ultimo_id, SUM(no_leido) AS no_leidos
+    FROM (
+        SELECT emisor_fk AS usuario_fk, receptor_fk AS otro_fk, id, 0 AS no_leido FROM mensajes
+        UNION ALL
+        SELECT receptor_fk, emisor_fk, id, IF(leido, 0, 1) FROM mensajes
+    ) lados
+    GROUP BY usuario_fk, otro_fk
+) c
+JOIN mensajes m ON m.id = c.ultimo_id;
@@ -0,0 +1,14 @@
+-- Clave canonica de la conversacion (par de usuarios ordenado) para leer
+-- un chat por indice y paginarlo hacia atras
+ALTER TABLE mensajes
+    ADD COLUMN usuario_menor INT NULL AFTER receptor_fk,
+    ADD COLUMN usuario_mayor INT NULL AFTER usuario_menor;
+
+UPDATE mensajes
+SET usuario_menor = LEAST(emisor_fk, receptor_fk),
+    usuario_mayor = GREATEST(emisor_fk, receptor_fk);
+
+ALTER TABLE mensajes
+    MODIFY usuario_menor INT NOT NULL,
+    MODIFY usuario_mayor INT NOT NULL,
+    ADD INDEX idx_mensajes_conversacion (usuario_menor, usuario_mayor, fecha_envio, id);
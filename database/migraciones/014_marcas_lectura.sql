@@ -0,0 +1,18 @@
+-- Lo leido pasa de un flag por mensaje a una marca por conversacion:
+-- id del ultimo mensaje del otro usuario que se ha leido
+ALTER TABLE conversaciones
+    ADD COLUMN leido_hasta INT NOT NULL DEFAULT 0 AFTER ultima_fecha;
+
+UPDATE conversaciones c
+SET c.leido_hasta = COALESCE((
+        SELECT MAX(m.id) FROM mensajes m
+        WHERE m.receptor_fk = c.usuario_fk AND m.emisor_fk = c.otro_fk AND m.leido
+    ), 0);
+
+UPDATE conversaciones c
+SET c.no_leidos = (
+        SELECT COUNT(*) FROM mensajes m
+        WHERE m.receptor_fk = c.usuario_fk AND m.emisor_fk = c.otro_fk AND m.id > c.leido_hasta
+    );
+
+ALTER TABLE mensajes DROP COLUMN leido;
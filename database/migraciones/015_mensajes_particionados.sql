@@ -0,0 +1,61 @@
+-- mensajes particionada por mes de fecha_envio; los meses antiguos se
+-- mueven a mensajes_archivo (comprimida) con `flask --app apis archivar-mensajes`
+-- y los siguientes se crean con `flask --app apis particionar-mensajes`.
+-- Requiere MySQL 8 (WITH RECURSIVE).
+-- MySQL no admite claves foraneas en tablas particionadas: el borrado de
+-- los mensajes de un usuario lo hace /eliminar_cuenta.
+ALTER TABLE mensajes
+    DROP FOREIGN KEY mensajes_ibfk_1,
+    DROP FOREIGN KEY mensajes_ibfk_2;
+
+ALTER TABLE mensajes
+    MODIFY fecha_envio TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    DROP PRIMARY KEY,
+    ADD PRIMARY KEY (id, fecha_envio),
+    -- Los indices que creo MySQL para las claves foraneas se quedan
+    RENAME INDEX emisor_fk TO idx_mensajes_emisor,
+    RENAME INDEX receptor_fk TO idx_mensajes_receptor;
+
+-- Las particiones se calculan desde la fecha en que se ejecuta: los 12
+-- meses anteriores, el actual y 3 por delante (como particionar-mensajes
+-- --meses 3). Lo mas antiguo queda en p_anteriores y lo que no tenga
+-- particion mensual cae en p_futuro (MAXVALUE). A partir de aqui hay que
+-- ejecutar `flask --app apis particionar-mensajes` una vez al mes (cron o
+-- similar) para que siempre haya meses preparados por delante.
+SET SESSION group_concat_max_len = 8192;
+SET @mes_actual = DATE(DATE_FORMAT(CURDATE(), '%Y-%m-01'));
+WITH RECURSIVE meses (n) AS (
+    SELECT -12
+    UNION ALL
+    SELECT n + 1 FROM meses WHERE n < 3
+)
+SELECT GROUP_CONCAT(
+    CONCAT('PARTITION p', DATE_FORMAT(@mes_actual + INTERVAL n MONTH, '%Y%m'),
+           ' VALUES LESS THAN (UNIX_TIMESTAMP(''', @mes_actual + INTERVAL n + 1 MONTH, ' 00:00:00''))')
+    ORDER BY n SEPARATOR ', '
+) INTO @particiones_mensuales
+FROM meses;
+
+SET @particionar = CONCAT(
+    'ALTER TABLE mensajes PARTITION BY RANGE (UNIX_TIMESTAMP(fecha_envio)) (',
+    'PARTITION p_anteriores VALUES LESS THAN (UNIX_TIMESTAMP(''', @mes_actual - INTERVAL 12 MONTH, ' 00:00:00'')), ',
+    @particiones_mensuales, ', ',
+    'PARTITION p_futuro VALUES LESS THAN MAXVALUE)'
+);
+PREPARE particionar FROM @particionar;
+EXECUTE particionar;
+DEALLOCATE PREPARE particionar;
+
+CREATE TABLE mensajes_archivo (
+    id INT NOT NULL,
+    emisor_fk INT NOT NULL,
+    receptor_fk INT NOT NULL,
+    usuario_menor INT NOT NULL,
+    usuario_mayor INT NOT NULL,
+    mensaje TEXT NOT NULL,
+    fecha_envio TIMESTAMP NOT NULL,
+    PRIMARY KEY (id, fecha_envio),
+    INDEX idx_mensajes_archivo_conversacion (usuario_menor, usuario_mayor, fecha_envio, id),
+    INDEX idx_mensajes_archivo_emisor (emisor_fk),
+    INDEX idx_mensajes_archivo_receptor (receptor_fk)
+) ROW_FORMAT=COMPRESSED KEY_BLOCK_SIZE=8;
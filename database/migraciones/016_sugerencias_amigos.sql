@@ -0,0 +1,14 @@
+-- Sugerencias de amistad precalculadas (amigos de amigos). Se rellenan con
+-- `flask --app apis calcular-sugerencias`
+CREATE TABLE sugerencias_amigos (
+    usuario_fk INT NOT NULL,
+    candidato_fk INT NOT NULL,
+    amigos_comunes INT UNSIGNED NOT NULL DEFAULT 0,
+    zonas_comunes INT UNSIGNED NOT NULL DEFAULT 0,
+    puntuacion INT UNSIGNED NOT NULL DEFAULT 0,
+    actualizado_en TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (usuario_fk, candidato_fk),
+    INDEX idx_sugerencias_puntuacion (usuario_fk, puntuacion, candidato_fk),
+    FOREIGN KEY (usuario_fk) REFERENCES usuarios(id) ON DELETE CASCADE,
+    FOREIGN KEY (candidato_fk) REFERENCES usuarios(id) ON DELETE CASCADE
+);
@@ -0,0 +1,44 @@
+-- Una sola fila por pareja de usuarios (en cualquier sentido) e indices
+-- por (usuario, estado) para leer cada sentido sin OR
+
+-- Solicitudes a uno mismo
+DELETE FROM amigos WHERE usuario_fk = amigo_fk;
+
+-- Duplicados y solicitudes cruzadas: se queda la aceptada o, a igualdad,
+-- la mas antigua
+DELETE a FROM amigos a
+JOIN amigos b
+  ON LEAST(b.usuario_fk, b.amigo_fk) = LEAST(a.usuario_fk, a.amigo_fk)
+ AND GREATEST(b.usuario_fk, b.amigo_fk) = GREATEST(a.usuario_fk, a.amigo_fk)
+ AND b.id <> a.id
+WHERE (COALESCE(b.estado, 'pendiente') = 'aceptado' AND COALESCE(a.estado, 'pendiente') <> 'aceptado')
+   OR (COALESCE(b.estado, 'pendiente') = COALESCE(a.estado, 'pendiente') AND b.id < a.id);
+
+ALTER TABLE amigos
+    ADD COLUMN usuario_menor INT NULL AFTER amigo_fk,
+    ADD COLUMN usuario_mayor INT NULL AFTER usuario_menor;
+
+UPDATE amigos
+SET usuario_menor = LEAST(usuario_fk, amigo_fk),
+    usuario_mayor = GREATEST(usuario_fk, amigo_fk),
+    estado = COALESCE(estado, 'pendiente');
+
+-- Los indices compuestos sustituyen a los que MySQL creo para las claves
+-- foraneas (empiezan por la misma columna)
+ALTER TABLE amigos
+    MODIFY usuario_menor INT NOT NULL,
+    MODIFY usuario_mayor INT NOT NULL,
+    MODIFY estado ENUM('pendiente', 'aceptado') NOT NULL DEFAULT 'pendiente',
+    ADD UNIQUE KEY uq_amigos_pareja (usuario_menor, usuario_mayor),
+    ADD INDEX idx_amigos_usuario_estado (usuario_fk, estado, amigo_fk),
+    ADD INDEX idx_amigos_amigo_estado (amigo_fk, estado, usuario_fk),
+    DROP INDEX usuario_fk,
+    DROP INDEX amigo_fk;
+
+-- Los duplicados aceptados inflaban num_amigos
+UPDATE usuarios u
+SET u.num_amigos = (
+        SELECT COUNT(*) FROM amigos a WHERE a.usuario_fk = u.id AND a.estado = 'aceptado'
+    ) + (
+        SELECT COUNT(*) FROM amigos a WHERE a.amigo_fk = u.id AND a.estado = 'aceptado'
+    );
@@ -0,0 +1,5 @@
+-- Las actividades de mas de 999.99 km no cabian en distancia
+ALTER TABLE publicaciones
+    MODIFY distancia DECIMAL(8,2) DEFAULT 0.00,
+    MODIFY velocidad_max DECIMAL(6,2) NULL,
+    MODIFY velocidad_media DECIMAL(6,2) NULL;
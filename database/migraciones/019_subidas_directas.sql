@@ -0,0 +1,6 @@
+-- Las subidas directas (POST /subidas) tambien quedan registradas: el PUT
+-- local solo acepta claves emitidas y limpiar-subidas borra las que nunca
+-- se llegan a usar
+ALTER TABLE subidas
+    MODIFY estado ENUM('abierta', 'completa', 'directa') NOT NULL DEFAULT 'abierta',
+    ADD INDEX idx_subidas_clave (clave);
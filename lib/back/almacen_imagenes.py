@@ -0,0 +1,131 @@
+import hashlib
+import os
+import re
+import tempfile
+
+from variantes_imagen import generar_variantes, nombre_variante, FORMATOS, TAMAÑO_POR_DEFECTO
+
+ES_HASH = re.compile(r'^[0-9a-f]{64}$')
+
+
+def hash_archivo(ruta):
+    with open(ruta, 'rb') as f:
+        return hash_flujo(f)
+
+
+def hash_flujo(flujo):
+    sha = hashlib.sha256()
+    for bloque in iter(lambda: flujo.read(1024 * 1024), b''):
+        sha.update(bloque)
+    return sha.hexdigest()
+
+
+class AlmacenImagenes:
+    """
+    Imagenes direccionadas por su contenido: el nombre es el SHA-256 del
+    archivo subido y sus variantes se reparten en subcarpetas por los
+    primeros caracteres (prefijo/ab/cd/abcd..._mini.webp) dentro del
+    almacenamiento. Subir dos veces la misma foto no ocupa mas espacio ni
+    vuelve a redimensionarla.
+
+    Cuantas filas apuntan a cada imagen (imagenes.nombre_imagen o
+    usuarios.foto_perfil) se lleva en la tabla blobs_imagen; cuando llega a
+    cero, la imagen se puede borrar.
+    """
+
+    def __init__(self, almacenamiento, espacio, tamaños, prefijo=''):
+        self.almacenamiento = almacenamiento
+        self.espacio = espacio
+        self.tamaños = tamaños
+        self.prefijo = prefijo
+
+    def clave_objeto(self, nombre):
+        """
+        Clave en el almacenamiento de un archivo. Los nombres antiguos
+        (anteriores al almacen) estan directamente bajo el prefijo.
+        """
+        clave = nombre.split('_', 1)[0]
+        if ES_HASH.match(clave):
+            nombre = f"{clave[:2]}/{clave[2:4]}/{nombre}"
+        return f"{self.prefijo}/{nombre}" if self.prefijo else nombre
+
+    def clave_a_servir(self, nombre, tamaño, extension):
+        """
+        Clave de la variante pedida. Las imagenes por hash siempre tienen
+        todas; las antiguas puede que no, y entonces se sirve el original.
+        """
+        variante = self.clave_objeto(nombre_variante(nombre, tamaño, extension))
+        if ES_HASH.match(nombre) or self.almacenamiento.existe(variante):
+            return variante
+        return self.clave_objeto(nombre)
+
+    def existe(self, clave):
+        return self.almacenamiento.existe(self.clave_objeto(nombre_variante(clave, TAMAÑO_POR_DEFECTO, 'jpg')))
+
+    def preparar(self, origen):
+        """
+        Calcula la clave de `origen` y genera sus variantes si aun no
+        existen. Lanza ImagenInvalida antes de tocar la base de datos.
+        """
+        clave = hash_archivo(origen)
+        if not self.existe(clave):
+            self._generar(origen, clave)
+        return clave
+
+    def referenciar(self, cur, clave, origen):
+        """
+        Suma una referencia dentro de la transaccion del llamador. La fila
+        queda bloqueada, asi que una recogida concurrente no puede borrar
+        los archivos; si ya los habia borrado, se regeneran.
+        """
+        cur.execute("""
+            INSERT INTO blobs_imagen (espacio, hash, referencias) VALUES (%s, %s, 1)
+            ON DUPLICATE KEY UPDATE referencias = referencias + 1
+        """, (self.espacio, clave))
+        if not self.existe(clave):
+            self._generar(origen, clave)
+
+    def liberar(self, cur, claves):
+        """
+        Resta una referencia por cada clave (los nombres antiguos se
+        ignoran). Devuelve las que se han quedado sin referencias; sus
+        archivos se borran con recoger() despues del commit.
+        """
+        huerfanas = []
+        for clave in claves:
+            if not clave or not ES_HASH.match(clave):
+                continue
+            cur.execute("""
+                UPDATE blobs_imagen SET referencias = GREATEST(CAST(referencias AS SIGNED) - 1, 0)
+                WHERE espacio = %s AND hash = %s
+            """, (self.espacio, clave))
+            cur.execute("""
+                DELETE FROM blobs_imagen WHERE espacio = %s AND hash = %s AND referencias = 0
+            """, (self.espacio, clave))
+            if cur.rowcount:
+                huerfanas.append(clave)
+        return huerfanas
+
+    def recoger(self, cur, claves):
+        """
+        Borra los archivos de las claves que siguen sin fila en blobs_imagen.
+        Se bloquea cada clave hasta el commit del llamador para que nadie la
+        referencie mientras tanto.
+        """
+        for clave in claves:
+            cur.execute("""
+                SELECT referencias FROM blobs_imagen WHERE espacio = %s AND hash = %s FOR UPDATE
+            """, (self.espacio, clave))
+            if cur.fetchone() is None:
+                self._borrar_archivos(clave)
+
+    def _generar(self, origen, clave):
+        # Las variantes se generan en local y despues se suben
+        with tempfile.TemporaryDirectory() as carpeta:
+            for nombre in generar_variantes(origen, carpeta, clave, self.tamaños):
+                self.almacenamiento.guardar(self.clave_objeto(nombre), os.path.join(carpeta, nombre), inmutable=True)
+
+    def _borrar_archivos(self, clave):
+        for tamaño, _ in self.tamaños:
+            for extension, _, _ in FORMATOS:
+                self.almacenamiento.borrar(self.clave_objeto(nombre_variante(clave, tamaño, extension)))
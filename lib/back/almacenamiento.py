@@ -0,0 +1,182 @@
+import mimetypes
+import os
+import shutil
+import tempfile
+import uuid
+from contextlib import contextmanager
+
+CACHE_INMUTABLE = 'public, max-age=31536000, immutable'
+
+
+class AlmacenamientoLocal:
+    """
+    Objetos guardados como archivos bajo `raiz`. Las claves son rutas
+    relativas separadas por '/' (p. ej. 'publicaciones/ab/cd/abcd..._mini.jpg').
+    No hay URLs firmadas: los archivos los sirve la API (o el proxy).
+    """
+
+    externo = False
+
+    def __init__(self, raiz):
+        self.raiz = raiz
+
+    def ruta(self, clave):
+        return os.path.join(self.raiz, *clave.split('/'))
+
+    def existe(self, clave):
+        return os.path.isfile(self.ruta(clave))
+
+    def guardar(self, clave, origen, inmutable=False):
+        """
+        Mueve el archivo local `origen` a `clave`. Se escribe a un temporal
+        y se renombra para que nunca se vea un archivo a medias.
+        """
+        destino = self.ruta(clave)
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        temporal = f"{destino}.{uuid.uuid4().hex}.tmp"
+        shutil.move(origen, temporal)
+        os.replace(temporal, destino)
+
+    def guardar_flujo(self, clave, flujo):
+        destino = self.ruta(clave)
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        temporal = f"{destino}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(temporal, 'wb') as f:
+                shutil.copyfileobj(flujo, f, 1024 * 1024)
+            os.replace(temporal, destino)
+        except BaseException:
+            _borrar(temporal)
+            raise
+
+    def borrar(self, clave):
+        ruta = self.ruta(clave)
+        _borrar(ruta)
+        # Quita las subcarpetas que se hayan quedado vacias
+        carpeta = os.path.dirname(ruta)
+        while os.path.abspath(carpeta) != os.path.abspath(self.raiz):
+            try:
+                os.rmdir(carpeta)
+            except OSError:
+                break
+            carpeta = os.path.dirname(carpeta)
+
+    @contextmanager
+    def archivo_local(self, clave):
+        yield self.ruta(clave)
+
+    def url_descarga(self, clave, caducidad):
+        return None
+
+    def url_subida(self, clave, tipo, caducidad, max_bytes):
+        return None
+
+
+class AlmacenamientoS3:
+    """
+    Bucket compatible con S3 (AWS, MinIO...). La app sube y descarga
+    directamente con URLs firmadas, sin pasar los bytes por la API.
+    boto3 solo se importa si se usa este almacenamiento.
+    """
+
+    externo = True
+
+    def __init__(self, bucket, endpoint=None, region=None, clave_acceso=None, secreto=None):
+        self.bucket = bucket
+        self.endpoint = endpoint
+        self.region = region
+        self.clave_acceso = clave_acceso
+        self.secreto = secreto
+        self._s3 = None
+
+    @property
+    def cliente(self):
+        if self._s3 is None:
+            import boto3
+            from botocore.config import Config
+            self._s3 = boto3.client(
+                's3',
+                endpoint_url=self.endpoint,
+                region_name=self.region,
+                aws_access_key_id=self.clave_acceso,
+                aws_secret_access_key=self.secreto,
+                # MinIO y similares no tienen DNS por bucket
+                config=Config(signature_version='s3v4',
+                              s3={'addressing_style': 'path' if self.endpoint else 'auto'}),
+            )
+        return self._s3
+
+    def existe(self, clave):
+        from botocore.exceptions import ClientError
+        try:
+            self.cliente.head_object(Bucket=self.bucket, Key=clave)
+            return True
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def guardar(self, clave, origen, inmutable=False):
+        extra = {'ContentType': mimetypes.guess_type(clave)[0] or 'application/octet-stream'}
+        if inmutable:
+            extra['CacheControl'] = CACHE_INMUTABLE
+        self.cliente.upload_file(origen, self.bucket, clave, ExtraArgs=extra)
+        _borrar(origen)
+
+    def guardar_flujo(self, clave, flujo):
+        self.cliente.upload_fileobj(flujo, self.bucket, clave)
+
+    def borrar(self, clave):
+        self.cliente.delete_object(Bucket=self.bucket, Key=clave)
+
+    @contextmanager
+    def archivo_local(self, clave):
+        """
+        Descarga el objeto a un archivo temporal mientras dure el bloque.
+        """
+        descriptor, ruta = tempfile.mkstemp(suffix=os.path.splitext(clave)[1])
+        os.close(descriptor)
+        try:
+            self.cliente.download_file(self.bucket, clave, ruta)
+            yield ruta
+        finally:
+            _borrar(ruta)
+
+    def url_descarga(self, clave, caducidad):
+        return self.cliente.generate_presigned_url(
+            'get_object', Params={'Bucket': self.bucket, 'Key': clave}, ExpiresIn=caducidad
+        )
+
+    def url_subida(self, clave, tipo, caducidad, max_bytes):
+        """
+        POST firmado: {'url', 'fields'}. A diferencia de un PUT firmado,
+        la politica limita el tamaño (S3 rechaza mas de `max_bytes`).
+        """
+        return self.cliente.generate_presigned_post(
+            self.bucket, clave,
+            Fields={'Content-Type': tipo},
+            Conditions=[{'Content-Type': tipo}, ['content-length-range', 1, max_bytes]],
+            ExpiresIn=caducidad
+        )
+
+
+def crear_almacenamiento(config):
+    """
+    Construye el almacenamiento segun config['ALMACENAMIENTO'] ('local' o 's3').
+    """
+    if config['ALMACENAMIENTO'] == 's3':
+        return AlmacenamientoS3(
+            config['S3_BUCKET'],
+            endpoint=config.get('S3_ENDPOINT'),
+            region=config.get('S3_REGION'),
+            clave_acceso=config.get('S3_CLAVE_ACCESO'),
+            secreto=config.get('S3_SECRETO'),
+        )
+    return AlmacenamientoLocal(config['UPLOAD_FOLDER'])
+
+
+def _borrar(ruta):
+    try:
+        os.remove(ruta)
+    except FileNotFoundError:
+        pass
@@ -1,11 +1,13 @@
 from functools import wraps
-from flask import Flask, request, jsonify, send_from_directory, Response
+from flask import Flask, request, jsonify, send_file, redirect, Response, g
 from flask_mysqldb import MySQL
 import MySQLdb.cursors
 from werkzeug.utils import secure_filename
-import gpxpy
+from werkzeug.security import safe_join
+from werkzeug.exceptions import ClientDisconnected
 import uuid
 import json
+import hashlib
 import os
 import re
 import bcrypt
@@ -15,6 +17,30 @@ from datetime import timedelta
 from flask_cors import CORS
 import pytz
 import mimetypes
+import time
+import click
+import math
+import numpy as np
+from cache_respuestas import CacheRespuestas
+from trabajos import ColaTrabajos, ErrorDefinitivo
+from contadores import ContadoresPendientes
+from pistas_gps import (
+    codificar_pista, decodificar_pista, arrays_desde_puntos_json, arrays_de_pista, iterar_puntos_json,
+    leer_gpx, generar_niveles, metros_por_pixel, calcular_estadisticas,
+    FormatoPistaInvalido, GPXInvalido
+)
+from variantes_imagen import (
+    ImagenInvalida, TAMAÑOS_PUBLICACION, TAMAÑOS_AVATAR, TAMAÑO_POR_DEFECTO
+)
+from almacenamiento import crear_almacenamiento, CACHE_INMUTABLE
+from almacen_imagenes import AlmacenImagenes, hash_archivo, hash_flujo, ES_HASH
+from canales import CanalesUsuarios, formatear_evento, flujo_eventos
+from grafo_amigos import GrafoAmistades
+from sugerencias import calcular_candidatos, nuevos_amigos_de_amigos, puntuacion, TAM_CELDA_GRADOS
+from particiones import crear_particiones, archivar_particiones, inicio_mes, sumar_meses
+from respuestas import elegir_codificacion, comprimir, comprimir_flujo, trozos_json, UMBRAL_COMPRESION
+from paginacion import codificar_cursor, decodificar_cursor, leer_limite, leer_id
+from lecturas import marca_lectura
 
 app = Flask(__name__)
 CORS(app)
@@ -25,13 +51,40 @@ app.config['MYSQL_USER'] = 'root'
 app.config['MYSQL_PASSWORD'] = '1234'
 app.config['MYSQL_DB'] = 'hercules'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16 MB
+app.config['GPX_MAX_PUNTOS'] = 200_000
 mysql = MySQL(app)
 
 
-UPLOAD_FOLDER = 'C:\\imagenes_hercules'
+UPLOAD_FOLDER = os.environ.get('HERCULES_CARPETA_IMAGENES', 'C:\\imagenes_hercules')
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
+# Donde se guardan imagenes y subidas: 'local' (en UPLOAD_FOLDER) o 's3'
+# (cualquier servicio compatible; S3_ENDPOINT p. ej. http://localhost:9000 para MinIO)
+app.config['ALMACENAMIENTO'] = os.environ.get('HERCULES_ALMACENAMIENTO', 'local')
+app.config['S3_BUCKET'] = os.environ.get('HERCULES_S3_BUCKET', 'hercules')
+app.config['S3_ENDPOINT'] = os.environ.get('HERCULES_S3_ENDPOINT')
+app.config['S3_REGION'] = os.environ.get('HERCULES_S3_REGION')
+app.config['S3_CLAVE_ACCESO'] = os.environ.get('HERCULES_S3_CLAVE_ACCESO')
+app.config['S3_SECRETO'] = os.environ.get('HERCULES_S3_SECRETO')
+app.config['URL_FIRMADA_CADUCIDAD'] = 3600  # segundos
+almacenamiento = crear_almacenamiento(app.config)
+
+# Subidas a la espera de que las procese la cola de trabajos
+PREFIJO_PENDIENTES = 'pendientes'
+
+almacen_publicaciones = AlmacenImagenes(almacenamiento, 'publicaciones', TAMAÑOS_PUBLICACION, prefijo='publicaciones')
+almacen_fotos_perfil = AlmacenImagenes(almacenamiento, 'fotos_perfil', TAMAÑOS_AVATAR)
+
+# Entrega de imagenes locales por el proxy de delante. Con USE_X_SENDFILE
+# Flask responde con X-Sendfile (Apache, lighttpd); con X_ACCEL_REDIRECT,
+# con la ruta interna de nginx que apunta a UPLOAD_FOLDER (p. ej. '/internas')
+app.config['USE_X_SENDFILE'] = False
+app.config['X_ACCEL_REDIRECT'] = None
+
+TRABAJOS_HILOS = 2
+cola_trabajos = ColaTrabajos(app, mysql, num_hilos=TRABAJOS_HILOS)
+
 # Clave secreta para firmar el token 
 SECRET_KEY = 'mi_clave_super_secreta'
 
@@ -62,6 +115,114 @@ def token_required(f):
         return f(*args, **kwargs)
     return decorated
 
+# Cache de respuestas por usuario para los endpoints que la app consulta en bucle
+RESPUESTAS_CACHE_TTL = 60  # segundos
+RESPUESTAS_CACHE_MAX_BYTES = 64 * 1024 * 1024
+cache_respuestas = CacheRespuestas(ttl=RESPUESTAS_CACHE_TTL, max_bytes=RESPUESTAS_CACHE_MAX_BYTES)
+
+# Pistas GPS ya comprimidas: solo cambian si se reprocesa o borra la publicacion
+PISTAS_CACHE_TTL = 3600  # segundos
+PISTAS_CACHE_MAX_BYTES = 128 * 1024 * 1024
+cache_pistas = CacheRespuestas(ttl=PISTAS_CACHE_TTL, max_bytes=PISTAS_CACHE_MAX_BYTES)
+
+
+def par_usuarios(usuario_a, usuario_b):
+    """
+    Clave canonica de una pareja de usuarios (chats, amistades): (menor, mayor).
+    """
+    usuario_a, usuario_b = int(usuario_a), int(usuario_b)
+    return min(usuario_a, usuario_b), max(usuario_a, usuario_b)
+
+
+def cargar_amigos(usuario_id):
+    cur = mysql.connection.cursor()
+    # Una consulta por sentido: cada una se resuelve solo con su indice
+    # (usuario, estado, otro)
+    cur.execute("""
+        SELECT amigo_fk FROM amigos WHERE usuario_fk = %s AND estado = 'aceptado'
+        UNION
+        SELECT usuario_fk FROM amigos WHERE amigo_fk = %s AND estado = 'aceptado'
+    """, (usuario_id, usuario_id))
+    ids = [fila[0] for fila in cur.fetchall()]
+    cur.close()
+    return ids
+
+
+# Amistades aceptadas en memoria: comprobar si dos usuarios son amigos o
+# listar los amigos de alguien no va a MySQL
+AMIGOS_CACHE_TTL = 300  # segundos
+AMIGOS_CACHE_MAX_USUARIOS = 100000
+grafo_amigos = GrafoAmistades(cargar_amigos, ttl=AMIGOS_CACHE_TTL, max_usuarios=AMIGOS_CACHE_MAX_USUARIOS)
+
+def respuesta_cacheada(f):
+    """
+    Guarda por usuario las respuestas 200 de la vista con su ETag y contesta
+    304 si el cliente ya tiene esa version. La vista indica en
+    g.etiquetas_cache que escrituras deben invalidar la respuesta.
+
+    Las versiones comprimidas se calculan la primera vez que se piden y se
+    guardan en la misma entrada (que cuenta tambien sus bytes), cada una con
+    su propio ETag.
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        clave = (request.user['user_id'], request.full_path)
+        entrada = cache_respuestas.obtener(clave)
+
+        if entrada is None:
+            generacion = cache_respuestas.generacion
+            g.etiquetas_cache = None
+            respuesta = app.make_response(f(*args, **kwargs))
+            if respuesta.status_code != 200 or not g.etiquetas_cache:
+                return respuesta
+
+            cuerpo = respuesta.get_data()
+            cabeceras = [(k, v) for k, v in respuesta.headers.items() if k.lower() != 'content-length']
+            entrada = (cuerpo, cabeceras, hashlib.sha1(cuerpo).hexdigest(), {})
+            cache_respuestas.guardar(clave, entrada, len(cuerpo), g.etiquetas_cache, generacion)
+
+        cuerpo, cabeceras, etag, comprimidos = entrada
+        codificacion = elegir_codificacion(request.accept_encodings)
+        if codificacion and len(cuerpo) >= UMBRAL_COMPRESION:
+            if codificacion not in comprimidos:
+                variante = comprimir(cuerpo, codificacion)
+                # Si otra peticion la ha añadido a la vez, solo cuenta una
+                if comprimidos.setdefault(codificacion, variante) is variante:
+                    cache_respuestas.crecer(clave, len(variante))
+            cuerpo = comprimidos[codificacion]
+            etag = f"{etag}-{codificacion}"
+        else:
+            codificacion = None
+
+        if request.if_none_match.contains(etag):
+            respuesta = Response(status=304)
+        else:
+            respuesta = Response(cuerpo, status=200, headers=cabeceras)
+            if codificacion:
+                respuesta.headers['Content-Encoding'] = codificacion
+        respuesta.set_etag(etag)
+        respuesta.vary.add('Accept-Encoding')
+        respuesta.headers['Cache-Control'] = 'private, no-cache'
+        return respuesta
+    return decorated
+
+
+@app.after_request
+def comprimir_respuesta(respuesta):
+    """
+    Comprime las respuestas JSON grandes que no pasan por el cache.
+    """
+    if (respuesta.status_code != 200 or respuesta.direct_passthrough or respuesta.is_streamed
+            or 'Content-Encoding' in respuesta.headers or respuesta.mimetype != 'application/json'):
+        return respuesta
+    respuesta.vary.add('Accept-Encoding')
+    codificacion = elegir_codificacion(request.accept_encodings)
+    cuerpo = respuesta.get_data()
+    if codificacion and len(cuerpo) >= UMBRAL_COMPRESION:
+        respuesta.set_data(comprimir(cuerpo, codificacion))
+        respuesta.headers['Content-Encoding'] = codificacion
+    return respuesta
+
 @app.route('/login', methods=['POST'])
 def login():
     data = request.get_json()
@@ -192,11 +353,47 @@ def eliminar_cuenta():
     user_id = request.user['user_id']
 
     cur = mysql.connection.cursor()
+    cur.execute("SELECT foto_perfil FROM usuarios WHERE id = %s", (user_id,))
+    fila = cur.fetchone()
+    foto_perfil = fila[0] if fila else None
+    cur.execute("""
+        SELECT i.nombre_imagen FROM imagenes i
+        JOIN publicaciones p ON p.id = i.id_publicacion
+        WHERE p.usuario_id = %s
+    """, (user_id,))
+    claves_imagenes = [fila[0] for fila in cur.fetchall()]
+    cur.execute("""
+        DELETE i FROM imagenes i
+        JOIN publicaciones p ON p.id = i.id_publicacion
+        WHERE p.usuario_id = %s
+    """, (user_id,))
+    huerfanas_publicaciones = almacen_publicaciones.liberar(cur, claves_imagenes)
+    huerfanas_fotos = almacen_fotos_perfil.liberar(cur, [foto_perfil])
+    cur.execute("DELETE FROM linea_tiempo WHERE usuario_fk = %s OR autor_fk = %s", (user_id, user_id))
     cur.execute("DELETE FROM publicaciones WHERE usuario_id = %s", (user_id,))
-    cur.execute("DELETE FROM amigos WHERE usuario_fk = %s OR amigo_fk = %s", (user_id, user_id))
+    cur.execute("""
+        UPDATE usuarios SET num_amigos = GREATEST(CAST(num_amigos AS SIGNED) - 1, 0)
+        WHERE id IN (
+            SELECT amigo_fk FROM amigos WHERE usuario_fk = %s AND estado = 'aceptado'
+            UNION
+            SELECT usuario_fk FROM amigos WHERE amigo_fk = %s AND estado = 'aceptado'
+        )
+    """, (user_id, user_id))
+    cur.execute("DELETE FROM amigos WHERE usuario_fk = %s", (user_id,))
+    cur.execute("DELETE FROM amigos WHERE amigo_fk = %s", (user_id,))
+    # mensajes esta particionada y no tiene claves foraneas que lo borren
+    for tabla in ('mensajes', 'mensajes_archivo'):
+        cur.execute(f"DELETE FROM {tabla} WHERE emisor_fk = %s", (user_id,))
+        cur.execute(f"DELETE FROM {tabla} WHERE receptor_fk = %s", (user_id,))
     cur.execute("DELETE FROM usuarios WHERE id = %s", (user_id,))
     mysql.connection.commit()
     cur.close()
+    recoger_imagenes(almacen_publicaciones, huerfanas_publicaciones)
+    recoger_imagenes(almacen_fotos_perfil, huerfanas_fotos)
+    grafo_amigos.olvidar(user_id)
+    # Sus publicaciones estaban en feeds ajenos; es raro, vaciamos todo
+    cache_respuestas.limpiar()
+    cache_pistas.limpiar()
 
     return jsonify({'mensaje': 'Cuenta eliminada correctamente'}), 200
 
@@ -290,34 +487,49 @@ def buscar_usuarios():
     
     if user_id is None:
         return jsonify({'mensaje': 'Faltan datos'}), 400
+    user_id = leer_id(user_id)
+    if user_id is None:
+        return jsonify({'mensaje': 'user_id no válido'}), 400
 
     cur = mysql.connection.cursor()
-    query = """
-        SELECT u.id, u.nombre_usuario, u.foto_perfil,
-        CASE 
-            WHEN a.estado = 'aceptado' THEN 'aceptado'
-            WHEN a.estado = 'pendiente' THEN 'pendiente'
-            ELSE 'no_amigo'
-        END AS estado
-        FROM usuarios u
-        LEFT JOIN amigos a ON (
-            (a.usuario_fk = u.id AND a.amigo_fk = %s) OR 
-            (a.usuario_fk = %s AND a.amigo_fk = u.id)
-        )
-        WHERE u.nombre_usuario LIKE %s AND u.id != %s
-        LIMIT 10
-    """
     like_pattern = f"%{nombre}%"
-    cur.execute(query, (user_id, user_id, like_pattern, user_id))
+    cur.execute("""
+        SELECT id, nombre_usuario, foto_perfil
+        FROM usuarios
+        WHERE nombre_usuario LIKE %s AND id != %s
+        LIMIT 10
+    """, (like_pattern, user_id))
     resultados = cur.fetchall()
+
+    # Las amistades salen del grafo; solo las solicitudes pendientes de
+    # estos (como mucho 10) usuarios se consultan
+    candidatos = [r[0] for r in resultados if not grafo_amigos.son_amigos(user_id, r[0])]
+    pendientes = set()
+    if candidatos:
+        marcas = ','.join(['%s'] * len(candidatos))
+        cur.execute(f"""
+            SELECT amigo_fk FROM amigos
+            WHERE usuario_fk = %s AND estado = 'pendiente' AND amigo_fk IN ({marcas})
+            UNION
+            SELECT usuario_fk FROM amigos
+            WHERE amigo_fk = %s AND estado = 'pendiente' AND usuario_fk IN ({marcas})
+        """, [user_id, *candidatos, user_id, *candidatos])
+        pendientes = {fila[0] for fila in cur.fetchall()}
     cur.close()
 
+    def estado(otro_id):
+        if otro_id in pendientes:
+            return 'pendiente'
+        if otro_id in candidatos:
+            return 'no_amigo'
+        return 'aceptado'
+
     lista_usuarios = [
         {
             'id': r[0],
             'nombre': r[1],
             'foto': r[2] if r[2] else None,  # Devuelve None si no hay foto
-            'estado': r[3]
+            'estado': estado(r[0])
         }
         for r in resultados
     ]
@@ -365,68 +577,108 @@ def allowed_file(filename):
 
 
 
-@app.route('/perfil', methods=['GET'])
-@token_required
-def obtener_perfil():
-    user_id = request.user['user_id']
-    cur = mysql.connection.cursor()
+PERFIL_LIMITE_POR_DEFECTO = 30
+PERFIL_LIMITE_MAXIMO = 90
+
+
+def construir_perfil(id_usuario, incluir_user_id_en_publicaciones=False):
+    """
+    Resumen del perfil (una consulta con los contadores precalculados) y una
+    pagina de la cuadricula de publicaciones con su primera imagen.
+    """
+    limite = leer_limite(request.args.get('limite'), PERFIL_LIMITE_POR_DEFECTO, PERFIL_LIMITE_MAXIMO)
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            cursor_fecha, cursor_id = decodificar_cursor(cursor)
+        except ValueError:
+            return jsonify({'mensaje': 'Cursor inválido'}), 400
 
-    # Obtener nombre y foto
+    cur = mysql.connection.cursor()
     cur.execute("""
-        SELECT nombre_usuario, foto_perfil
+        SELECT nombre_usuario, foto_perfil, num_amigos, num_publicaciones
         FROM usuarios
         WHERE id = %s
-    """, (user_id,))
+    """, (id_usuario,))
     usuario = cur.fetchone()
     if not usuario:
         cur.close()
         return jsonify({'mensaje': 'Usuario no encontrado'}), 404
-    nombre_usuario, foto_perfil = usuario
-
-    # Contar amigos aceptados
-    cur.execute("""
-        SELECT COUNT(*) FROM amigos 
-        WHERE (usuario_fk = %s OR amigo_fk = %s) AND estado = 'aceptado'
-    """, (user_id, user_id))
-    num_amigos = cur.fetchone()[0]
-
-    # Contar publicaciones
-    cur.execute("""
-        SELECT COUNT(*) FROM publicaciones
+    nombre_usuario, foto_perfil, num_amigos, num_publicaciones = usuario
+
+    params = [id_usuario]
+    filtro_cursor = ''
+    if cursor:
+        filtro_cursor = "AND (fecha < %s OR (fecha = %s AND id < %s))"
+        params += [cursor_fecha, cursor_fecha, cursor_id]
+    params.append(limite + 1)
+    cur.execute(f"""
+        SELECT id, fecha, distancia, duracion
+        FROM publicaciones
         WHERE usuario_id = %s
-    """, (user_id,))
-    num_publicaciones = cur.fetchone()[0]
-
-    # Obtener publicaciones con su primera imagen (si tiene)
-    cur.execute("""
-        SELECT p.id,
-               (SELECT nombre_imagen 
-                FROM imagenes 
-                WHERE id_publicacion = p.id 
-                LIMIT 1) AS imagen
-        FROM publicaciones p
-        WHERE p.usuario_id = %s
-        ORDER BY p.fecha DESC
-    """, (user_id,))
+        {filtro_cursor}
+        ORDER BY fecha DESC, id DESC
+        LIMIT %s
+    """, tuple(params))
     filas = cur.fetchall()
 
-    publicaciones = []
-    for pub_id, imagen in filas:
-        publicaciones.append({
-            'id': pub_id,
-            'imagen': f"http://10.0.2.2:5000/imagenes_publicaciones/{imagen}" if imagen else None
-        })
+    siguiente_cursor = ''
+    if len(filas) > limite:
+        filas = filas[:limite]
+        siguiente_cursor = codificar_cursor(filas[-1][1], filas[-1][0])
 
+    primeras = primeras_imagenes(cur, [fila[0] for fila in filas])
     cur.close()
 
-    return jsonify({
+    publicaciones = []
+    for pub_id, _, distancia, duracion in filas:
+        imagen = primeras.get(pub_id)
+        publicacion = {'id': pub_id}
+        if incluir_user_id_en_publicaciones:
+            publicacion['user_id'] = id_usuario
+        publicacion['imagen'] = f"http://10.0.2.2:5000/imagenes_publicaciones/{imagen}?tam=mini" if imagen else None
+        publicacion['distancia'] = float(distancia) if distancia is not None else None
+        publicacion['duracion'] = formatear_duracion(duracion)
+        publicaciones.append(publicacion)
+
+    g.etiquetas_cache = {('perfil', id_usuario)}
+    respuesta = jsonify({
         'nombre_usuario': nombre_usuario,
         'foto_perfil': foto_perfil,
         'num_amigos': num_amigos,
         'num_publicaciones': num_publicaciones,
         'publicaciones': publicaciones,
-        'user_id' : user_id
-    }), 200
+        'user_id': id_usuario
+    })
+    respuesta.headers['X-Siguiente-Cursor'] = siguiente_cursor
+    return respuesta, 200
+
+
+def primeras_imagenes(cur, ids_publicaciones):
+    """
+    Primera imagen de cada publicacion en una sola consulta.
+    """
+    if not ids_publicaciones:
+        return {}
+    formato_in = ','.join(['%s'] * len(ids_publicaciones))
+    cur.execute(f"""
+        SELECT i.id_publicacion, i.nombre_imagen
+        FROM imagenes i
+        JOIN (
+            SELECT MIN(id_imagen) AS id_imagen
+            FROM imagenes
+            WHERE id_publicacion IN ({formato_in})
+            GROUP BY id_publicacion
+        ) primera ON primera.id_imagen = i.id_imagen
+    """, tuple(ids_publicaciones))
+    return dict(cur.fetchall())
+
+
+@app.route('/perfil', methods=['GET'])
+@token_required
+@respuesta_cacheada
+def obtener_perfil():
+    return construir_perfil(request.user['user_id'])
 
 @app.route('/peso', methods=['GET'])
 @token_required
@@ -446,136 +698,386 @@ def obtener_peso():
 
 @app.route('/perfil/<int:id_usuario>', methods=['GET'])
 @token_required
+@respuesta_cacheada
 def obtener_perfil_de_otro_usuario(id_usuario):
-    cur = mysql.connection.cursor()
-    cur.execute("""
-        SELECT nombre_usuario, foto_perfil
-        FROM usuarios
-        WHERE id = %s
-    """, (id_usuario,))
-    usuario = cur.fetchone()
-    if not usuario:
-        cur.close()
-        return jsonify({'mensaje': 'Usuario no encontrado'}), 404
+    return construir_perfil(id_usuario, incluir_user_id_en_publicaciones=True)
 
-    nombre_usuario, foto_perfil = usuario
-
-    cur.execute("""
-        SELECT COUNT(*) FROM amigos 
-        WHERE (usuario_fk = %s OR amigo_fk = %s) AND estado = 'aceptado'
-    """, (id_usuario, id_usuario))
-    num_amigos = cur.fetchone()[0]
 
-    cur.execute("""
-        SELECT COUNT(*) FROM publicaciones
-        WHERE usuario_id = %s
-    """, (id_usuario,))
-    num_publicaciones = cur.fetchone()[0]
 
+# ----------------------
+# LINEA DE TIEMPO (fan-out en escritura)
+# ----------------------
+def repartir_publicacion(cur, publicacion_id, autor_id):
+    """
+    Copia la publicacion en la linea de tiempo del autor y de sus amigos.
+    Devuelve los ids de los usuarios que la reciben.
+    """
     cur.execute("""
-        SELECT p.id,
-               (SELECT nombre_imagen 
-                FROM imagenes 
-                WHERE id_publicacion = p.id 
-                LIMIT 1) AS imagen
+        INSERT IGNORE INTO linea_tiempo (usuario_fk, publicacion_fk, autor_fk, fecha)
+        SELECT d.destinatario, p.id, p.usuario_id, p.fecha
         FROM publicaciones p
-        WHERE p.usuario_id = %s
-        ORDER BY p.fecha DESC
-    """, (id_usuario,))
-    filas = cur.fetchall()
+        JOIN (
+            SELECT %s AS destinatario
+            UNION
+            SELECT amigo_fk FROM amigos WHERE usuario_fk = %s AND estado = 'aceptado'
+            UNION
+            SELECT usuario_fk FROM amigos WHERE amigo_fk = %s AND estado = 'aceptado'
+        ) d
+        WHERE p.id = %s
+    """, (autor_id, autor_id, autor_id, publicacion_id))
 
-    publicaciones = []
-    for pub_id, imagen in filas:
-        publicaciones.append({
-            'id': pub_id,
-            'user_id': id_usuario,
-            'imagen': f"http://10.0.2.2:5000/imagenes_publicaciones/{imagen}" if imagen else None
-        })
+    cur.execute("SELECT usuario_fk FROM linea_tiempo WHERE publicacion_fk = %s", (publicacion_id,))
+    return [row[0] for row in cur.fetchall()]
 
-    cur.close()
 
-    return jsonify({
-        'nombre_usuario': nombre_usuario,
-        'foto_perfil': foto_perfil,
-        'num_amigos': num_amigos,
-        'num_publicaciones': num_publicaciones,
-        'publicaciones': publicaciones,
-        'user_id': id_usuario
-    }), 200
+def rellenar_linea_tiempo(cur, usuario_id, amigo_id):
+    """
+    Al aceptar una amistad cada uno recibe las publicaciones del otro.
+    """
+    for destinatario, autor in ((usuario_id, amigo_id), (amigo_id, usuario_id)):
+        cur.execute("""
+            INSERT IGNORE INTO linea_tiempo (usuario_fk, publicacion_fk, autor_fk, fecha)
+            SELECT %s, p.id, p.usuario_id, p.fecha
+            FROM publicaciones p
+            WHERE p.usuario_id = %s
+        """, (destinatario, autor))
+
 
+def publicacion_por_clave(cur, user_id, clave):
+    cur.execute("""
+        SELECT id FROM publicaciones WHERE usuario_id = %s AND clave_idempotencia = %s
+    """, (user_id, clave))
+    fila = cur.fetchone()
+    return fila[0] if fila else None
+
+
+def respuesta_publicacion_existente(cur, publicacion_id):
+    cur.execute("SELECT nombre_imagen FROM imagenes WHERE id_publicacion = %s", (publicacion_id,))
+    imagenes = [f"{request.host_url}imagenes_publicaciones/{fila[0]}" for fila in cur.fetchall()]
+    cur.execute("SELECT id, tipo, estado, carga FROM trabajos WHERE publicacion_fk = %s ORDER BY id",
+                (publicacion_id,))
+    trabajos = cur.fetchall()
+    cur.close()
+    trabajos_ids = [fila[0] for fila in trabajos]
+    # Mientras procesar_imagenes no termine, sus imagenes aun no tienen URL
+    pendientes = [pendiente for _, tipo, estado, carga in trabajos
+                  if tipo == 'procesar_imagenes' and estado in ('pendiente', 'en_curso')
+                  for pendiente in json.loads(carga)['imagenes']]
+    return jsonify({
+        'mensaje': 'Publicación creada correctamente',
+        'id_publicacion': publicacion_id,
+        'imagenes': imagenes,
+        'imagenes_pendientes': pendientes,
+        'trabajos': trabajos_ids
+    }), 201
 
 
 @app.route('/crear_actividad', methods=['POST'])
 @token_required
 def crear_actividad():
+    """
+    Crea la publicacion y deja el GPX y las imagenes en pendientes; el
+    procesado lo hace la cola de trabajos. Los archivos pueden venir en el
+    formulario o subidos antes con /subidas (campos gpx_subida e
+    imagenes_subidas). Con la cabecera Idempotency-Key un reintento del
+    cliente devuelve la misma publicacion.
+    """
     user_id = request.user['user_id']
     descripcion = request.form.get('descripcion')
-    tiene_gps = 0
-    gps_data_json = None
+    clave = request.headers.get('Idempotency-Key') or None
+    if clave and len(clave) > 64:
+        return jsonify({'mensaje': 'Idempotency-Key demasiado larga'}), 400
 
     try:
-        # GPX a JSON
+        cur = mysql.connection.cursor()
+        if clave:
+            existente = publicacion_por_clave(cur, user_id, clave)
+            if existente:
+                return respuesta_publicacion_existente(cur, existente)
+
+        gpx_pendiente = request.form.get('gpx_subida') or None
+        imagenes_subidas = request.form.getlist('imagenes_subidas')
+        imagenes_pendientes = list(imagenes_subidas)
+        if gpx_pendiente and not subida_propia(user_id, gpx_pendiente, {'gpx'}):
+            return jsonify({'mensaje': 'Subida no encontrada'}), 400
+        if not all(subida_propia(user_id, subida, ALLOWED_EXTENSIONS) for subida in imagenes_subidas):
+            return jsonify({'mensaje': 'Subida no encontrada'}), 400
+
         if 'gpx' in request.files:
             gpx_file = request.files['gpx']
             if gpx_file.filename != '':
-                gpx = gpxpy.parse(gpx_file.stream)
-                puntos = []
-                for track in gpx.tracks:
-                    for segment in track.segments:
-                        for point in segment.points:
-                            puntos.append({
-                                "lat": point.latitude,
-                                "lon": point.longitude,
-                                "ele": point.elevation,
-                                "time": point.time.isoformat() if point.time else None
-                            })
-                gps_data_json = puntos
-                tiene_gps = 1
-
-        # Insertar publicacion
-        cur = mysql.connection.cursor()
-        cur.execute("""
-            INSERT INTO publicaciones (usuario_id, descripcion, gps_data, tiene_gps, duracion)
-            VALUES (%s, %s, %s, %s, %s)
-        """, (user_id, descripcion, json.dumps(gps_data_json), tiene_gps, "00:00:00"))
-        mysql.connection.commit()
-        publicacion_id = cur.lastrowid
+                gpx_pendiente = clave_pendiente(user_id, '.gpx')
+                almacenamiento.guardar_flujo(gpx_pendiente, gpx_file.stream)
 
-        # Guardar imagenes
-        imagenes_guardadas = []
+        claves_imagenes = []
         if 'imagenes' in request.files:
-            imagenes = request.files.getlist('imagenes')
-            carpeta_destino = 'C:\\imagenes_hercules\\publicaciones'
-            os.makedirs(carpeta_destino, exist_ok=True)
-
-            for imagen in imagenes:
+            for imagen in request.files.getlist('imagenes'):
                 if imagen and allowed_file(imagen.filename):
-                    extension = os.path.splitext(imagen.filename)[1]
-                    nombre_unico = f"{uuid.uuid4().hex}{extension}"
-                    ruta_fisica = os.path.join(carpeta_destino, nombre_unico)
-                    imagen.save(ruta_fisica)
-
-                    # Guardamos solo el nombre para reconstruir la URL luego
-                    cur.execute("""
-                        INSERT INTO imagenes (id_publicacion, nombre_imagen)
-                        VALUES (%s, %s)
-                    """, (publicacion_id, nombre_unico))
-                    #EDITADO HOST_URL
-                    imagenes_guardadas.append(f"{request.host_url}imagenes_publicaciones/{nombre_unico}")
+                    # La imagen se publicara con el hash de su contenido
+                    claves_imagenes.append(hash_flujo(imagen.stream))
+                    imagen.stream.seek(0)
+                    pendiente = clave_pendiente(user_id, os.path.splitext(imagen.filename)[1])
+                    almacenamiento.guardar_flujo(pendiente, imagen.stream)
+                    imagenes_pendientes.append(pendiente)
+
+        # Insertar publicacion; las estadisticas llegan al procesar el GPX
+        try:
+            cur.execute("""
+                INSERT INTO publicaciones (usuario_id, descripcion, tiene_gps, duracion, clave_idempotencia)
+                VALUES (%s, %s, 0, '00:00:00', %s)
+            """, (user_id, descripcion, clave))
+        except MySQLdb.IntegrityError:
+            # Otra peticion con la misma clave se nos ha adelantado
+            mysql.connection.rollback()
+            existente = publicacion_por_clave(cur, user_id, clave)
+            if existente is None:
+                raise
+            return respuesta_publicacion_existente(cur, existente)
+        publicacion_id = cur.lastrowid
+        lectores = repartir_publicacion(cur, publicacion_id, user_id)
+        cur.execute("UPDATE usuarios SET num_publicaciones = num_publicaciones + 1 WHERE id = %s", (user_id,))
+        consumir_subidas(cur, [request.form.get('gpx_subida'), *imagenes_subidas])
+
+        trabajos_ids = []
+        if gpx_pendiente:
+            trabajos_ids.append(cola_trabajos.encolar(
+                cur, 'procesar_gpx',
+                {'publicacion_id': publicacion_id, 'usuario_id': user_id, 'clave': gpx_pendiente},
+                clave=f"procesar_gpx:{publicacion_id}", usuario_id=user_id, publicacion_id=publicacion_id
+            ))
+        if imagenes_pendientes:
+            trabajos_ids.append(cola_trabajos.encolar(
+                cur, 'procesar_imagenes',
+                {'publicacion_id': publicacion_id, 'usuario_id': user_id, 'imagenes': imagenes_pendientes},
+                clave=f"procesar_imagenes:{publicacion_id}", usuario_id=user_id, publicacion_id=publicacion_id
+            ))
 
         mysql.connection.commit()
         cur.close()
+        cola_trabajos.avisar()
+        cache_respuestas.invalidar(('perfil', user_id), *[('feed', lector) for lector in lectores])
 
         return jsonify({
             'mensaje': 'Publicación creada correctamente',
             'id_publicacion': publicacion_id,
-            'imagenes': imagenes_guardadas
+            #EDITADO HOST_URL
+            'imagenes': [f"{request.host_url}imagenes_publicaciones/{clave}" for clave in claves_imagenes],
+            # Las subidas antes no se leen aqui: su URL sale al terminar procesar_imagenes
+            'imagenes_pendientes': imagenes_subidas,
+            'trabajos': trabajos_ids
         }), 201
 
     except Exception as e:
         print(f"Error en /crear_actividad: {e}")
         return jsonify({'error': 'No se pudo crear la publicación'}), 500
 
+
+# ----------------------
+# TRABAJOS EN SEGUNDO PLANO
+# ----------------------
+def publicacion_existe(cur, publicacion_id):
+    cur.execute("SELECT 1 FROM publicaciones WHERE id = %s", (publicacion_id,))
+    return cur.fetchone() is not None
+
+
+def borrar_gpx_pendiente(carga):
+    almacenamiento.borrar(carga['clave'])
+
+
+def borrar_imagenes_pendientes(carga):
+    for pendiente in carga['imagenes']:
+        almacenamiento.borrar(pendiente)
+
+
+# Si el trabajo fracasa del todo, nadie volvera a leer lo subido
+@cola_trabajos.tarea('procesar_gpx', al_fallar=borrar_gpx_pendiente)
+def procesar_gpx(cur, carga, trabajo_id):
+    publicacion_id = carga['publicacion_id']
+    if not publicacion_existe(cur, publicacion_id):
+        borrar_gpx_pendiente(carga)
+        return None
+
+    try:
+        with almacenamiento.archivo_local(carga['clave']) as ruta, open(ruta, 'rb') as gpx_file:
+            lat, lon, ele, tiempo = leer_gpx(gpx_file, app.config['GPX_MAX_PUNTOS'])
+    except GPXInvalido as e:
+        raise ErrorDefinitivo(str(e))
+
+    estadisticas = columnas_estadisticas(calcular_estadisticas(lat, lon, ele, tiempo))
+    guardar_pista(cur, publicacion_id, lat, lon, ele, tiempo)
+    asignaciones = ', '.join(f"{columna} = %s" for columna in estadisticas)
+    cur.execute(f"UPDATE publicaciones SET tiene_gps = 1, {asignaciones} WHERE id = %s",
+                (*estadisticas.values(), publicacion_id))
+
+    def despues():
+        borrar_gpx_pendiente(carga)
+        cache_respuestas.invalidar(('publicacion', publicacion_id), ('perfil', carga['usuario_id']))
+        cache_pistas.invalidar(('pista', publicacion_id))
+    return despues
+
+
+@cola_trabajos.tarea('procesar_imagenes', al_fallar=borrar_imagenes_pendientes)
+def procesar_imagenes(cur, carga, trabajo_id):
+    publicacion_id = carga['publicacion_id']
+    if not publicacion_existe(cur, publicacion_id):
+        borrar_imagenes_pendientes(carga)
+        return None
+
+    for pendiente in carga['imagenes']:
+        if not almacenamiento.existe(pendiente):
+            continue
+        with almacenamiento.archivo_local(pendiente) as ruta:
+            # El original (con su EXIF) no se publica: solo sus variantes
+            try:
+                clave = almacen_publicaciones.preparar(ruta)
+            except ImagenInvalida as e:
+                print(f"Imagen descartada {pendiente}: {e}")
+                continue
+            # Guardamos solo el hash para reconstruir la URL luego
+            cur.execute("""
+                INSERT IGNORE INTO imagenes (id_publicacion, nombre_imagen)
+                VALUES (%s, %s)
+            """, (publicacion_id, clave))
+            if cur.rowcount == 1:
+                almacen_publicaciones.referenciar(cur, clave, ruta)
+
+    def despues():
+        borrar_imagenes_pendientes(carga)
+        cache_respuestas.invalidar(('publicacion', publicacion_id), ('perfil', carga['usuario_id']))
+    return despues
+
+
+def trabajo_json(fila):
+    return {
+        'id': fila[0],
+        'tipo': fila[1],
+        'estado': fila[2],
+        'intentos': fila[3],
+        'error': fila[4],
+        'id_publicacion': fila[5],
+    }
+
+
+@app.route('/trabajos/<int:trabajo_id>', methods=['GET'])
+@token_required
+def obtener_trabajo(trabajo_id):
+    user_id = request.user['user_id']
+    cur = mysql.connection.cursor()
+    cur.execute("""
+        SELECT id, tipo, estado, intentos, error, publicacion_fk
+        FROM trabajos WHERE id = %s AND usuario_fk = %s
+    """, (trabajo_id, user_id))
+    fila = cur.fetchone()
+    cur.close()
+    if not fila:
+        return jsonify({'mensaje': 'Trabajo no encontrado'}), 404
+    return jsonify(trabajo_json(fila)), 200
+
+
+@app.route('/publicacion/<int:publicacion_id>/trabajos', methods=['GET'])
+@token_required
+def obtener_trabajos_publicacion(publicacion_id):
+    user_id = request.user['user_id']
+    cur = mysql.connection.cursor()
+    cur.execute("""
+        SELECT id, tipo, estado, intentos, error, publicacion_fk
+        FROM trabajos WHERE publicacion_fk = %s AND usuario_fk = %s
+        ORDER BY id
+    """, (publicacion_id, user_id))
+    filas = cur.fetchall()
+    cur.close()
+    return jsonify([trabajo_json(fila) for fila in filas]), 200
+
+
+@app.cli.command('trabajador')
+@click.option('--hilos', default=TRABAJOS_HILOS, help='Hilos que procesan la cola.')
+def trabajador_cmd(hilos):
+    """Procesa la cola de trabajos en primer plano."""
+    cola_trabajos.num_hilos = hilos
+    cola_trabajos.arrancar()
+    print(f"Procesando trabajos con {hilos} hilos (Ctrl+C para salir)")
+    while True:
+        time.sleep(60)
+
+
+# ----------------------
+# CONTADORES DE LIKES Y COMENTARIOS
+# ----------------------
+CONTADORES_INTERVALO_VOLCADO = 2  # segundos
+
+contadores = ContadoresPendientes(app, mysql, cache_respuestas, CONTADORES_INTERVALO_VOLCADO)
+
+
+def reconciliar_contadores(cur, lote=1000):
+    """
+    Recalcula total_likes/total_comentarios desde me_gustas y comentarios,
+    por rangos de id para no bloquear la tabla entera.
+    """
+    cur.execute("SELECT COALESCE(MAX(id), 0) FROM publicaciones")
+    max_id = cur.fetchone()[0]
+    corregidas = 0
+    for desde in range(0, max_id, lote):
+        cur.execute("""
+            UPDATE publicaciones p
+            LEFT JOIN (
+                SELECT id_publicacion, COUNT(*) AS n FROM me_gustas
+                WHERE id_publicacion > %s AND id_publicacion <= %s
+                GROUP BY id_publicacion
+            ) l ON l.id_publicacion = p.id
+            LEFT JOIN (
+                SELECT id_publicacion, COUNT(*) AS n FROM comentarios
+                WHERE id_publicacion > %s AND id_publicacion <= %s
+                GROUP BY id_publicacion
+            ) c ON c.id_publicacion = p.id
+            SET p.total_likes = COALESCE(l.n, 0),
+                p.total_comentarios = COALESCE(c.n, 0)
+            WHERE p.id > %s AND p.id <= %s
+              AND (p.total_likes <> COALESCE(l.n, 0) OR p.total_comentarios <> COALESCE(c.n, 0))
+        """, (desde, desde + lote) * 3)
+        corregidas += cur.rowcount
+        mysql.connection.commit()
+    return corregidas
+
+
+def reconciliar_contadores_usuarios(cur):
+    """
+    Recalcula num_amigos/num_publicaciones de usuarios.
+    """
+    cur.execute("""
+        UPDATE usuarios u
+        LEFT JOIN (
+            SELECT id_usuario, COUNT(*) AS n FROM (
+                SELECT usuario_fk AS id_usuario FROM amigos WHERE estado = 'aceptado'
+                UNION ALL
+                SELECT amigo_fk FROM amigos WHERE estado = 'aceptado'
+            ) extremos
+            GROUP BY id_usuario
+        ) a ON a.id_usuario = u.id
+        LEFT JOIN (
+            SELECT usuario_id, COUNT(*) AS n FROM publicaciones GROUP BY usuario_id
+        ) p ON p.usuario_id = u.id
+        SET u.num_amigos = COALESCE(a.n, 0),
+            u.num_publicaciones = COALESCE(p.n, 0)
+        WHERE u.num_amigos <> COALESCE(a.n, 0) OR u.num_publicaciones <> COALESCE(p.n, 0)
+    """)
+    corregidos = cur.rowcount
+    mysql.connection.commit()
+    return corregidos
+
+
+@app.cli.command('reconciliar-contadores')
+@click.option('--lote', default=1000, help='Publicaciones por transaccion.')
+def reconciliar_contadores_cmd(lote):
+    """Repara la deriva de los contadores de publicaciones y usuarios."""
+    cur = mysql.connection.cursor()
+    contadores.volcar(cur)
+    corregidas = reconciliar_contadores(cur, lote)
+    corregidos = reconciliar_contadores_usuarios(cur)
+    cur.close()
+    print(f"Publicaciones corregidas: {corregidas}")
+    print(f"Usuarios corregidos: {corregidos}")
+
+
 # ----------------------
 # API: COMENTARIOS
 # ----------------------
@@ -597,6 +1099,8 @@ def comentar(publicacion_id):
         """, (publicacion_id, user_id, contenido))
         mysql.connection.commit()
         cur.close()
+        contadores.sumar(publicacion_id, comentarios=1)
+        cache_respuestas.invalidar(('publicacion', publicacion_id))
         return jsonify({'mensaje': 'Comentario publicado correctamente'}), 201
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -609,19 +1113,55 @@ def eliminar_publicacion(publicacion_id):
     try:
         cur = mysql.connection.cursor()
 
+        # Solo el autor puede borrarla: se comprueba antes de tocar nada
+        cur.execute("""
+            SELECT 1 FROM publicaciones WHERE id = %s AND usuario_id = %s FOR UPDATE
+        """, (publicacion_id, user_id))
+        if not cur.fetchone():
+            cur.close()
+            return jsonify({'mensaje': 'Publicación no encontrada'}), 404
+
         # Eliminar relaciones dependientes primero si no usas ON DELETE CASCADE
         cur.execute("DELETE FROM comentarios WHERE id_publicacion = %s", (publicacion_id,))
-        cur.execute("DELETE FROM imagenes WHERE id_publicacion = %s", (publicacion_id,))
+        cur.execute("""
+            SELECT i.nombre_imagen FROM imagenes i
+            JOIN publicaciones p ON p.id = i.id_publicacion
+            WHERE p.id = %s AND p.usuario_id = %s
+        """, (publicacion_id, user_id))
+        claves_imagenes = [fila[0] for fila in cur.fetchall()]
+        cur.execute("""
+            DELETE i FROM imagenes i
+            JOIN publicaciones p ON p.id = i.id_publicacion
+            WHERE p.id = %s AND p.usuario_id = %s
+        """, (publicacion_id, user_id))
+        huerfanas = almacen_publicaciones.liberar(cur, claves_imagenes)
         cur.execute("DELETE FROM me_gustas WHERE id_publicacion = %s", (publicacion_id,))
 
+        cur.execute("""
+            DELETE lt FROM linea_tiempo lt
+            JOIN publicaciones p ON p.id = lt.publicacion_fk
+            WHERE p.id = %s AND p.usuario_id = %s
+        """, (publicacion_id, user_id))
+
         # Corrige el nombre de la columna
         cur.execute("""
             DELETE FROM publicaciones
             WHERE id = %s AND usuario_id = %s
         """, (publicacion_id, user_id))
 
+        eliminada = cur.rowcount == 1
+        if eliminada:
+            cur.execute("""
+                UPDATE usuarios SET num_publicaciones = GREATEST(CAST(num_publicaciones AS SIGNED) - 1, 0)
+                WHERE id = %s
+            """, (user_id,))
         mysql.connection.commit()
         cur.close()
+        recoger_imagenes(almacen_publicaciones, huerfanas)
+        if eliminada:
+            contadores.descartar(publicacion_id)
+            cache_respuestas.invalidar(('publicacion', publicacion_id), ('perfil', user_id))
+            cache_pistas.invalidar(('pista', publicacion_id))
 
         return jsonify({'mensaje': 'Publicación eliminada'}), 200
     except Exception as e:
@@ -629,58 +1169,482 @@ def eliminar_publicacion(publicacion_id):
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
-@app.route('/publicacion/<int:id>/gps')
-@token_required
-def obtener_gps(id):
-    cur = mysql.connection.cursor()
-    cur.execute("SELECT gps_data FROM publicaciones WHERE id = %s", (id,))
-    row = cur.fetchone()
-    cur.close()
-
-    if row and row[0]:
-        try:
-            datos = json.loads(row[0])  # Convierte la cadena JSON a lista real
-            return jsonify(datos)
-        except Exception as e:
-            print(f"Error parseando gps_data: {e}")
-            return jsonify({'error': 'Formato inválido de gps_data'}), 500
+# ----------------------
+# PISTAS GPS
+# ----------------------
+def guardar_pista(cur, publicacion_id, lat, lon, ele, tiempo):
+    """
+    Guarda la pista completa, sus niveles de detalle simplificados y su
+    entrada en el indice espacial.
+    """
+    cur.execute("""
+        INSERT INTO pistas_gps (publicacion_fk, datos)
+        VALUES (%s, %s)
+        ON DUPLICATE KEY UPDATE datos = VALUES(datos)
+    """, (publicacion_id, codificar_pista(lat, lon, ele, tiempo)))
+    guardar_niveles(cur, publicacion_id, lat, lon, ele, tiempo)
+    guardar_area(cur, publicacion_id, lat, lon)
 
-    return jsonify([]), 404
 
+def guardar_area(cur, publicacion_id, lat, lon):
+    """
+    Punto de salida y caja envolvente de la pista para las busquedas por zona.
+    """
+    if len(lat) == 0:
+        return
+    min_lat, max_lat = float(np.min(lat)), float(np.max(lat))
+    min_lon, max_lon = float(np.min(lon)), float(np.max(lon))
+    # Un poligono sin area no es valido: ensanchamos las cajas degeneradas
+    if max_lat - min_lat < 1e-6:
+        max_lat = min_lat + 1e-6
+    if max_lon - min_lon < 1e-6:
+        max_lon = min_lon + 1e-6
+    caja = (f"POLYGON(({min_lon} {min_lat}, {max_lon} {min_lat}, {max_lon} {max_lat}, "
+            f"{min_lon} {max_lat}, {min_lon} {min_lat}))")
+    cur.execute("""
+        REPLACE INTO areas_actividad
+            (publicacion_fk, usuario_fk, fecha, inicio, caja, min_lat, min_lon, max_lat, max_lon)
+        SELECT p.id, p.usuario_id, p.fecha, POINT(%s, %s), ST_GeomFromText(%s, 0), %s, %s, %s, %s
+        FROM publicaciones p
+        WHERE p.id = %s
+    """, (float(lon[0]), float(lat[0]), caja, min_lat, min_lon, max_lat, max_lon, publicacion_id))
 
 
-@app.route('/publicacion/<int:publicacion_id>/comentarios', methods=['GET'])
-@token_required
-def obtener_comentarios(publicacion_id):
-    try:
-        cur = mysql.connection.cursor()
-        cur.execute("""
-            SELECT c.contenido, u.nombre_usuario, u.id AS id_usuario
-            FROM comentarios c
-            JOIN usuarios u ON c.id_usuario = u.id
-            WHERE c.id_publicacion = %s
-            ORDER BY c.id_comentario ASC
-        """, (publicacion_id,))
-        resultados = cur.fetchall()
-        cur.close()
+def guardar_niveles(cur, publicacion_id, lat, lon, ele, tiempo):
+    cur.execute("DELETE FROM pistas_gps_niveles WHERE publicacion_fk = %s", (publicacion_id,))
+    niveles = generar_niveles(lat, lon, ele, tiempo)
+    if niveles:
+        cur.executemany("""
+            INSERT INTO pistas_gps_niveles (publicacion_fk, nivel, tolerancia_m, num_puntos, datos)
+            VALUES (%s, %s, %s, %s, %s)
+        """, [(publicacion_id, *nivel) for nivel in niveles])
 
-        comentarios = [
-            {
-                'usuario': fila[1],
-                'contenido': fila[0],
-                'id_usuario': fila[2]
-            }
-            for fila in resultados
-        ]
-        return jsonify(comentarios), 200
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+
+# Limites de las columnas: en modo estricto MySQL rechaza el UPDATE entero
+DURACION_MAXIMA_S = 838 * 3600 + 59 * 60 + 59  # TIME
+DISTANCIA_MAXIMA_KM = 999999.99                 # DECIMAL(8,2)
+
+
+def columnas_estadisticas(est):
+    """
+    Valores de las columnas de estadisticas de publicaciones. Sin pista
+    solo se rellena la duracion obligatoria.
+    """
+    if est is None:
+        return {'duracion': "00:00:00"}
+
+    def kmh(velocidad):
+        return round(velocidad * 3.6, 2) if velocidad is not None else None
+
+    return {
+        'duracion': formatear_duracion(timedelta(seconds=min(round(est.duracion_s or 0), DURACION_MAXIMA_S))),
+        'distancia': min(round(est.distancia_m / 1000, 2), DISTANCIA_MAXIMA_KM),
+        'tiempo_movimiento': round(est.tiempo_movimiento_s) if est.tiempo_movimiento_s is not None else None,
+        'desnivel_positivo': round(est.desnivel_positivo_m, 1),
+        'desnivel_negativo': round(est.desnivel_negativo_m, 1),
+        'velocidad_max': kmh(est.velocidad_max_ms),
+        'velocidad_media': kmh(est.velocidad_media_ms),
+        'parciales_km': json.dumps(est.parciales_km),
+    }
+
+
+def formatear_estadisticas(pub):
+    # DECIMAL llega como Decimal; la app espera numeros
+    for campo in ('distancia', 'desnivel_positivo', 'desnivel_negativo', 'velocidad_max', 'velocidad_media'):
+        if pub.get(campo) is not None:
+            pub[campo] = float(pub[campo])
+    if isinstance(pub.get('parciales_km'), str):
+        pub['parciales_km'] = json.loads(pub['parciales_km'])
+    return pub
+
+
+def cargar_nivel(cur, publicacion_id, resolucion_m):
+    """
+    Nivel de detalle mas simple cuya tolerancia no supera resolucion_m.
+    Devuelve (nivel, Pista) o None si hay que usar la pista completa.
+    """
+    cur.execute("""
+        SELECT nivel, datos FROM pistas_gps_niveles
+        WHERE publicacion_fk = %s AND tolerancia_m <= %s
+        ORDER BY tolerancia_m DESC
+        LIMIT 1
+    """, (publicacion_id, resolucion_m))
+    row = cur.fetchone()
+    if row:
+        return row[0], decodificar_pista(row[1])
+    return None
+
+
+def cargar_pista(cur, publicacion_id):
+    """
+    Devuelve la Pista de la publicacion o None. Las publicaciones aun no
+    migradas se leen del JSON antiguo de publicaciones.gps_data.
+    """
+    cur.execute("SELECT datos FROM pistas_gps WHERE publicacion_fk = %s", (publicacion_id,))
+    row = cur.fetchone()
+    if row:
+        return decodificar_pista(row[0])
+
+    cur.execute("SELECT gps_data FROM publicaciones WHERE id = %s", (publicacion_id,))
+    row = cur.fetchone()
+    if row and row[0]:
+        puntos = json.loads(row[0])
+        if puntos:
+            return decodificar_pista(codificar_pista(*arrays_desde_puntos_json(puntos)))
+    return None
+
+
+@app.route('/publicacion/<int:id>/gps')
+@token_required
+def obtener_gps(id):
+    """
+    Pista GPS de la publicacion. Con ?zoom=<0-22> o ?resolucion=<metros>
+    devuelve el nivel de detalle simplificado adecuado para ese mapa.
+
+    La pista se envia por trozos (array JSON o, con ?formato=ndjson, un
+    punto por linea) comprimida segun Accept-Encoding. El cuerpo comprimido
+    se guarda en cache_pistas para las siguientes peticiones.
+    """
+    resolucion = None
+    try:
+        if request.args.get('resolucion') is not None:
+            resolucion = float(request.args['resolucion'])
+            # float() acepta 'nan' e 'inf'
+            if not math.isfinite(resolucion) or resolucion <= 0:
+                raise ValueError(resolucion)
+        elif request.args.get('zoom') is not None:
+            zoom = float(request.args['zoom'])
+            if not math.isfinite(zoom):
+                raise ValueError(zoom)
+            resolucion = metros_por_pixel(min(max(zoom, 0), 22))
+    except ValueError:
+        return jsonify({'mensaje': 'Parámetro de resolución inválido'}), 400
+
+    ndjson = (request.args.get('formato') == 'ndjson'
+              or request.accept_mimetypes.best == 'application/x-ndjson')
+    tipo = 'application/x-ndjson' if ndjson else 'application/json'
+    codificacion = elegir_codificacion(request.accept_encodings)
+    clave = (id, resolucion, ndjson, codificacion)
+
+    cacheada = cache_pistas.obtener(clave)
+    if cacheada is not None:
+        cuerpo, nivel, usada = cacheada
+        return respuesta_pista(cuerpo, tipo, usada, nivel)
+
+    cur = mysql.connection.cursor()
+    try:
+        nivel, pista = 0, None
+        if resolucion is not None:
+            nivel, pista = cargar_nivel(cur, id, resolucion) or (0, None)
+        if pista is None:
+            pista = cargar_pista(cur, id)
+    except (FormatoPistaInvalido, ValueError, KeyError) as e:
+        print(f"Error leyendo la pista GPS: {e}")
+        return jsonify({'error': 'Formato inválido de gps_data'}), 500
+    finally:
+        cur.close()
+
+    if pista is None:
+        return jsonify([]), 404
+    # Cada punto ocupa unos 70 bytes en JSON; las pistas minimas van sin comprimir
+    usada = codificacion if len(pista.lat) * 64 >= UMBRAL_COMPRESION else None
+
+    def generar():
+        # Se envia mientras se comprime y al acabar se guarda el resultado
+        enviados = []
+        for trozo in comprimir_flujo(trozos_json(iterar_puntos_json(pista), ndjson), usada):
+            enviados.append(trozo)
+            yield trozo
+        cuerpo = b''.join(enviados)
+        cache_pistas.guardar(clave, (cuerpo, nivel, usada), len(cuerpo), [('pista', id)], generacion)
+
+    generacion = cache_pistas.generacion
+    return respuesta_pista(generar(), tipo, usada, nivel)
+
+
+def respuesta_pista(cuerpo, tipo, codificacion, nivel):
+    respuesta = Response(cuerpo, mimetype=tipo)
+    if codificacion:
+        respuesta.headers['Content-Encoding'] = codificacion
+    respuesta.vary.add('Accept-Encoding')
+    respuesta.headers['X-Nivel-Detalle'] = str(nivel)
+    return respuesta
+
+
+# ----------------------
+# API: ACTIVIDADES POR ZONA
+# ----------------------
+ZONA_LIMITE_POR_DEFECTO = 50
+ZONA_LIMITE_MAXIMO = 200
+ZONA_RADIO_MAXIMO_KM = 100
+
+
+def leer_coordenada(nombre, minimo, maximo):
+    valor = float(request.args[nombre])
+    if not minimo <= valor <= maximo:
+        raise ValueError(nombre)
+    return valor
+
+
+def actividades_de_zona(filas):
+    return [
+        {
+            'id': fila[0],
+            'id_usuario': fila[1],
+            'nombre_usuario': fila[2],
+            'fecha': fila[3],
+            'distancia': float(fila[4]) if fila[4] is not None else None,
+            'inicio': {'lat': fila[5], 'lon': fila[6]},
+            'caja': {'min_lat': fila[7], 'min_lon': fila[8], 'max_lat': fila[9], 'max_lon': fila[10]},
+            **({'distancia_km': round(fila[11] / 1000, 3)} if len(fila) > 11 else {}),
+        }
+        for fila in filas
+    ]
+
+
+# Solo actividades visibles para el usuario: las de su linea de tiempo
+SELECT_ZONA = """
+    SELECT a.publicacion_fk, a.usuario_fk, u.nombre_usuario, a.fecha, p.distancia,
+           ST_Y(a.inicio), ST_X(a.inicio), a.min_lat, a.min_lon, a.max_lat, a.max_lon
+           {extra}
+    FROM areas_actividad a
+    JOIN linea_tiempo lt
+      ON lt.usuario_fk = %s AND lt.fecha = a.fecha AND lt.publicacion_fk = a.publicacion_fk
+    JOIN publicaciones p ON p.id = a.publicacion_fk
+    JOIN usuarios u ON u.id = a.usuario_fk
+"""
+
+
+@app.route('/actividades/cerca', methods=['GET'])
+@token_required
+def actividades_cerca():
+    """
+    Actividades que empiezan a menos de radio_km de (lat, lon), por cercania.
+    """
+    user_id = request.user['user_id']
+    try:
+        lat = leer_coordenada('lat', -90, 90)
+        lon = leer_coordenada('lon', -180, 180)
+        radio_km = float(request.args.get('radio_km', 5))
+        if not 0 < radio_km <= ZONA_RADIO_MAXIMO_KM:
+            raise ValueError('radio_km')
+    except (KeyError, ValueError):
+        return jsonify({'mensaje': 'Parámetros de ubicación inválidos'}), 400
+    limite = leer_limite(request.args.get('limite'), ZONA_LIMITE_POR_DEFECTO, ZONA_LIMITE_MAXIMO)
+
+    # Caja alrededor del punto para que filtre el indice espacial
+    grados_lat = radio_km / 111.32
+    grados_lon = radio_km / (111.32 * max(math.cos(math.radians(lat)), 0.01))
+    caja = (f"POLYGON(({lon - grados_lon} {lat - grados_lat}, {lon + grados_lon} {lat - grados_lat}, "
+            f"{lon + grados_lon} {lat + grados_lat}, {lon - grados_lon} {lat + grados_lat}, "
+            f"{lon - grados_lon} {lat - grados_lat}))")
+
+    try:
+        cur = mysql.connection.cursor()
+        cur.execute(SELECT_ZONA.format(extra=", ST_Distance_Sphere(a.inicio, POINT(%s, %s)) AS metros") + """
+            WHERE MBRContains(ST_GeomFromText(%s, 0), a.inicio)
+            HAVING metros <= %s
+            ORDER BY metros
+            LIMIT %s
+        """, (lon, lat, user_id, caja, radio_km * 1000, limite))
+        filas = cur.fetchall()
+        cur.close()
+        return jsonify(actividades_de_zona(filas)), 200
+    except Exception as e:
+        print(f"Error en /actividades/cerca: {e}")
+        return jsonify({'mensaje': 'Error al buscar actividades'}), 500
+
+
+@app.route('/actividades/zona', methods=['GET'])
+@token_required
+def actividades_en_zona():
+    """
+    Actividades cuyo recorrido cruza el rectangulo visible del mapa.
+    """
+    user_id = request.user['user_id']
+    try:
+        min_lat = leer_coordenada('min_lat', -90, 90)
+        max_lat = leer_coordenada('max_lat', -90, 90)
+        min_lon = leer_coordenada('min_lon', -180, 180)
+        max_lon = leer_coordenada('max_lon', -180, 180)
+        if min_lat >= max_lat or min_lon >= max_lon:
+            raise ValueError('caja')
+    except (KeyError, ValueError):
+        return jsonify({'mensaje': 'Parámetros de zona inválidos'}), 400
+    limite = leer_limite(request.args.get('limite'), ZONA_LIMITE_POR_DEFECTO, ZONA_LIMITE_MAXIMO)
+
+    caja = (f"POLYGON(({min_lon} {min_lat}, {max_lon} {min_lat}, {max_lon} {max_lat}, "
+            f"{min_lon} {max_lat}, {min_lon} {min_lat}))")
+    try:
+        cur = mysql.connection.cursor()
+        cur.execute(SELECT_ZONA.format(extra="") + """
+            WHERE MBRIntersects(a.caja, ST_GeomFromText(%s, 0))
+            ORDER BY a.fecha DESC
+            LIMIT %s
+        """, (user_id, caja, limite))
+        filas = cur.fetchall()
+        cur.close()
+        return jsonify(actividades_de_zona(filas)), 200
+    except Exception as e:
+        print(f"Error en /actividades/zona: {e}")
+        return jsonify({'mensaje': 'Error al buscar actividades'}), 500
+
+
+@app.cli.command('indexar-areas')
+@click.option('--lote', default=200, help='Pistas por transaccion.')
+def indexar_areas_cmd(lote):
+    """Rellena areas_actividad para las pistas que aun no estan indexadas."""
+    cur = mysql.connection.cursor()
+    indexadas = 0
+    ultimo_id = 0
+    while True:
+        cur.execute("""
+            SELECT pg.publicacion_fk, pg.datos FROM pistas_gps pg
+            LEFT JOIN areas_actividad a ON a.publicacion_fk = pg.publicacion_fk
+            WHERE pg.publicacion_fk > %s AND a.publicacion_fk IS NULL
+            ORDER BY pg.publicacion_fk
+            LIMIT %s
+        """, (ultimo_id, lote))
+        filas = cur.fetchall()
+        if not filas:
+            break
+        for publicacion_id, datos in filas:
+            ultimo_id = publicacion_id
+            pista = decodificar_pista(datos)
+            guardar_area(cur, publicacion_id, pista.lat, pista.lon)
+            indexadas += 1
+        mysql.connection.commit()
+    cur.close()
+    print(f"Pistas indexadas: {indexadas}")
+
+
+@app.cli.command('migrar-gps')
+@click.option('--lote', default=200, help='Publicaciones por transaccion.')
+def migrar_gps_cmd(lote):
+    """Pasa publicaciones.gps_data (JSON) a pistas_gps (binario)."""
+    cur = mysql.connection.cursor()
+    migradas = 0
+    ultimo_id = 0
+    while True:
+        cur.execute("""
+            SELECT id, gps_data FROM publicaciones
+            WHERE id > %s AND gps_data IS NOT NULL
+            ORDER BY id
+            LIMIT %s
+        """, (ultimo_id, lote))
+        filas = cur.fetchall()
+        if not filas:
+            break
+        for publicacion_id, gps_data in filas:
+            ultimo_id = publicacion_id
+            try:
+                puntos = json.loads(gps_data)
+            except ValueError as e:
+                print(f"Publicacion {publicacion_id}: gps_data ilegible ({e}), se deja como esta")
+                continue
+            if puntos:
+                guardar_pista(cur, publicacion_id, *arrays_desde_puntos_json(puntos))
+            cur.execute("UPDATE publicaciones SET gps_data = NULL WHERE id = %s", (publicacion_id,))
+            migradas += 1
+        mysql.connection.commit()
+    cur.close()
+    print(f"Publicaciones migradas: {migradas}")
+
+
+@app.cli.command('generar-niveles-gps')
+@click.option('--lote', default=200, help='Pistas por transaccion.')
+def generar_niveles_gps_cmd(lote):
+    """Calcula los niveles de detalle de las pistas que aun no los tienen."""
+    cur = mysql.connection.cursor()
+    generadas = 0
+    ultimo_id = 0
+    while True:
+        cur.execute("""
+            SELECT pg.publicacion_fk, pg.datos FROM pistas_gps pg
+            WHERE pg.publicacion_fk > %s
+              AND NOT EXISTS (
+                  SELECT 1 FROM pistas_gps_niveles n WHERE n.publicacion_fk = pg.publicacion_fk
+              )
+            ORDER BY pg.publicacion_fk
+            LIMIT %s
+        """, (ultimo_id, lote))
+        filas = cur.fetchall()
+        if not filas:
+            break
+        for publicacion_id, datos in filas:
+            ultimo_id = publicacion_id
+            guardar_niveles(cur, publicacion_id, *arrays_de_pista(decodificar_pista(datos)))
+            generadas += 1
+        mysql.connection.commit()
+    cur.close()
+    print(f"Pistas procesadas: {generadas}")
+
+
+@app.cli.command('calcular-estadisticas')
+@click.option('--lote', default=200, help='Publicaciones por transaccion.')
+def calcular_estadisticas_cmd(lote):
+    """Calcula las estadisticas de las actividades con GPS que no las tienen."""
+    cur = mysql.connection.cursor()
+    calculadas = 0
+    ultimo_id = 0
+    while True:
+        cur.execute("""
+            SELECT p.id, pg.datos FROM publicaciones p
+            JOIN pistas_gps pg ON pg.publicacion_fk = p.id
+            WHERE p.id > %s AND p.desnivel_positivo IS NULL
+            ORDER BY p.id
+            LIMIT %s
+        """, (ultimo_id, lote))
+        filas = cur.fetchall()
+        if not filas:
+            break
+        for publicacion_id, datos in filas:
+            ultimo_id = publicacion_id
+            estadisticas = columnas_estadisticas(
+                calcular_estadisticas(*arrays_de_pista(decodificar_pista(datos)))
+            )
+            asignaciones = ', '.join(f"{columna} = %s" for columna in estadisticas)
+            cur.execute(f"UPDATE publicaciones SET {asignaciones} WHERE id = %s",
+                        (*estadisticas.values(), publicacion_id))
+            calculadas += 1
+        mysql.connection.commit()
+    cur.close()
+    print(f"Actividades calculadas: {calculadas}")
+
+
+
+@app.route('/publicacion/<int:publicacion_id>/comentarios', methods=['GET'])
+@token_required
+def obtener_comentarios(publicacion_id):
+    try:
+        cur = mysql.connection.cursor()
+        cur.execute("""
+            SELECT c.contenido, u.nombre_usuario, u.id AS id_usuario
+            FROM comentarios c
+            JOIN usuarios u ON c.id_usuario = u.id
+            WHERE c.id_publicacion = %s
+            ORDER BY c.id_comentario ASC
+        """, (publicacion_id,))
+        resultados = cur.fetchall()
+        cur.close()
+
+        comentarios = [
+            {
+                'usuario': fila[1],
+                'contenido': fila[0],
+                'id_usuario': fila[2]
+            }
+            for fila in resultados
+        ]
+        return jsonify(comentarios), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
 
 
 # ----------------------
-# API: DAR LIKE
-# ----------------------
+# API: DAR LIKE
+# ----------------------
 @app.route('/publicacion/<int:publicacion_id>/like', methods=['POST'])
 @token_required
 def dar_like(publicacion_id):
@@ -692,8 +1656,12 @@ def dar_like(publicacion_id):
             INSERT IGNORE INTO me_gustas (id_publicacion, id_usuario)
             VALUES (%s, %s)
         """, (publicacion_id, user_id))
+        nuevo = cur.rowcount == 1
         mysql.connection.commit()
         cur.close()
+        if nuevo:
+            contadores.sumar(publicacion_id, likes=1)
+            cache_respuestas.invalidar(('publicacion', publicacion_id))
         return jsonify({'mensaje': 'Like registrado'}), 201
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -711,8 +1679,12 @@ def quitar_like(publicacion_id):
         cur.execute("""
             DELETE FROM me_gustas WHERE id_publicacion = %s AND id_usuario = %s
         """, (publicacion_id, user_id))
+        quitado = cur.rowcount == 1
         mysql.connection.commit()
         cur.close()
+        if quitado:
+            contadores.sumar(publicacion_id, likes=-1)
+            cache_respuestas.invalidar(('publicacion', publicacion_id))
         return jsonify({'mensaje': 'Like eliminado'}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -729,8 +1701,10 @@ def obtener_publicacion(publicacion_id):
 
         # Obtener publicacion
         cur.execute("""
-            SELECT p.id, p.descripcion, p.fecha, p.gps_data, p.tiene_gps,
-                   u.nombre_usuario, p.duracion
+            SELECT p.id, p.descripcion, p.fecha, p.tiene_gps,
+                   u.nombre_usuario, p.duracion, p.total_likes, p.total_comentarios,
+                   p.distancia, p.tiempo_movimiento, p.desnivel_positivo, p.desnivel_negativo,
+                   p.velocidad_max, p.velocidad_media, p.parciales_km
             FROM publicaciones p
             JOIN usuarios u ON p.usuario_id = u.id
             WHERE p.id = %s
@@ -740,15 +1714,8 @@ def obtener_publicacion(publicacion_id):
             return jsonify({'mensaje': 'Publicación no encontrada'}), 404
 
         # Justo después de recuperar la publicacion
-        duracion = publicacion.get('duracion')
-        if isinstance(duracion, datetime.timedelta):
-            total_seconds = int(duracion.total_seconds())
-            hours = total_seconds // 3600
-            minutes = (total_seconds % 3600) // 60
-            seconds = total_seconds % 60
-            publicacion['duracion'] = f"{hours:02}:{minutes:02}:{seconds:02}"
-        else:
-            publicacion['duracion'] = str(duracion)
+        publicacion['duracion'] = formatear_duracion(publicacion.get('duracion'))
+        formatear_estadisticas(publicacion)
 
         # Obtener imágenes
         cur.execute("""
@@ -770,9 +1737,10 @@ def obtener_publicacion(publicacion_id):
         """, (publicacion_id,))
         publicacion['comentarios'] = cur.fetchall()
 
-        # Contar likes
-        cur.execute("SELECT COUNT(*) AS total_likes FROM me_gustas WHERE id_publicacion = %s", (publicacion_id,))
-        publicacion['me_gustas'] = cur.fetchone()['total_likes']
+        # Contadores desnormalizados + incrementos aun sin volcar
+        likes_pendientes, comentarios_pendientes = contadores.pendientes(publicacion_id)
+        publicacion['me_gustas'] = publicacion.pop('total_likes') + likes_pendientes
+        publicacion['total_comentarios'] += comentarios_pendientes
 
         cur.execute("""SELECT 1 FROM me_gustas WHERE id_publicacion = %s AND id_usuario = %s
         """, (publicacion_id, user_id))
@@ -789,61 +1757,121 @@ def obtener_publicacion(publicacion_id):
 # ----------------------
 # API: LISTAR PUBLICACIONES DE AMIGOS + PROPIAS
 # ----------------------
+FEED_LIMITE_POR_DEFECTO = 20
+FEED_LIMITE_MAXIMO = 100
+
+
+def formatear_duracion(duracion):
+    # MySQLdb devuelve las columnas TIME como timedelta
+    if isinstance(duracion, timedelta):
+        total_seconds = int(duracion.total_seconds())
+        hours = total_seconds // 3600
+        minutes = (total_seconds % 3600) // 60
+        seconds = total_seconds % 60
+        return f"{hours:02}:{minutes:02}:{seconds:02}"
+    return str(duracion)
+
+
+def hidratar_publicaciones(cur, publicaciones, user_id):
+    """
+    Añade imagenes y el like del usuario a una pagina de publicaciones con
+    un numero fijo de consultas (no una por fila).
+    """
+    if not publicaciones:
+        return publicaciones
+
+    ids = [pub['id'] for pub in publicaciones]
+    formato_in = ','.join(['%s'] * len(ids))
+
+    imagenes = {pub_id: [] for pub_id in ids}
+    cur.execute(f"""
+        SELECT id_publicacion, nombre_imagen FROM imagenes
+        WHERE id_publicacion IN ({formato_in})
+        ORDER BY id_imagen
+    """, tuple(ids))
+    for pub_id, nombre in cur.fetchall():
+        imagenes[pub_id].append(nombre)
+
+    cur.execute(f"""
+        SELECT id_publicacion FROM me_gustas
+        WHERE id_usuario = %s AND id_publicacion IN ({formato_in})
+    """, (user_id, *ids))
+    con_like = {row[0] for row in cur.fetchall()}
+
+    for pub in publicaciones:
+        pub['imagenes'] = imagenes[pub['id']]
+        likes_pendientes, comentarios_pendientes = contadores.pendientes(pub['id'])
+        pub['total_likes'] += likes_pendientes
+        pub['total_comentarios'] += comentarios_pendientes
+        pub['me_gusta_usuario'] = pub['id'] in con_like
+
+    return publicaciones
+
+
 @app.route('/publicaciones', methods=['GET'])
 @token_required
+@respuesta_cacheada
 def listar_publicaciones_amigos():
+    """
+    Feed paginado por cursor (fecha, id). El cursor de la siguiente pagina
+    se devuelve en la cabecera X-Siguiente-Cursor (vacia si no hay mas).
+    """
     user_id = request.user['user_id']
+    limite = leer_limite(request.args.get('limite'), FEED_LIMITE_POR_DEFECTO, FEED_LIMITE_MAXIMO)
+
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            cursor_fecha, cursor_id = decodificar_cursor(cursor)
+        except ValueError:
+            return jsonify({'mensaje': 'Cursor inválido'}), 400
 
     try:
         cur = mysql.connection.cursor()
 
-        # Obtener IDs de amigos aceptados + el usuario actual
-        cur.execute("""
-            SELECT amigo_fk FROM amigos WHERE usuario_fk = %s AND estado = 'aceptado'
-            UNION
-            SELECT usuario_fk FROM amigos WHERE amigo_fk = %s AND estado = 'aceptado'
-        """, (user_id, user_id))
-        amigos = [row[0] for row in cur.fetchall()]
-        amigos.append(user_id)
-
-        # Obtener publicaciones (sin formato en query)
-        formato_in = ','.join(['%s'] * len(amigos))
-        query = f"""
-    SELECT p.id, p.descripcion, p.fecha, p.duracion, p.usuario_id AS id_usuario,
-           u.nombre_usuario, u.foto_perfil,
-           (SELECT COUNT(*) FROM me_gustas WHERE id_publicacion = p.id) AS total_likes,
-           p.tiene_gps
-    FROM publicaciones p
-    JOIN usuarios u ON p.usuario_id = u.id
-    WHERE p.usuario_id IN ({formato_in})
-    ORDER BY p.fecha DESC
-"""
-        cur.execute(query, tuple(amigos))
-        resultados = cur.fetchall()
+        # La linea de tiempo ya contiene las publicaciones propias y de amigos
+        params = [user_id]
+        filtro_cursor = ''
+        if cursor:
+            filtro_cursor = "AND (lt.fecha < %s OR (lt.fecha = %s AND lt.publicacion_fk < %s))"
+            params += [cursor_fecha, cursor_fecha, cursor_id]
+        # Pedimos una fila de mas para saber si hay otra pagina
+        params.append(limite + 1)
+
+        cur.execute(f"""
+            SELECT p.id, p.descripcion, p.fecha, p.duracion, p.usuario_id AS id_usuario,
+                   u.nombre_usuario, u.foto_perfil, p.tiene_gps,
+                   p.total_likes, p.total_comentarios,
+                   p.distancia, p.tiempo_movimiento, p.desnivel_positivo, p.velocidad_media
+            FROM linea_tiempo lt
+            JOIN publicaciones p ON p.id = lt.publicacion_fk
+            JOIN usuarios u ON p.usuario_id = u.id
+            WHERE lt.usuario_fk = %s
+            {filtro_cursor}
+            ORDER BY lt.fecha DESC, lt.publicacion_fk DESC
+            LIMIT %s
+        """, tuple(params))
         columnas = [col[0] for col in cur.description]
-        publicaciones = [dict(zip(columnas, row)) for row in resultados]
+        publicaciones = [dict(zip(columnas, row)) for row in cur.fetchall()]
+
+        siguiente_cursor = ''
+        if len(publicaciones) > limite:
+            publicaciones = publicaciones[:limite]
+            ultima = publicaciones[-1]
+            siguiente_cursor = codificar_cursor(ultima['fecha'], ultima['id'])
 
         for pub in publicaciones:
-            # Convertir timedelta a string si aplica
-            duracion = pub['duracion']
-            if isinstance(duracion, timedelta):
-                total_seconds = int(duracion.total_seconds())
-                hours = total_seconds // 3600
-                minutes = (total_seconds % 3600) // 60
-                seconds = total_seconds % 60
-                pub['duracion'] = f"{hours:02}:{minutes:02}:{seconds:02}"
-            else:
-                pub['duracion'] = str(duracion)
-
-            cur.execute("SELECT nombre_imagen FROM imagenes WHERE id_publicacion = %s", (pub['id'],))
-            imagenes = [row[0] for row in cur.fetchall()]
-            pub['imagenes'] = imagenes
-
-            cur.execute("SELECT 1 FROM me_gustas WHERE id_publicacion = %s AND id_usuario = %s", (pub['id'], user_id))
-            pub['me_gusta_usuario'] = bool(cur.fetchone())
+            pub['duracion'] = formatear_duracion(pub['duracion'])
+            formatear_estadisticas(pub)
 
+        hidratar_publicaciones(cur, publicaciones, user_id)
         cur.close()
-        return jsonify(publicaciones), 200
+
+        g.etiquetas_cache = {('feed', user_id)} | {('publicacion', pub['id']) for pub in publicaciones}
+
+        respuesta = jsonify(publicaciones)
+        respuesta.headers['X-Siguiente-Cursor'] = siguiente_cursor
+        return respuesta, 200
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -852,29 +1880,96 @@ def listar_publicaciones_amigos():
 @token_required
 def son_amigos(id1, id2):
     try:
-        cur = mysql.connection.cursor()
-        cur.execute("""
-            SELECT 1 FROM amigos
-            WHERE (
-                (usuario_fk = %s AND amigo_fk = %s) OR 
-                (usuario_fk = %s AND amigo_fk = %s)
-            )
-            AND estado = 'aceptado'
-            LIMIT 1
-        """, (id1, id2, id2, id1))
-        
-        resultado = cur.fetchone()
-        cur.close()
-
-        if resultado:
-            return jsonify({'son_amigos': True}), 200
-        else:
-            return jsonify({'son_amigos': False}), 200
+        return jsonify({'son_amigos': grafo_amigos.son_amigos(id1, id2)}), 200
     except Exception as e:
         print(f"Error al verificar amistad: {e}")
         return jsonify({'mensaje': 'Error al verificar amistad'}), 500
 
 
+# ----------------------
+# API: CHAT EN TIEMPO REAL
+# ----------------------
+# Conexiones SSE abiertas en este proceso. El servidor tiene que poder
+# mantener muchas peticiones abiertas: hilos (app.run, gunicorn --threads)
+# o un worker asincrono (gunicorn -k gevent)
+canales = CanalesUsuarios()
+EVENTOS_LATIDO = 15  # segundos
+EVENTOS_MAX_RECUPERADOS = 500
+
+
+CHAT_LIMITE_POR_DEFECTO = 50
+CHAT_LIMITE_MAXIMO = 200
+
+# mensajes esta particionada por mes. Las lecturas normales solo tocan los
+# ultimos meses; los mas antiguos se mueven a mensajes_archivo
+MENSAJES_MESES_CALIENTES = 6
+MENSAJES_MESES_ARCHIVO = 12
+MENSAJES_MESES_ADELANTADOS = 3
+# fecha_envio es el NOW() del INSERT, tomado al empezar la sentencia, y el
+# id se asigna despues: un INSERT que espera un bloqueo puede quedar con un
+# id mayor y una fecha anterior a la de otro envio. La espera no pasa de
+# innodb_lock_wait_timeout (50 s por defecto), asi que al contar los no
+# leidos desde la fecha de un mensaje se mira tambien el minuto anterior
+MARGEN_ORDEN_MENSAJES = datetime.timedelta(minutes=1)
+COLUMNAS_MENSAJE = ('id', 'emisor_fk', 'receptor_fk', 'usuario_menor', 'usuario_mayor',
+                    'mensaje', 'fecha_envio')
+
+
+def corte_mensajes_calientes():
+    """
+    Primer dia del mes mas antiguo que se lee sin pedir el historial.
+    """
+    return sumar_meses(inicio_mes(datetime.datetime.now()), 1 - MENSAJES_MESES_CALIENTES)
+
+
+def mensaje_evento(fila):
+    mensaje_id, emisor_id, receptor_id, mensaje, fecha_envio, leido = fila
+    return {
+        'id': mensaje_id,
+        'emisor_id': emisor_id,
+        'receptor_id': receptor_id,
+        'mensaje': mensaje,
+        'fecha_envio': fecha_envio.strftime("%Y-%m-%d %H:%M:%S"),
+        'leido': bool(leido)
+    }
+
+
+@app.route('/eventos', methods=['GET'])
+@token_required
+def eventos():
+    """
+    Canal Server-Sent Events del usuario: un evento 'mensaje' por cada
+    mensaje que envia o recibe. Al reconectar con la cabecera Last-Event-ID
+    (o ?desde=<id>) se reenvian los mensajes perdidos entre medias.
+    """
+    user_id = request.user['user_id']
+    # Primero la suscripcion: lo que llegue durante la consulta no se pierde
+    cola = canales.suscribir(user_id)
+
+    iniciales = []
+    desde = request.headers.get('Last-Event-ID') or request.args.get('desde')
+    if desde and desde.isdigit():
+        cur = mysql.connection.cursor()
+        cur.execute(f"""
+            SELECT m.id, m.emisor_fk, m.receptor_fk, m.mensaje, m.fecha_envio, {LEIDO_MENSAJE}
+            FROM mensajes m
+            {JOIN_LECTURA_RECEPTOR}
+            WHERE (m.emisor_fk = %s OR m.receptor_fk = %s) AND m.id > %s
+              AND m.fecha_envio >= %s
+            ORDER BY m.id
+            LIMIT %s
+        """, (user_id, user_id, int(desde), corte_mensajes_calientes(), EVENTOS_MAX_RECUPERADOS))
+        iniciales = [formatear_evento('mensaje', mensaje_evento(fila), fila[0]) for fila in cur.fetchall()]
+        cur.close()
+
+    respuesta = Response(flujo_eventos(canales, user_id, cola, iniciales, EVENTOS_LATIDO),
+                         mimetype='text/event-stream')
+    respuesta.headers['Cache-Control'] = 'no-cache'
+    # Que nginx no acumule el flujo
+    respuesta.headers['X-Accel-Buffering'] = 'no'
+    return respuesta
+
+
 @app.route('/enviar_mensaje', methods=['POST'])
 @token_required
 def enviar_mensaje():
@@ -889,13 +1984,25 @@ def enviar_mensaje():
     try:
         cur = mysql.connection.cursor()
         cur.execute("""
-            INSERT INTO mensajes (emisor_fk, receptor_fk, mensaje, fecha_envio)
-            VALUES (%s, %s, %s, NOW())
-        """, (emisor_fk, receptor_fk, mensaje))
+            INSERT INTO mensajes (emisor_fk, receptor_fk, usuario_menor, usuario_mayor, mensaje, fecha_envio)
+            VALUES (%s, %s, %s, %s, %s, NOW())
+        """, (emisor_fk, receptor_fk, *par_usuarios(emisor_fk, receptor_fk), mensaje))
+        mensaje_id = cur.lastrowid
+        cur.execute("""
+            SELECT id, emisor_fk, receptor_fk, mensaje, fecha_envio, FALSE
+            FROM mensajes WHERE id = %s
+        """, (mensaje_id,))
+        fila = cur.fetchone()
+        actualizar_conversaciones(cur, fila)
 
         mysql.connection.commit()
         cur.close()
-        return jsonify({'mensaje': 'Mensaje enviado correctamente'}), 201
+
+        # Al receptor y a las otras sesiones del emisor
+        evento = mensaje_evento(fila)
+        canales.publicar(int(receptor_fk), 'mensaje', evento, mensaje_id)
+        canales.publicar(int(emisor_fk), 'mensaje', evento, mensaje_id)
+        return jsonify({'mensaje': 'Mensaje enviado correctamente', 'id': mensaje_id}), 201
 
     except Exception as e:
         print(f"Error al enviar el mensaje: {e}")
@@ -904,16 +2011,60 @@ def enviar_mensaje():
 @app.route('/obtener_conversacion', methods=['POST'])
 @token_required
 def obtener_conversacion():
+    """
+    Pagina de un chat en orden cronologico: los `limite` mensajes mas
+    recientes o, con `antes_id`, los anteriores a ese mensaje. El antes_id
+    de la pagina previa va en la cabecera X-Siguiente-Cursor (vacia si no
+    hay mas).
+
+    Solo se leen los ultimos MENSAJES_MESES_CALIENTES meses; con
+    `historial` se buscan tambien los anteriores y el archivo.
+    """
     data = request.get_json()
     usuario_id = data.get('usuario_id')
     amigo_id = data.get('amigo_id')
+    antes_id = data.get('antes_id')
+    historial = bool(data.get('historial'))
+    limite = leer_limite(data.get('limite'), CHAT_LIMITE_POR_DEFECTO, CHAT_LIMITE_MAXIMO)
 
     if not usuario_id or not amigo_id:
         return jsonify([]), 200 
 
     try:
+        menor, mayor = par_usuarios(usuario_id, amigo_id)
+        tablas = ('mensajes', 'mensajes_archivo') if historial else ('mensajes',)
         cur = mysql.connection.cursor()
-        cur.execute("""
+
+        filtros = ''
+        params_filtros = []
+        if not historial:
+            # Con la fecha MySQL descarta las particiones antiguas
+            filtros += " AND fecha_envio >= %s"
+            params_filtros.append(corte_mensajes_calientes())
+        if antes_id:
+            cur.execute(" UNION ALL ".join(f"""
+                SELECT fecha_envio FROM {tabla}
+                WHERE id = %s AND usuario_menor = %s AND usuario_mayor = %s
+            """ for tabla in tablas), (antes_id, menor, mayor) * len(tablas))
+            anterior = cur.fetchone()
+            if anterior is None:
+                cur.close()
+                return jsonify({'mensaje': 'Cursor inválido'}), 400
+            filtros += " AND (fecha_envio < %s OR (fecha_envio = %s AND id < %s))"
+            params_filtros += [anterior[0], anterior[0], antes_id]
+
+        # Cada tabla se recorre por su indice de conversacion hacia atras
+        # desde el cursor; despues se mezclan
+        paginas = " UNION ALL ".join(f"""
+            (SELECT id, emisor_fk, receptor_fk, mensaje, fecha_envio FROM {tabla}
+             WHERE usuario_menor = %s AND usuario_mayor = %s {filtros}
+             ORDER BY fecha_envio DESC, id DESC
+             LIMIT %s)
+        """ for tabla in tablas)
+        params = [menor, mayor, *params_filtros, limite + 1] * len(tablas)
+        params.append(limite + 1)
+
+        cur.execute(f"""
             SELECT 
                 m.id, 
                 m.emisor_fk AS emisor_id, 
@@ -924,28 +2075,38 @@ def obtener_conversacion():
                 u2.foto_perfil AS receptor_foto,
                 m.mensaje, 
                 m.fecha_envio, 
-                m.leido
-            FROM mensajes m
+                {LEIDO_MENSAJE} AS leido
+            FROM ({paginas}) m
             JOIN usuarios u1 ON u1.id = m.emisor_fk
             JOIN usuarios u2 ON u2.id = m.receptor_fk
-            WHERE (m.emisor_fk = %s AND m.receptor_fk = %s) 
-               OR (m.emisor_fk = %s AND m.receptor_fk = %s)
-            ORDER BY m.fecha_envio ASC
-        """, (usuario_id, amigo_id, amigo_id, usuario_id))
+            {JOIN_LECTURA_RECEPTOR}
+            ORDER BY m.fecha_envio DESC, m.id DESC
+            LIMIT %s
+        """, params)
 
         mensajes = cur.fetchall()
         columnas = [desc[0] for desc in cur.description]
-        resultado = [dict(zip(columnas, fila)) for fila in mensajes]
-
         cur.close()
 
-        return jsonify(resultado if resultado else []), 200
+        hay_mas = len(mensajes) > limite
+        mensajes = mensajes[:limite]
+        resultado = [dict(zip(columnas, fila)) for fila in reversed(mensajes)]
+
+        respuesta = jsonify(resultado)
+        respuesta.headers['X-Siguiente-Cursor'] = str(resultado[0]['id']) if hay_mas else ''
+        return respuesta, 200
     except Exception as e:
+        print(f"Error al obtener la conversacion: {e}")
         return jsonify([]), 500
 
 @app.route('/obtener_mensajes', methods=['POST'])
 @token_required
 def obtener_mensajes():
+    """
+    Ultimo mensaje de cada conversacion del usuario, de la mas reciente a
+    la mas antigua, leido de la tabla conversaciones. Para paginar usar
+    GET /conversaciones.
+    """
     data = request.get_json()
     user_id = data.get('usuario_id')
 
@@ -954,60 +2115,27 @@ def obtener_mensajes():
 
     try:
         cur = mysql.connection.cursor()
-
-        #Ejecutamos la consulta optimizada
-        cur.execute("""
-            SELECT 
-                m.id, 
-                m.emisor_fk, 
-                u1.nombre_usuario AS emisor_nombre, 
-                u1.foto_perfil AS emisor_foto,
-                m.receptor_fk, 
-                u2.nombre_usuario AS receptor_nombre, 
-                u2.foto_perfil AS receptor_foto,
-                m.mensaje, 
-                m.fecha_envio, 
-                m.leido
-            FROM 
-                mensajes m
-            JOIN 
-                usuarios u1 ON u1.id = m.emisor_fk
-            JOIN 
-                usuarios u2 ON u2.id = m.receptor_fk
-            WHERE 
-                m.emisor_fk = %s OR m.receptor_fk = %s
-            ORDER BY 
-                m.fecha_envio DESC
-        """, (user_id, user_id))
-
-        # Transformamos directamente en el formato que quieres
-        mensajes = [{
-            'id': msg[0],
-            'emisor_id': msg[1],
-            'emisor_nombre': msg[2],
-            'emisor_foto': msg[3] if msg[3] else 'default.png',  # Valor por defecto si vacio
-            'receptor_id': msg[4],
-            'receptor_nombre': msg[5],
-            'receptor_foto': msg[6] if msg[6] else 'default.png',  # Valor por defecto si vacio
-            'mensaje': msg[7],
-            'fecha_envio': msg[8].strftime("%Y-%m-%d %H:%M:%S"),
-            'leido': bool(msg[9])
-        } for msg in cur.fetchall()]
-
+        cur.execute(f"""
+            {CONSULTA_CONVERSACIONES}
+            WHERE c.usuario_fk = %s
+            ORDER BY c.ultima_fecha DESC, c.otro_fk DESC
+        """, (user_id,))
+        mensajes = [conversacion_json(fila) for fila in cur.fetchall()]
         cur.close()
 
-        print(f"Conversaciones abiertas: {mensajes}")
         return jsonify(mensajes), 200
     except Exception as e:
         print(f"Error al obtener los mensajes: {e}")
         return jsonify({'mensaje': 'Error al obtener los mensajes'}), 500
 
 
-
-
 @app.route('/marcar_leido', methods=['POST'])
 @token_required
 def marcar_leido():
+    """
+    Compatibilidad: marca como leido el mensaje y todos los anteriores de
+    la misma conversacion (avanza la marca de lectura del receptor).
+    """
     data = request.get_json()
     mensaje_id = data.get('mensaje_id')
 
@@ -1016,30 +2144,305 @@ def marcar_leido():
 
     try:
         cur = mysql.connection.cursor()
-        cur.execute("""
-            UPDATE mensajes 
-            SET leido = TRUE 
-            WHERE id = %s
-        """, (mensaje_id,))
+        cur.execute("SELECT receptor_fk, emisor_fk FROM mensajes WHERE id = %s", (mensaje_id,))
+        fila = cur.fetchone()
+        if fila is None:
+            cur.close()
+            return jsonify({'mensaje': 'Mensaje no encontrado'}), 404
+
+        receptor_id, emisor_id = fila
+        lectura = avanzar_lectura(cur, receptor_id, emisor_id, mensaje_id)
         mysql.connection.commit()
         cur.close()
+        publicar_lectura(receptor_id, emisor_id, lectura)
         return jsonify({'mensaje': 'Mensaje marcado como leído'}), 200
     except Exception as e:
         print(f"Error al marcar como leído: {e}")
         return jsonify({'mensaje': 'Error al marcar como leído'}), 500
 
 
+@app.cli.command('particionar-mensajes')
+@click.option('--meses', default=MENSAJES_MESES_ADELANTADOS, help='Meses por delante a preparar.')
+def particionar_mensajes_cmd(meses):
+    """Crea las particiones mensuales de mensajes de los proximos meses."""
+    cur = mysql.connection.cursor()
+    creadas = crear_particiones(cur, 'mensajes', sumar_meses(datetime.datetime.now(), meses))
+    cur.close()
+    print(f"Particiones creadas: {', '.join(creadas) if creadas else 'ninguna'}")
+
+
+@app.cli.command('archivar-mensajes')
+@click.option('--meses', default=MENSAJES_MESES_ARCHIVO, help='Meses que se quedan en mensajes.')
+def archivar_mensajes_cmd(meses):
+    """Mueve a mensajes_archivo las particiones de mensajes mas antiguas."""
+    if meses < MENSAJES_MESES_CALIENTES:
+        print(f"Hay que conservar al menos {MENSAJES_MESES_CALIENTES} meses")
+        return
+    corte = sumar_meses(inicio_mes(datetime.datetime.now()), 1 - meses)
+    cur = mysql.connection.cursor()
+    archivadas = archivar_particiones(cur, 'mensajes', 'mensajes_archivo', COLUMNAS_MENSAJE, corte)
+    mysql.connection.commit()
+    cur.close()
+    for particion, filas in archivadas:
+        print(f"{particion}: {filas} mensajes archivados")
+    print(f"Particiones archivadas: {len(archivadas)}")
+
+
+# ----------------------
+# BANDEJA DE ENTRADA
+# ----------------------
+# Una fila por usuario y conversacion (tabla conversaciones) con el ultimo
+# mensaje y los no leidos: abrir la bandeja no recorre todos los mensajes
+CONVERSACIONES_LIMITE_POR_DEFECTO = 30
+CONVERSACIONES_LIMITE_MAXIMO = 100
+VISTA_PREVIA_MENSAJE = 255  # caracteres
+
+# Lo leido se guarda como una marca por conversacion (conversaciones.leido_hasta:
+# id del ultimo mensaje leido del otro usuario); un mensaje esta leido si su id
+# no pasa de la marca de su receptor
+JOIN_LECTURA_RECEPTOR = """
+    LEFT JOIN conversaciones lr ON lr.usuario_fk = m.receptor_fk AND lr.otro_fk = m.emisor_fk
+"""
+LEIDO_MENSAJE = "m.id <= COALESCE(lr.leido_hasta, 0)"
+
+
+def actualizar_conversaciones(cur, fila):
+    """
+    Lleva el mensaje recien insertado al resumen de la conversacion en los
+    dos sentidos y suma un no leido al receptor. Si dos envios se cruzan,
+    el resumen se queda con el mensaje de id mayor.
+    """
+    mensaje_id, emisor_id, receptor_id, mensaje, fecha_envio, _ = fila
+    vista_previa = mensaje[:VISTA_PREVIA_MENSAJE]
+    # ultimo_mensaje_id se asigna el ultimo: las condiciones anteriores lo
+    # comparan con el valor que tenia la fila
+    cur.execute("""
+        INSERT INTO conversaciones (usuario_fk, otro_fk, ultimo_mensaje_id, ultimo_emisor_fk,
+                                    ultimo_mensaje, ultima_fecha, no_leidos)
+        VALUES (%s, %s, %s, %s, %s, %s, 0), (%s, %s, %s, %s, %s, %s, 1)
+        ON DUPLICATE KEY UPDATE
+            no_leidos = no_leidos + VALUES(no_leidos),
+            ultimo_emisor_fk = IF(VALUES(ultimo_mensaje_id) > ultimo_mensaje_id,
+                                  VALUES(ultimo_emisor_fk), ultimo_emisor_fk),
+            ultimo_mensaje = IF(VALUES(ultimo_mensaje_id) > ultimo_mensaje_id,
+                                VALUES(ultimo_mensaje), ultimo_mensaje),
+            ultima_fecha = IF(VALUES(ultimo_mensaje_id) > ultimo_mensaje_id,
+                              VALUES(ultima_fecha), ultima_fecha),
+            ultimo_mensaje_id = GREATEST(ultimo_mensaje_id, VALUES(ultimo_mensaje_id))
+    """, (emisor_id, receptor_id, mensaje_id, emisor_id, vista_previa, fecha_envio,
+          receptor_id, emisor_id, mensaje_id, emisor_id, vista_previa, fecha_envio))
+
+
+def avanzar_lectura(cur, usuario_id, otro_id, hasta_id=None):
+    """
+    Marca como leido lo que `otro_id` ha enviado a `usuario_id` hasta el
+    mensaje `hasta_id` (o hasta el ultimo). La marca nunca retrocede.
+    Devuelve (leido_hasta, no_leidos) o None si no hay conversacion.
+    """
+    cur.execute("""
+        SELECT leido_hasta, ultimo_mensaje_id, no_leidos FROM conversaciones
+        WHERE usuario_fk = %s AND otro_fk = %s
+        FOR UPDATE
+    """, (usuario_id, otro_id))
+    fila = cur.fetchone()
+    if fila is None:
+        return None
+    leido_hasta, ultimo_id, no_leidos = fila
+    nuevo = marca_lectura(leido_hasta, ultimo_id, hasta_id)
+    if nuevo == leido_hasta:
+        return leido_hasta, no_leidos
+
+    no_leidos = 0
+    if nuevo < ultimo_id:
+        # Lo posterior a la marca se envio despues que el mensaje de la
+        # marca: solo hace falta mirar las particiones desde su fecha
+        cur.execute("SELECT fecha_envio FROM mensajes WHERE id = %s", (nuevo,))
+        fila = cur.fetchone()
+        desde = fila[0] - MARGEN_ORDEN_MENSAJES if fila else corte_mensajes_calientes()
+        menor, mayor = par_usuarios(usuario_id, otro_id)
+        cur.execute("""
+            SELECT COUNT(*) FROM mensajes
+            WHERE usuario_menor = %s AND usuario_mayor = %s
+              AND fecha_envio >= %s AND emisor_fk = %s AND id > %s
+        """, (menor, mayor, desde, otro_id, nuevo))
+        no_leidos = cur.fetchone()[0]
+
+    cur.execute("""
+        UPDATE conversaciones SET leido_hasta = %s, no_leidos = %s
+        WHERE usuario_fk = %s AND otro_fk = %s
+    """, (nuevo, no_leidos, usuario_id, otro_id))
+    return nuevo, no_leidos
+
+
+def publicar_lectura(usuario_id, otro_id, lectura):
+    """
+    Avisa por SSE al otro usuario (para sus confirmaciones de lectura) y a
+    las demas sesiones del que lee (para el contador de no leidos). Sin id:
+    Last-Event-ID solo sigue a los mensajes.
+    """
+    if lectura is None:
+        return
+    evento = {
+        'usuario_id': int(usuario_id),
+        'otro_id': int(otro_id),
+        'leido_hasta': lectura[0],
+        'no_leidos': lectura[1]
+    }
+    canales.publicar(int(otro_id), 'leido', evento)
+    canales.publicar(int(usuario_id), 'leido', evento)
+
+
+CONSULTA_CONVERSACIONES = """
+    SELECT c.ultimo_mensaje_id, c.ultimo_emisor_fk, c.usuario_fk, u.nombre_usuario, u.foto_perfil,
+           c.otro_fk, o.nombre_usuario, o.foto_perfil, c.ultimo_mensaje, c.ultima_fecha,
+           c.no_leidos, c.leido_hasta, r.leido_hasta
+    FROM conversaciones c
+    JOIN usuarios u ON u.id = c.usuario_fk
+    JOIN usuarios o ON o.id = c.otro_fk
+    LEFT JOIN conversaciones r ON r.usuario_fk = c.otro_fk AND r.otro_fk = c.usuario_fk
+"""
+
+
+def conversacion_json(fila):
+    """
+    Resumen de una conversacion con la forma de un mensaje (el ultimo)
+    mas el otro usuario y los no leidos.
+    """
+    (mensaje_id, emisor_id, usuario_id, usuario_nombre, usuario_foto,
+     otro_id, otro_nombre, otro_foto, mensaje, fecha, no_leidos, leido_hasta, leido_hasta_otro) = fila
+    usuario = (usuario_id, usuario_nombre, usuario_foto or 'default.png')
+    otro = (otro_id, otro_nombre, otro_foto or 'default.png')
+    emisor, receptor = (usuario, otro) if emisor_id == usuario_id else (otro, usuario)
+    # El ultimo esta leido si la marca de quien lo recibio llega a el
+    marca = leido_hasta_otro if emisor_id == usuario_id else leido_hasta
+    return {
+        'id': mensaje_id,
+        'emisor_id': emisor[0],
+        'emisor_nombre': emisor[1],
+        'emisor_foto': emisor[2],
+        'receptor_id': receptor[0],
+        'receptor_nombre': receptor[1],
+        'receptor_foto': receptor[2],
+        'mensaje': mensaje,
+        'fecha_envio': fecha.strftime("%Y-%m-%d %H:%M:%S"),
+        'leido': (marca or 0) >= mensaje_id,
+        'otro_id': otro[0],
+        'otro_nombre': otro[1],
+        'otro_foto': otro[2],
+        'no_leidos': no_leidos
+    }
+
+
+@app.route('/conversaciones', methods=['GET'])
+@token_required
+def listar_conversaciones():
+    """
+    Bandeja de entrada paginada por cursor (fecha del ultimo mensaje, otro
+    usuario), de la conversacion mas reciente a la mas antigua. El cursor de
+    la siguiente pagina va en la cabecera X-Siguiente-Cursor.
+    """
+    user_id = request.user['user_id']
+    limite = leer_limite(request.args.get('limite'), CONVERSACIONES_LIMITE_POR_DEFECTO,
+                         CONVERSACIONES_LIMITE_MAXIMO)
+
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            cursor_fecha, cursor_otro = decodificar_cursor(cursor)
+        except ValueError:
+            return jsonify({'mensaje': 'Cursor inválido'}), 400
+
+    try:
+        cur = mysql.connection.cursor()
+        params = [user_id]
+        filtro_cursor = ''
+        if cursor:
+            filtro_cursor = "AND (c.ultima_fecha < %s OR (c.ultima_fecha = %s AND c.otro_fk < %s))"
+            params += [cursor_fecha, cursor_fecha, cursor_otro]
+        params.append(limite + 1)
+
+        cur.execute(f"""
+            {CONSULTA_CONVERSACIONES}
+            WHERE c.usuario_fk = %s {filtro_cursor}
+            ORDER BY c.ultima_fecha DESC, c.otro_fk DESC
+            LIMIT %s
+        """, params)
+        filas = cur.fetchall()
+        cur.close()
+
+        hay_mas = len(filas) > limite
+        filas = filas[:limite]
+        respuesta = jsonify([conversacion_json(fila) for fila in filas])
+        respuesta.headers['X-Siguiente-Cursor'] = (
+            codificar_cursor(filas[-1][9], filas[-1][5]) if hay_mas else ''
+        )
+        return respuesta, 200
+    except Exception as e:
+        print(f"Error al obtener las conversaciones: {e}")
+        return jsonify({'mensaje': 'Error al obtener las conversaciones'}), 500
+
+
+@app.route('/conversaciones/<int:otro_id>/leido', methods=['POST'])
+@token_required
+def marcar_conversacion_leida(otro_id):
+    """
+    Avanza la marca de lectura del usuario en su chat con `otro_id` hasta
+    `hasta_id` (por defecto, el ultimo mensaje). Abrir un chat es una sola
+    llamada aunque tenga cientos de mensajes sin leer.
+    """
+    user_id = request.user['user_id']
+    data = request.get_json(silent=True) or {}
+    hasta_id = data.get('hasta_id')
+
+    if hasta_id is not None and not isinstance(hasta_id, int):
+        return jsonify({'mensaje': 'hasta_id no válido'}), 400
+
+    try:
+        cur = mysql.connection.cursor()
+        lectura = avanzar_lectura(cur, user_id, otro_id, hasta_id)
+        mysql.connection.commit()
+        cur.close()
+
+        if lectura is None:
+            return jsonify({'mensaje': 'Conversación no encontrada'}), 404
+
+        publicar_lectura(user_id, otro_id, lectura)
+        return jsonify({'leido_hasta': lectura[0], 'no_leidos': lectura[1]}), 200
+    except Exception as e:
+        print(f"Error al marcar la conversación como leída: {e}")
+        return jsonify({'mensaje': 'Error al marcar la conversación como leída'}), 500
+
+
 @app.route('/enviar_solicitud', methods=['POST'])
 def enviar_solicitud():
     data = request.json
     usuario_fk = data['usuario_fk']
     amigo_fk = data['amigo_fk']
 
+    menor, mayor = par_usuarios(usuario_fk, amigo_fk)
+    if menor == mayor:
+        return jsonify({'mensaje': 'No puedes enviarte una solicitud a ti mismo'}), 400
+
     cur = mysql.connection.cursor()
-    cur.execute("""
-        INSERT INTO amigos (usuario_fk, amigo_fk, estado)
-        VALUES (%s, %s, 'pendiente')
-    """, (usuario_fk, amigo_fk))
+    try:
+        # Una fila por pareja: la clave unica (usuario_menor, usuario_mayor)
+        # impide repetir la solicitud o cruzarla con la del otro
+        cur.execute("""
+            INSERT INTO amigos (usuario_fk, amigo_fk, usuario_menor, usuario_mayor, estado)
+            VALUES (%s, %s, %s, %s, 'pendiente')
+        """, (usuario_fk, amigo_fk, menor, mayor))
+    except MySQLdb.IntegrityError:
+        mysql.connection.rollback()
+        cur.execute("""
+            SELECT estado FROM amigos WHERE usuario_menor = %s AND usuario_mayor = %s
+        """, (menor, mayor))
+        existente = cur.fetchone()
+        cur.close()
+        if existente is None:
+            return jsonify({'mensaje': 'Usuario no encontrado'}), 404
+        if existente[0] == 'aceptado':
+            return jsonify({'mensaje': 'Ya sois amigos'}), 409
+        return jsonify({'mensaje': 'Ya hay una solicitud pendiente entre vosotros'}), 409
     mysql.connection.commit()
     cur.close()
 
@@ -1057,39 +2460,33 @@ def aceptar_solicitud():
 
     try:
         cur = mysql.connection.cursor()
-        
-        #Buscamos la solicitud pendiente
-        query = """
-            SELECT * FROM amigos 
+
+        # La solicitud la envio amigo_fk. Solo una peticion puede pasarla de
+        # pendiente a aceptada, asi los contadores no se suman dos veces
+        cur.execute("""
+            UPDATE amigos 
+            SET estado = 'aceptado', fecha_aceptacion = NOW() 
             WHERE usuario_fk = %s AND amigo_fk = %s AND estado = 'pendiente'
-        """
-        print(f"📝 Consulta SQL:\n{query}\nParámetros: usuario_fk={amigo_fk}, amigo_fk={usuario_fk}")
-        
-        #Invertimos los params al buscar
-        cur.execute(query, (amigo_fk, usuario_fk))
-        
-        solicitud = cur.fetchone()
-        
-        if solicitud:
-            print(f"✅ Solicitud encontrada: {solicitud}")
-            
-            #Actualizamos el estado 
-            update_query = """
-                UPDATE amigos 
-                SET estado = 'aceptado', fecha_aceptacion = NOW() 
-                WHERE usuario_fk = %s AND amigo_fk = %s
-            """
-            print(f"📝 Actualización SQL:\n{update_query}\nParámetros: usuario_fk={amigo_fk}, amigo_fk={usuario_fk}")
-            
-            # Invertimos tmbn en el UPDATE
-            cur.execute(update_query, (amigo_fk, usuario_fk))
+        """, (amigo_fk, usuario_fk))
+
+        if cur.rowcount == 1:
+            rellenar_linea_tiempo(cur, usuario_fk, amigo_fk)
+            cur.execute("UPDATE usuarios SET num_amigos = num_amigos + 1 WHERE id IN (%s, %s)", (usuario_fk, amigo_fk))
+            cola_trabajos.encolar(
+                cur, 'sugerencias_amistad', {'usuario_id': usuario_fk, 'amigo_id': amigo_fk},
+                clave=f"sugerencias_amistad:{usuario_fk}:{amigo_fk}:{time.time_ns()}", usuario_id=usuario_fk
+            )
             mysql.connection.commit()
             cur.close()
-            print("Solicitud aceptada correctamente.")
+            cola_trabajos.avisar()
+            grafo_amigos.agregar(usuario_fk, amigo_fk)
+            cache_respuestas.invalidar(
+                ('feed', usuario_fk), ('feed', amigo_fk),
+                ('perfil', usuario_fk), ('perfil', amigo_fk)
+            )
             return jsonify({'mensaje': 'Solicitud aceptada correctamente'}), 200
         else:
             cur.close()
-            print("No se encontro la solicitud pendiente para actualizar.")
             return jsonify({'mensaje': 'No se encontró la solicitud pendiente'}), 404
     except Exception as e:
         print(f"Error al aceptar la solicitud: {e}")
@@ -1133,64 +2530,40 @@ def buscar_usuario_por_nombre():
         return jsonify({'mensaje': 'Usuario no encontrado'}), 404
 
 
+def usuarios_por_id(cur, ids):
+    """
+    (id, nombre_usuario, foto_perfil) de cada id, con una sola consulta.
+    """
+    if not ids:
+        return []
+    marcas = ','.join(['%s'] * len(ids))
+    cur.execute(f"""
+        SELECT id, nombre_usuario, foto_perfil FROM usuarios WHERE id IN ({marcas})
+    """, list(ids))
+    return cur.fetchall()
+
+
 @app.route('/amigos_de/<int:usuario_id>', methods=['GET'])
 @token_required
 def amigos_de_usuario(usuario_id):
     current_user_id = request.user['user_id']
     cur = mysql.connection.cursor()
 
-   # Ejecutar consulta
-    cur.execute("""
-        SELECT u.id, u.nombre_usuario, u.foto_perfil
-        FROM amigos a
-        JOIN usuarios u ON u.id = 
-          CASE 
-            WHEN a.usuario_fk = %s THEN a.amigo_fk 
-            ELSE a.usuario_fk 
-        END
-    WHERE (a.usuario_fk = %s OR a.amigo_fk = %s)
-      AND u.id != %s
-      AND a.estado = 'aceptado'
-    """, (usuario_id, usuario_id, usuario_id, usuario_id))
-
-    columns = [col[0] for col in cur.description]
-    amigos = [dict(zip(columns, row)) for row in cur.fetchall()]
-
-
-    # Verificar ellos tmbn son amigos del usuario actual
-    ids_amigos = [amigo['id'] for amigo in amigos]
-    if ids_amigos:
-        format_ids = ','.join(['%s'] * len(ids_amigos))
-        query = f"""
-            SELECT 
-                CASE 
-                    WHEN usuario_fk = %s THEN amigo_fk 
-                    ELSE usuario_fk 
-                END AS id_amigo
-            FROM amigos
-            WHERE estado = 'aceptado'
-              AND (usuario_fk = %s OR amigo_fk = %s)
-              AND (usuario_fk IN ({format_ids}) OR amigo_fk IN ({format_ids}))
-        """
-        params = [current_user_id, current_user_id, current_user_id] + ids_amigos + ids_amigos
-        cur.execute(query, params)
-        rows = cur.fetchall()
-        column_names = [desc[0] for desc in cur.description]
-        amigos_mutuos = {
-            dict(zip(column_names, row))['id_amigo']
-            for row in rows
-        }
-    else:
-        amigos_mutuos = set()
+    ids_amigos = [i for i in grafo_amigos.amigos(usuario_id) if i != usuario_id]
+    amigos = [
+        {'id': fila[0], 'nombre_usuario': fila[1], 'foto_perfil': fila[2]}
+        for fila in usuarios_por_id(cur, ids_amigos)
+    ]
+    cur.close()
 
+    # Cuales son tambien amigos del usuario actual (desde el grafo)
     for amigo in amigos:
-        amigo['es_amigo_actual'] = amigo['id'] in amigos_mutuos
-        amigo['foto_perfil'] = f"{request.host_url}fotos_perfil/{amigo['foto_perfil']}"
+        amigo['es_amigo_actual'] = grafo_amigos.son_amigos(current_user_id, amigo['id'])
+        amigo['foto_perfil'] = f"{request.host_url}fotos_perfil/{amigo['foto_perfil']}?tam=mini"
 
     # primero los que son amigos del usuario actual
     amigos.sort(key=lambda a: not a['es_amigo_actual'])
 
-    cur.close()
     return jsonify(amigos)
 
 
@@ -1201,22 +2574,13 @@ def obtener_amigos():
 
     if not user_id:
         return jsonify({'mensaje': 'Usuario no encontrado'}), 404
+    user_id = leer_id(user_id)
+    if user_id is None:
+        return jsonify({'mensaje': 'user_id no válido'}), 400
 
     try:
         cur = mysql.connection.cursor()
-        
-        # consulta para obtener amigos aceptados
-        cur.execute("""
-            SELECT u.id, u.nombre_usuario, u.foto_perfil 
-            FROM amigos a 
-            JOIN usuarios u ON (
-                (u.id = a.usuario_fk AND a.amigo_fk = %s) OR 
-                (u.id = a.amigo_fk AND a.usuario_fk = %s)
-            )
-            WHERE a.estado = 'aceptado'
-        """, (user_id, user_id))
-        
-        amigos = cur.fetchall()
+        amigos = usuarios_por_id(cur, grafo_amigos.amigos(user_id))
         cur.close()
 
         # formatear la respuesta
@@ -1255,6 +2619,138 @@ def obtener_solicitudes():
     return jsonify(resultado), 200
 
 
+# ----------------------
+# SUGERENCIAS DE AMISTAD
+# ----------------------
+# Amigos de amigos precalculados en sugerencias_amigos: `calcular-sugerencias`
+# las recalcula todas y cada amistad nueva las ajusta en segundo plano
+SUGERENCIAS_POR_USUARIO = 50
+SUGERENCIAS_LIMITE_POR_DEFECTO = 20
+SUGERENCIAS_LIMITE_MAXIMO = 50
+
+
+@cola_trabajos.tarea('sugerencias_amistad')
+def actualizar_sugerencias(cur, carga, trabajo_id):
+    """
+    Suma un amigo en comun a cada par que lo gana con la amistad nueva y
+    quita la sugerencia entre los dos. Las zonas en comun de los pares
+    nuevos se calculan en el siguiente recalculo completo.
+    """
+    usuario_id, amigo_id = int(carga['usuario_id']), int(carga['amigo_id'])
+    cur.executemany("""
+        DELETE FROM sugerencias_amigos WHERE usuario_fk = %s AND candidato_fk = %s
+    """, [(usuario_id, amigo_id), (amigo_id, usuario_id)])
+
+    pares = nuevos_amigos_de_amigos(usuario_id, set(cargar_amigos(usuario_id)),
+                                    amigo_id, set(cargar_amigos(amigo_id)))
+    if pares:
+        cur.executemany("""
+            INSERT INTO sugerencias_amigos (usuario_fk, candidato_fk, amigos_comunes, zonas_comunes, puntuacion)
+            VALUES (%s, %s, 1, 0, %s)
+            ON DUPLICATE KEY UPDATE
+                amigos_comunes = amigos_comunes + 1,
+                puntuacion = puntuacion + VALUES(puntuacion)
+        """, [(usuario, candidato, puntuacion(1, 0)) for usuario, candidato in pares])
+        # Cada usuario conserva solo sus SUGERENCIAS_POR_USUARIO mejores,
+        # con el mismo orden que el recalculo completo
+        cur.executemany("""
+            DELETE s FROM sugerencias_amigos s
+            JOIN (
+                SELECT candidato_fk FROM (
+                    SELECT candidato_fk,
+                           ROW_NUMBER() OVER (ORDER BY puntuacion DESC, candidato_fk) AS posicion
+                    FROM sugerencias_amigos
+                    WHERE usuario_fk = %s
+                ) ranking
+                WHERE posicion > %s
+            ) sobran ON sobran.candidato_fk = s.candidato_fk
+            WHERE s.usuario_fk = %s
+        """, [(usuario, SUGERENCIAS_POR_USUARIO, usuario) for usuario in sorted({u for u, _ in pares})])
+    return None
+
+
+@app.route('/sugerencias_amigos', methods=['GET'])
+@token_required
+def sugerencias_amigos():
+    """
+    Personas que quiza conozca el usuario, por amigos en comun y zonas
+    donde entrenan los dos. Se descartan las que ya son amigos o tienen
+    una solicitud pendiente en cualquier sentido.
+    """
+    user_id = request.user['user_id']
+    limite = leer_limite(request.args.get('limite'), SUGERENCIAS_LIMITE_POR_DEFECTO, SUGERENCIAS_LIMITE_MAXIMO)
+
+    try:
+        cur = mysql.connection.cursor()
+        cur.execute("""
+            SELECT s.candidato_fk, u.nombre_usuario, u.foto_perfil, s.amigos_comunes, s.zonas_comunes
+            FROM sugerencias_amigos s
+            JOIN usuarios u ON u.id = s.candidato_fk
+            WHERE s.usuario_fk = %s
+              AND NOT EXISTS (
+                  SELECT 1 FROM amigos a
+                  WHERE a.usuario_menor = LEAST(s.usuario_fk, s.candidato_fk)
+                    AND a.usuario_mayor = GREATEST(s.usuario_fk, s.candidato_fk)
+              )
+            ORDER BY s.puntuacion DESC, s.candidato_fk
+            LIMIT %s
+        """, (user_id, limite))
+        filas = cur.fetchall()
+        cur.close()
+
+        return jsonify([{
+            'id': fila[0],
+            'nombre': fila[1],
+            'foto': fila[2] if fila[2] else None,
+            'amigos_comunes': fila[3],
+            'zonas_comunes': fila[4]
+        } for fila in filas]), 200
+    except Exception as e:
+        print(f"Error al obtener sugerencias: {e}")
+        return jsonify({'mensaje': 'Error al obtener sugerencias'}), 500
+
+
+@app.cli.command('calcular-sugerencias')
+@click.option('--lote', default=500, help='Usuarios por transaccion.')
+def calcular_sugerencias_cmd(lote):
+    """Recalcula las sugerencias de amistad de todos los usuarios."""
+    cur = mysql.connection.cursor()
+
+    # El grafo completo y las zonas de cada usuario caben en memoria de un
+    # proceso por lotes; asi cada usuario se calcula sin ir a MySQL
+    amigos = {}
+    cur.execute("SELECT usuario_fk, amigo_fk FROM amigos WHERE estado = 'aceptado'")
+    for usuario_id, amigo_id in cur.fetchall():
+        amigos.setdefault(usuario_id, set()).add(amigo_id)
+        amigos.setdefault(amigo_id, set()).add(usuario_id)
+
+    zonas = {}
+    cur.execute("""
+        SELECT DISTINCT usuario_fk, FLOOR(ST_Y(inicio) / %s), FLOOR(ST_X(inicio) / %s)
+        FROM areas_actividad
+    """, (TAM_CELDA_GRADOS, TAM_CELDA_GRADOS))
+    for usuario_id, fila, columna in cur.fetchall():
+        zonas.setdefault(usuario_id, set()).add((int(fila), int(columna)))
+
+    cur.execute("SELECT id FROM usuarios ORDER BY id")
+    usuarios = [fila[0] for fila in cur.fetchall()]
+    total = 0
+    for i, usuario_id in enumerate(usuarios, 1):
+        candidatos = calcular_candidatos(usuario_id, amigos, zonas, SUGERENCIAS_POR_USUARIO)
+        cur.execute("DELETE FROM sugerencias_amigos WHERE usuario_fk = %s", (usuario_id,))
+        if candidatos:
+            cur.executemany("""
+                INSERT INTO sugerencias_amigos (usuario_fk, candidato_fk, amigos_comunes, zonas_comunes, puntuacion)
+                VALUES (%s, %s, %s, %s, %s)
+            """, [(usuario_id, *candidato) for candidato in candidatos])
+        total += len(candidatos)
+        if i % lote == 0:
+            mysql.connection.commit()
+    mysql.connection.commit()
+    cur.close()
+    print(f"Sugerencias calculadas: {total} para {len(usuarios)} usuarios")
+
+
 @app.route('/agregar_comida', methods=['POST'])
 @token_required
 def agregar_comida():
@@ -1419,77 +2915,488 @@ def obtener_tmb():
 @app.route('/usuario/foto_perfil', methods=['POST'])
 @token_required
 def actualizar_foto_perfil():
+    """
+    La imagen llega en el formulario (foto_perfil) o subida antes con
+    /subidas (campo clave_subida).
+    """
     user_id = request.user['user_id']
+    clave_subida = request.form.get('clave_subida') or (request.get_json(silent=True) or {}).get('clave_subida')
 
-    if 'foto_perfil' not in request.files:
+    if clave_subida:
+        if not subida_propia(user_id, clave_subida, ALLOWED_EXTENSIONS):
+            return jsonify({'mensaje': 'Subida no encontrada'}), 400
+        pendiente = clave_subida
+    elif 'foto_perfil' not in request.files:
         return jsonify({'mensaje': 'No se ha enviado ninguna imagen'}), 400
+    else:
+        file = request.files['foto_perfil']
+        if not (file and allowed_file(file.filename)):
+            return jsonify({'mensaje': 'Formato de archivo no permitido'}), 400
+        pendiente = clave_pendiente(user_id, os.path.splitext(file.filename)[1])
+        almacenamiento.guardar_flujo(pendiente, file.stream)
 
-    file = request.files['foto_perfil']
+    # Se guardan solo las variantes redimensionadas, nunca el original
+    try:
+        with almacenamiento.archivo_local(pendiente) as temporal:
+            try:
+                filename = almacen_fotos_perfil.preparar(temporal)
+            except ImagenInvalida:
+                return jsonify({'mensaje': 'La imagen no es válida'}), 400
+
+            # Guardar en la bd el hash de la imagen
+            cur = mysql.connection.cursor()
+            cur.execute("SELECT foto_perfil FROM usuarios WHERE id = %s FOR UPDATE", (user_id,))
+            anterior = cur.fetchone()[0]
+            cur.execute("""
+                UPDATE usuarios SET foto_perfil = %s WHERE id = %s
+            """, (filename, user_id))
+            almacen_fotos_perfil.referenciar(cur, filename, temporal)
+            huerfanas = almacen_fotos_perfil.liberar(cur, [anterior])
+            consumir_subidas(cur, [clave_subida])
+            mysql.connection.commit()
+            cur.close()
+    finally:
+        almacenamiento.borrar(pendiente)
+    recoger_imagenes(almacen_fotos_perfil, huerfanas)
+    cache_respuestas.invalidar(('perfil', user_id))
 
-    if file and allowed_file(file.filename):
-        # Generar un nombre seguro para el archivo con un timestamp
-        filename = secure_filename(f"{user_id}_{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}.png")
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        
-        # Guardar el archivo en el directorio 
-        file.save(filepath)
+    # Devolver el nombre del archivo actualizado
+    return jsonify({
+        'mensaje': 'Foto de perfil actualizada',
+        'ruta': filename
+    }), 200
 
-        # Guardar en la bd la ruta relativa
-        cur = mysql.connection.cursor()
-        cur.execute("""
-            UPDATE usuarios SET foto_perfil = %s WHERE id = %s
-        """, (filename, user_id))
+def recoger_imagenes(almacen, claves):
+    """
+    Borra, en su propia transaccion, los archivos de las imagenes que se
+    han quedado sin referencias.
+    """
+    if not claves:
+        return
+    cur = mysql.connection.cursor()
+    try:
+        almacen.recoger(cur, claves)
         mysql.connection.commit()
+    except Exception as e:
+        mysql.connection.rollback()
+        print(f"Error borrando imagenes sin referencias: {e}")
+    finally:
         cur.close()
 
-        # Devolver el nombre del archivo actualizado
-        return jsonify({
-            'mensaje': 'Foto de perfil actualizada',
-            'ruta': filename
-        }), 200
+
+# ----------------------
+# SUBIDAS DIRECTAS
+# ----------------------
+TIPOS_SUBIDA = {
+    'png': 'image/png',
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'gif': 'image/gif',
+    'gpx': 'application/gpx+xml',
+}
+
+
+def clave_pendiente(user_id, extension):
+    return f"{PREFIJO_PENDIENTES}/{user_id}/{uuid.uuid4().hex}{extension.lower()}"
+
+
+def nombre_subida_directa(clave):
+    # 'pendientes/7/<hex>.gpx' -> '<hex>', el id de su fila en subidas
+    return os.path.splitext(clave.rsplit('/', 1)[1])[0]
+
+
+def subida_propia(user_id, clave, extensiones):
+    """
+    True si `clave` es una subida de este usuario, con una de las
+    extensiones permitidas y ya presente en el almacenamiento.
+    """
+    coincidencia = re.fullmatch(rf"{PREFIJO_PENDIENTES}/{user_id}/[0-9a-f]{{32}}\.(\w+)", clave)
+    return bool(coincidencia) and coincidencia.group(1) in extensiones and almacenamiento.existe(clave)
+
+
+def consumir_subidas(cur, claves):
+    """
+    Las subidas ya usadas dejan de estar registradas: desde aqui su archivo
+    es del trabajo que lo procesa y limpiar-subidas no lo toca.
+    """
+    claves = [clave for clave in claves if clave]
+    if claves:
+        marcas = ','.join(['%s'] * len(claves))
+        cur.execute(f"DELETE FROM subidas WHERE clave IN ({marcas})", claves)
+
+
+@app.route('/subidas', methods=['POST'])
+@token_required
+def iniciar_subida():
+    """
+    Reserva una clave para subir una imagen o un GPX sin pasar los bytes por
+    la API. Con S3 es un POST de formulario al bucket, firmado, con los
+    `campos` antes del archivo; en local es PUT /subidas/<nombre> (con el
+    token). En los dos casos se rechaza lo que pase de `max_bytes`. La clave
+    se usa despues en /crear_actividad o /usuario/foto_perfil.
+    """
+    user_id = request.user['user_id']
+    data = request.get_json(silent=True) or {}
+    extension = os.path.splitext(data.get('nombre') or '')[1].lower().lstrip('.')
+    if extension not in TIPOS_SUBIDA:
+        return jsonify({'mensaje': 'Formato de archivo no permitido'}), 400
+
+    clave = clave_pendiente(user_id, f".{extension}")
+    tipo = TIPOS_SUBIDA[extension]
+    caducidad = app.config['URL_FIRMADA_CADUCIDAD']
+    max_bytes = app.config['MAX_CONTENT_LENGTH']
+    cur = mysql.connection.cursor()
+    cur.execute("""
+        INSERT INTO subidas (id, usuario_fk, extension, bytes_total, estado, clave)
+        VALUES (%s, %s, %s, %s, 'directa', %s)
+    """, (nombre_subida_directa(clave), user_id, extension, max_bytes, clave))
+    mysql.connection.commit()
+    cur.close()
+    respuesta = {'clave': clave, 'max_bytes': max_bytes, 'caduca_en': caducidad}
+    firmada = almacenamiento.url_subida(clave, tipo, caducidad, max_bytes)
+    if firmada is None:
+        respuesta.update({
+            'url': f"{request.host_url}subidas/{clave.rsplit('/', 1)[1]}",
+            'metodo': 'PUT',
+            'cabeceras': {'Content-Type': tipo}
+        })
     else:
+        respuesta.update({'url': firmada['url'], 'metodo': 'POST', 'campos': firmada['fields']})
+    return jsonify(respuesta), 201
+
+
+@app.route('/subidas/<nombre>', methods=['PUT'])
+@token_required
+def recibir_subida(nombre):
+    """
+    Destino de las subidas directas cuando el almacenamiento es local. Solo
+    acepta claves emitidas por POST /subidas para este usuario, con el
+    Content-Type que se indico entonces.
+    """
+    coincidencia = re.fullmatch(r"([0-9a-f]{32})\.(\w+)", nombre)
+    if almacenamiento.externo or not coincidencia:
+        return jsonify({'mensaje': 'Subida no encontrada'}), 404
+    user_id = request.user['user_id']
+    cur = mysql.connection.cursor()
+    cur.execute("""
+        SELECT extension FROM subidas
+        WHERE id = %s AND usuario_fk = %s AND estado = 'directa'
+    """, (coincidencia.group(1), user_id))
+    fila = cur.fetchone()
+    mysql.connection.commit()
+    cur.close()
+    if not fila or fila[0] != coincidencia.group(2):
+        return jsonify({'mensaje': 'Subida no encontrada'}), 404
+    if request.mimetype != TIPOS_SUBIDA[fila[0]]:
+        return jsonify({'mensaje': f'El Content-Type debe ser {TIPOS_SUBIDA[fila[0]]}'}), 415
+
+    clave = f"{PREFIJO_PENDIENTES}/{user_id}/{nombre}"
+    almacenamiento.guardar_flujo(clave, request.stream)
+    return jsonify({'clave': clave}), 200
+
+
+# ----------------------
+# SUBIDAS REANUDABLES
+# ----------------------
+# El archivo se manda por trozos a partir de un desplazamiento y se verifica
+# con SHA-256 al terminar. Los trozos se escriben directamente en disco del
+# servidor de la API; al finalizar el archivo pasa al almacenamiento.
+CARPETA_PARCIALES = os.path.join(UPLOAD_FOLDER, 'parciales')
+SUBIDA_TAM_TROZO = 1024 * 1024
+SUBIDA_MAX_BYTES = 100 * 1024 * 1024
+SUBIDA_CADUCIDAD_HORAS = 24
+
+
+def ruta_parcial(subida_id):
+    return os.path.join(CARPETA_PARCIALES, f"{subida_id}.part")
+
+
+def estado_subida(subida_id, bytes_total, bytes_recibidos, estado, clave):
+    respuesta = jsonify({
+        'id': subida_id,
+        'bytes_total': bytes_total,
+        'recibido': bytes_recibidos,
+        'estado': estado,
+        'clave': clave,
+        'tamano_trozo': SUBIDA_TAM_TROZO
+    })
+    respuesta.headers['Upload-Offset'] = str(bytes_recibidos)
+    return respuesta
+
+
+@app.route('/subidas/reanudables', methods=['POST'])
+@token_required
+def iniciar_subida_reanudable():
+    """
+    Abre una subida por trozos. Recibe {nombre, bytes_total}.
+    """
+    user_id = request.user['user_id']
+    data = request.get_json(silent=True) or {}
+    extension = os.path.splitext(data.get('nombre') or '')[1].lower().lstrip('.')
+    if extension not in TIPOS_SUBIDA:
         return jsonify({'mensaje': 'Formato de archivo no permitido'}), 400
+    try:
+        bytes_total = int(data.get('bytes_total'))
+    except (TypeError, ValueError):
+        return jsonify({'mensaje': 'Falta el tamaño del archivo'}), 400
+    if not 0 < bytes_total <= SUBIDA_MAX_BYTES:
+        return jsonify({'mensaje': 'Tamaño de archivo no permitido'}), 413
+
+    subida_id = uuid.uuid4().hex
+    os.makedirs(CARPETA_PARCIALES, exist_ok=True)
+    open(ruta_parcial(subida_id), 'wb').close()
+
+    cur = mysql.connection.cursor()
+    cur.execute("""
+        INSERT INTO subidas (id, usuario_fk, extension, bytes_total)
+        VALUES (%s, %s, %s, %s)
+    """, (subida_id, user_id, extension, bytes_total))
+    mysql.connection.commit()
+    cur.close()
+    return estado_subida(subida_id, bytes_total, 0, 'abierta', None), 201
+
+
+@app.route('/subidas/reanudables/<subida_id>', methods=['GET'])
+@token_required
+def consultar_subida_reanudable(subida_id):
+    """
+    Cuanto se ha recibido (tambien en la cabecera Upload-Offset), para
+    continuar tras un corte.
+    """
+    cur = mysql.connection.cursor()
+    cur.execute("""
+        SELECT bytes_total, bytes_recibidos, estado, clave FROM subidas
+        WHERE id = %s AND usuario_fk = %s
+    """, (subida_id, request.user['user_id']))
+    fila = cur.fetchone()
+    cur.close()
+    if not fila:
+        return jsonify({'mensaje': 'Subida no encontrada'}), 404
+    return estado_subida(subida_id, *fila), 200
+
+
+@app.route('/subidas/reanudables/<subida_id>', methods=['PATCH'])
+@token_required
+def enviar_trozo(subida_id):
+    """
+    Escribe el cuerpo en la posicion de la cabecera Upload-Offset. Si no
+    coincide con lo ya recibido responde 409 con el desplazamiento correcto.
+    Si la conexion se corta a medias se conserva lo que haya llegado.
+    """
+    try:
+        desplazamiento = int(request.headers.get('Upload-Offset', ''))
+    except ValueError:
+        return jsonify({'mensaje': 'Falta la cabecera Upload-Offset'}), 400
+
+    cur = mysql.connection.cursor()
+    try:
+        cur.execute("""
+            SELECT bytes_total, bytes_recibidos, estado, clave FROM subidas
+            WHERE id = %s AND usuario_fk = %s
+        """, (subida_id, request.user['user_id']))
+        fila = cur.fetchone()
+        # Sin transaccion abierta mientras llega el cuerpo, que puede tardar
+        mysql.connection.commit()
+        if not fila:
+            return jsonify({'mensaje': 'Subida no encontrada'}), 404
+        bytes_total, bytes_recibidos, estado, clave = fila
+        if estado != 'abierta' or desplazamiento != bytes_recibidos:
+            return estado_subida(subida_id, *fila), 409
+
+        escritos = 0
+        sobra = False
+        try:
+            with open(ruta_parcial(subida_id), 'r+b') as f:
+                f.seek(desplazamiento)
+                while True:
+                    bloque = request.stream.read(64 * 1024)
+                    if not bloque:
+                        break
+                    if desplazamiento + escritos + len(bloque) > bytes_total:
+                        sobra = True
+                        break
+                    f.write(bloque)
+                    escritos += len(bloque)
+        except ClientDisconnected:
+            pass
+        if sobra:
+            return jsonify({'mensaje': 'El trozo supera el tamaño declarado'}), 400
+        if not escritos:
+            return estado_subida(subida_id, *fila), 200
+
+        # Solo avanza si nadie lo ha movido mientras tanto: de dos trozos
+        # enviados a la vez desde el mismo punto gana uno y el otro recibe
+        # 409 (el SHA-256 final detecta cualquier mezcla)
+        cur.execute("""
+            UPDATE subidas SET bytes_recibidos = %s
+            WHERE id = %s AND bytes_recibidos = %s AND estado = 'abierta'
+        """, (desplazamiento + escritos, subida_id, desplazamiento))
+        avanzada = cur.rowcount == 1
+        mysql.connection.commit()
+        if not avanzada:
+            cur.execute("""
+                SELECT bytes_total, bytes_recibidos, estado, clave FROM subidas WHERE id = %s
+            """, (subida_id,))
+            fila = cur.fetchone()
+            if not fila:
+                return jsonify({'mensaje': 'Subida no encontrada'}), 404
+            return estado_subida(subida_id, *fila), 409
+        return estado_subida(subida_id, bytes_total, desplazamiento + escritos, estado, clave), 200
+    finally:
+        cur.close()
+
+
+@app.route('/subidas/reanudables/<subida_id>/finalizar', methods=['POST'])
+@token_required
+def finalizar_subida_reanudable(subida_id):
+    """
+    Comprueba el tamaño y el SHA-256 ({sha256}) y deja el archivo en
+    pendientes. La clave devuelta se usa en /crear_actividad (gpx_subida,
+    imagenes_subidas) o en /usuario/foto_perfil (clave_subida).
+    """
+    user_id = request.user['user_id']
+    sha256 = (request.get_json(silent=True) or {}).get('sha256')
+    # Sin una suma valida no se puede comparar: no se descarta lo subido
+    if not isinstance(sha256, str) or not ES_HASH.fullmatch(sha256):
+        return jsonify({'mensaje': 'sha256 debe ser 64 caracteres hexadecimales en minúscula'}), 400
+
+    cur = mysql.connection.cursor()
+    try:
+        cur.execute("""
+            SELECT bytes_total, bytes_recibidos, estado, clave, extension FROM subidas
+            WHERE id = %s AND usuario_fk = %s
+            FOR UPDATE
+        """, (subida_id, user_id))
+        fila = cur.fetchone()
+        if not fila:
+            mysql.connection.rollback()
+            return jsonify({'mensaje': 'Subida no encontrada'}), 404
+        bytes_total, bytes_recibidos, estado, clave, extension = fila
+        if estado == 'completa':
+            mysql.connection.rollback()
+            return estado_subida(subida_id, *fila[:4]), 200
+        if bytes_recibidos != bytes_total:
+            mysql.connection.rollback()
+            return estado_subida(subida_id, *fila[:4]), 409
+
+        ruta = ruta_parcial(subida_id)
+        if hash_archivo(ruta) != sha256:
+            # No sabemos que trozo llego mal: se vuelve a empezar
+            open(ruta, 'wb').close()
+            cur.execute("UPDATE subidas SET bytes_recibidos = 0 WHERE id = %s", (subida_id,))
+            mysql.connection.commit()
+            return jsonify({'mensaje': 'La suma de comprobación no coincide', 'recibido': 0}), 422
+
+        clave = clave_pendiente(user_id, f".{extension}")
+        almacenamiento.guardar(clave, ruta)
+        cur.execute("""
+            UPDATE subidas SET estado = 'completa', clave = %s WHERE id = %s
+        """, (clave, subida_id))
+        mysql.connection.commit()
+        return estado_subida(subida_id, bytes_total, bytes_recibidos, 'completa', clave), 200
+    finally:
+        cur.close()
+
+
+@app.cli.command('limpiar-subidas')
+@click.option('--horas', default=SUBIDA_CADUCIDAD_HORAS, help='Horas sin actividad.')
+def limpiar_subidas_cmd(horas):
+    """Borra las subidas abandonadas y las finalizadas o directas que no se usaron."""
+    cur = mysql.connection.cursor()
+    cur.execute("""
+        SELECT id, estado, clave FROM subidas
+        WHERE actualizado_en < NOW() - INTERVAL %s HOUR
+    """, (horas,))
+    filas = cur.fetchall()
+    for subida_id, estado, clave in filas:
+        if estado == 'abierta':
+            try:
+                os.remove(ruta_parcial(subida_id))
+            except FileNotFoundError:
+                pass
+        elif clave:
+            # Completa o directa pero nunca usada (al usarse se borra su
+            # fila): su objeto en pendientes/ se queda huerfano
+            almacenamiento.borrar(clave)
+        cur.execute("DELETE FROM subidas WHERE id = %s", (subida_id,))
+    mysql.connection.commit()
+    cur.close()
+    print(f"Subidas borradas: {len(filas)}")
+
+
+# ----------------------
+# ARCHIVOS ESTATICOS
+# ----------------------
+# Los nombres de las imagenes son el hash de su contenido (o, los antiguos,
+# unicos por subida) y nunca se reescriben: el cliente puede guardarlas sin
+# volver a preguntar. CACHE_INMUTABLE viene de almacenamiento.py
+
+
+def variante_solicitada(almacen, nombre):
+    """
+    Clave en el almacenamiento del archivo a servir segun ?tam= (mini,
+    media, grande) y si el cliente acepta WebP. Devuelve None si el tamaño
+    no existe.
+    """
+    tamaño = request.args.get('tam', TAMAÑO_POR_DEFECTO)
+    if tamaño not in dict(almacen.tamaños):
+        return None
+    extension = 'webp' if request.accept_mimetypes['image/webp'] else 'jpg'
+    return almacen.clave_a_servir(nombre, tamaño, extension)
+
+
+def servir_archivo(clave, inmutable=True):
+    """
+    Sirve un archivo local con tipo MIME, Content-Length, Range y validacion
+    por Last-Modified/ETag. El cuerpo lo envia el servidor WSGI con
+    wsgi.file_wrapper (sendfile) o el proxy si esta configurado. Devuelve
+    None si el archivo no existe.
+    """
+    ruta = safe_join(almacenamiento.raiz, clave)
+    if ruta is None or not os.path.isfile(ruta):
+        return None
+
+    interna = app.config['X_ACCEL_REDIRECT']
+    if interna:
+        # nginx lee el archivo y resuelve Range y condicionales
+        respuesta = Response(mimetype=mimetypes.guess_type(clave)[0] or 'application/octet-stream')
+        respuesta.headers['X-Accel-Redirect'] = f"{interna.rstrip('/')}/{clave}"
+    else:
+        respuesta = send_file(ruta, conditional=True, etag=True)
+    respuesta.headers['Cache-Control'] = CACHE_INMUTABLE if inmutable else 'public, no-cache'
+    return respuesta
+
+
+def servir_imagen(almacen, nombre):
+    clave = variante_solicitada(almacen, nombre)
+    if clave is None:
+        return jsonify({'mensaje': 'Tamaño no válido'}), 400
+
+    caducidad = app.config['URL_FIRMADA_CADUCIDAD']
+    url = almacenamiento.url_descarga(clave, caducidad)
+    if url:
+        # La imagen se descarga directamente del bucket
+        respuesta = redirect(url)
+        respuesta.headers['Cache-Control'] = f"private, max-age={caducidad // 2}"
+    else:
+        respuesta = servir_archivo(clave)
+        if respuesta is None:
+            return "Archivo no encontrado", 404
+    respuesta.vary.add('Accept')
+    return respuesta
+
 
 @app.route('/fotos_perfil/<filename>', methods=['GET'])
 def uploaded_file(filename):
-   
-    try:
-        print(f"Intentando servir la imagen: {filename}")
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        
-        def generate():
-            with open(filepath, 'rb') as f:
-                chunk = f.read(4096)
-                while chunk:
-                    yield chunk
-                    chunk = f.read(4096)
-        
-        # Encabezados necesarios 
-        headers = {
-            "Content-Type": "image/png",
-            "Connection": "keep-alive",
-            "Keep-Alive": "timeout=5, max=1",
-            "Cache-Control": "no-cache",
-            "Access-Control-Allow-Origin": "*"
-        }
-        
-        return app.response_class(generate(), headers=headers)
-    except FileNotFoundError:
-        print(f"Imagen no encontrada: {filename}")
-        return "Archivo no encontrado", 404
+    return servir_imagen(almacen_fotos_perfil, filename)
 
 @app.route('/imagenes_publicaciones/<filename>', methods=['GET'])
 def imagen_publicacion(filename):
-    try:
-        print(f"Sirviendo imagen de publicación: {filename}")
-        carpeta = os.path.join('C:\\imagenes_hercules', 'publicaciones')
-        return send_from_directory(carpeta, filename)
-    except FileNotFoundError:
-        print(f"Archivo no encontrado: {filename}")
-        return "Archivo no encontrado", 404
+    return servir_imagen(almacen_publicaciones, filename)
 
 
 if __name__ == '__main__':
     print("Iniciando API Flask en modo desarrollo...")
+    cola_trabajos.arrancar()
     app.run(debug=True)
  
\ No newline at end of file
@@ -0,0 +1,101 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class CacheRespuestas:
+    """
+    Cache LRU en memoria con caducidad (TTL) y limite de bytes.
+
+    Cada entrada lleva unas etiquetas (p. ej. ('feed', 7) o ('publicacion', 42))
+    para poder invalidar exactamente las respuestas afectadas por una escritura.
+    """
+
+    def __init__(self, ttl=60, max_bytes=64 * 1024 * 1024, max_entradas=10000):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_entradas = max_entradas
+        self._entradas = OrderedDict()  # clave -> (valor, tamaño, caduca, etiquetas)
+        self._por_etiqueta = {}
+        self._bytes = 0
+        self._generacion = 0
+        self._lock = threading.Lock()
+
+    @property
+    def generacion(self):
+        """
+        Cambia con cada invalidacion; sirve para no guardar una respuesta
+        calculada mientras otra peticion invalidaba el cache.
+        """
+        return self._generacion
+
+    def obtener(self, clave):
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada is None:
+                return None
+            if entrada[2] < time.monotonic():
+                self._quitar(clave)
+                return None
+            self._entradas.move_to_end(clave)
+            return entrada[0]
+
+    def guardar(self, clave, valor, tamaño, etiquetas=(), generacion=None):
+        if tamaño > self.max_bytes:
+            return
+        with self._lock:
+            if generacion is not None and generacion != self._generacion:
+                return
+            if clave in self._entradas:
+                self._quitar(clave)
+            etiquetas = frozenset(etiquetas)
+            self._entradas[clave] = (valor, tamaño, time.monotonic() + self.ttl, etiquetas)
+            self._bytes += tamaño
+            for etiqueta in etiquetas:
+                self._por_etiqueta.setdefault(etiqueta, set()).add(clave)
+            self._expulsar()
+
+    def crecer(self, clave, tamaño):
+        """
+        Suma `tamaño` bytes a una entrada que ha ganado datos despues de
+        guardarse (p. ej. una version comprimida). No hace nada si ya no esta.
+        """
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada is None:
+                return
+            valor, actual, caduca, etiquetas = entrada
+            self._entradas[clave] = (valor, actual + tamaño, caduca, etiquetas)
+            self._bytes += tamaño
+            self._expulsar()
+
+    def invalidar(self, *etiquetas):
+        with self._lock:
+            self._generacion += 1
+            for etiqueta in etiquetas:
+                for clave in list(self._por_etiqueta.get(etiqueta, ())):
+                    self._quitar(clave)
+
+    def limpiar(self):
+        with self._lock:
+            self._generacion += 1
+            self._entradas.clear()
+            self._por_etiqueta.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._entradas)
+
+    def _expulsar(self):
+        while self._bytes > self.max_bytes or len(self._entradas) > self.max_entradas:
+            self._quitar(next(iter(self._entradas)))
+
+    def _quitar(self, clave):
+        _, tamaño, _, etiquetas = self._entradas.pop(clave)
+        self._bytes -= tamaño
+        for etiqueta in etiquetas:
+            claves = self._por_etiqueta.get(etiqueta)
+            if claves is not None:
+                claves.discard(clave)
+                if not claves:
+                    del self._por_etiqueta[etiqueta]
@@ -0,0 +1,93 @@
+import json
+import queue
+import threading
+
+
+def formatear_evento(tipo, datos, evento_id=None):
+    """
+    Un evento en formato Server-Sent Events.
+    """
+    lineas = []
+    if evento_id is not None:
+        lineas.append(f"id: {evento_id}")
+    lineas.append(f"event: {tipo}")
+    lineas.append(f"data: {json.dumps(datos, ensure_ascii=False, default=str)}")
+    return '\n'.join(lineas) + '\n\n'
+
+
+class CanalesUsuarios:
+    """
+    Pub/sub en memoria: cada conexion abierta de un usuario tiene su cola y
+    publicar() copia el evento en todas. Solo llega a las conexiones de este
+    proceso.
+
+    Si un cliente no lee y su cola se llena, se le cierra la conexion; al
+    reconectar con Last-Event-ID recupera lo perdido.
+    """
+
+    def __init__(self, max_cola=200):
+        self.max_cola = max_cola
+        self._colas = {}
+        self._lock = threading.Lock()
+
+    def suscribir(self, usuario_id):
+        cola = queue.Queue(self.max_cola)
+        with self._lock:
+            self._colas.setdefault(usuario_id, set()).add(cola)
+        return cola
+
+    def cancelar(self, usuario_id, cola):
+        with self._lock:
+            colas = self._colas.get(usuario_id)
+            if colas is not None:
+                colas.discard(cola)
+                if not colas:
+                    del self._colas[usuario_id]
+
+    def publicar(self, usuario_id, tipo, datos, evento_id=None):
+        with self._lock:
+            colas = list(self._colas.get(usuario_id, ()))
+        if not colas:
+            return
+        evento = formatear_evento(tipo, datos, evento_id)
+        for cola in colas:
+            try:
+                cola.put_nowait(evento)
+            except queue.Full:
+                self._cerrar(usuario_id, cola)
+
+    def conectados(self, usuario_id):
+        with self._lock:
+            return len(self._colas.get(usuario_id, ()))
+
+    def _cerrar(self, usuario_id, cola):
+        self.cancelar(usuario_id, cola)
+        try:
+            while True:
+                cola.get_nowait()
+        except queue.Empty:
+            pass
+        cola.put_nowait(None)
+
+
+def flujo_eventos(canales, usuario_id, cola, iniciales=(), latido=15):
+    """
+    Generador para la respuesta SSE. Cada `latido` segundos sin eventos
+    manda un comentario para mantener viva la conexion y detectar pronto
+    los clientes que se han ido.
+    """
+    try:
+        yield 'retry: 3000\n\n'
+        for evento in iniciales:
+            yield evento
+        while True:
+            try:
+                evento = cola.get(timeout=latido)
+            except queue.Empty:
+                yield ': ping\n\n'
+                continue
+            if evento is None:
+                return
+            yield evento
+    finally:
+        canales.cancelar(usuario_id, cola)
@@ -0,0 +1,85 @@
+import threading
+import time
+
+
+class ContadoresPendientes:
+    """
+    Acumula en memoria los incrementos de likes/comentarios por publicacion
+    y los vuelca a MySQL en un solo UPDATE por publicacion cada pocos segundos.
+    """
+
+    def __init__(self, app, mysql, cache, intervalo):
+        self.app = app
+        self.mysql = mysql
+        self.cache = cache
+        self.intervalo = intervalo
+        self._deltas = {}
+        # Incrementos que se estan volcando: siguen contando hasta el commit
+        self._en_vuelo = {}
+        self._lock = threading.Lock()
+        self._volcando = threading.Lock()
+        self._hilo = None
+
+    def sumar(self, publicacion_id, likes=0, comentarios=0):
+        with self._lock:
+            actual = self._deltas.get(publicacion_id, (0, 0))
+            self._deltas[publicacion_id] = (actual[0] + likes, actual[1] + comentarios)
+            if self._hilo is None:
+                self._hilo = threading.Thread(target=self._bucle, daemon=True)
+                self._hilo.start()
+
+    def pendientes(self, publicacion_id):
+        with self._lock:
+            likes, comentarios = self._deltas.get(publicacion_id, (0, 0))
+            en_vuelo = self._en_vuelo.get(publicacion_id, (0, 0))
+            return likes + en_vuelo[0], comentarios + en_vuelo[1]
+
+    def descartar(self, publicacion_id):
+        with self._lock:
+            self._deltas.pop(publicacion_id, None)
+            self._en_vuelo.pop(publicacion_id, None)
+
+    def volcar(self, cur):
+        """
+        Aplica los incrementos a MySQL y hace commit. Mientras tanto siguen
+        sumandose en pendientes(): quien lea antes del commit no los pierde.
+        """
+        with self._volcando:
+            with self._lock:
+                deltas, self._deltas = self._deltas, {}
+                self._en_vuelo = deltas
+            filas = [(l, c, pub_id) for pub_id, (l, c) in deltas.items() if l or c]
+            try:
+                if filas:
+                    cur.executemany("""
+                        UPDATE publicaciones
+                        SET total_likes = GREATEST(CAST(total_likes AS SIGNED) + %s, 0),
+                            total_comentarios = GREATEST(CAST(total_comentarios AS SIGNED) + %s, 0)
+                        WHERE id = %s
+                    """, filas)
+                    self.mysql.connection.commit()
+            except Exception:
+                # Devolvemos los incrementos al buffer para el siguiente intento
+                with self._lock:
+                    for pub_id, (l, c) in self._en_vuelo.items():
+                        actual = self._deltas.get(pub_id, (0, 0))
+                        self._deltas[pub_id] = (actual[0] + l, actual[1] + c)
+                    self._en_vuelo = {}
+                raise
+            with self._lock:
+                self._en_vuelo = {}
+        if filas:
+            # Las respuestas cacheadas con el total de antes del commit
+            self.cache.invalidar(*[('publicacion', pub_id) for _, _, pub_id in filas])
+        return len(filas)
+
+    def _bucle(self):
+        while True:
+            time.sleep(self.intervalo)
+            try:
+                with self.app.app_context():
+                    cur = self.mysql.connection.cursor()
+                    self.volcar(cur)
+                    cur.close()
+            except Exception as e:
+                print(f"Error al volcar contadores: {e}")
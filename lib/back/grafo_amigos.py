@@ -0,0 +1,119 @@
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+
+def _contiene(ids, valor):
+    i = bisect_left(ids, valor)
+    return i < len(ids) and ids[i] == valor
+
+
+class GrafoAmistades:
+    """
+    Cache LRU en memoria de las amistades aceptadas. Por cada usuario guarda
+    sus amigos como un array de enteros ordenado (4 bytes por amigo), que se
+    lee de la base de datos con `cargar(usuario_id)` la primera vez que hace
+    falta.
+
+    Las escrituras de este proceso lo actualizan al momento (agregar,
+    quitar, olvidar); las de otros procesos se ven cuando caduca la entrada
+    (ttl).
+    """
+
+    def __init__(self, cargar, ttl=300, max_usuarios=100000):
+        self._cargar = cargar
+        self.ttl = ttl
+        self.max_usuarios = max_usuarios
+        self._vecinos = OrderedDict()  # usuario_id -> (array ordenado, caduca)
+        self._generacion = 0
+        self._lock = threading.Lock()
+
+    def amigos(self, usuario_id):
+        """
+        Ids de los amigos de `usuario_id` en un array ordenado. No modificar.
+        """
+        usuario_id = int(usuario_id)
+        with self._lock:
+            entrada = self._vecinos.get(usuario_id)
+            if entrada is not None and entrada[1] >= time.monotonic():
+                self._vecinos.move_to_end(usuario_id)
+                return entrada[0]
+            generacion = self._generacion
+
+        ids = array('i', sorted(set(self._cargar(usuario_id))))
+        with self._lock:
+            # Si alguien cambio el grafo durante la carga, puede estar vieja
+            if generacion == self._generacion:
+                self._vecinos[usuario_id] = (ids, time.monotonic() + self.ttl)
+                self._vecinos.move_to_end(usuario_id)
+                while len(self._vecinos) > self.max_usuarios:
+                    self._vecinos.popitem(last=False)
+        return ids
+
+    def son_amigos(self, usuario_a, usuario_b):
+        return _contiene(self.amigos(usuario_a), int(usuario_b))
+
+    def mutuos(self, usuario_a, usuario_b):
+        """
+        Amigos en comun, ordenados.
+        """
+        a, b = self.amigos(usuario_a), self.amigos(usuario_b)
+        if len(a) > len(b):
+            a, b = b, a
+        return [x for x in a if _contiene(b, x)]
+
+    def agregar(self, usuario_a, usuario_b):
+        usuario_a, usuario_b = int(usuario_a), int(usuario_b)
+        with self._lock:
+            self._generacion += 1
+            self._cambiar(usuario_a, usuario_b, True)
+            self._cambiar(usuario_b, usuario_a, True)
+
+    def quitar(self, usuario_a, usuario_b):
+        usuario_a, usuario_b = int(usuario_a), int(usuario_b)
+        with self._lock:
+            self._generacion += 1
+            self._cambiar(usuario_a, usuario_b, False)
+            self._cambiar(usuario_b, usuario_a, False)
+
+    def olvidar(self, usuario_id):
+        """
+        Saca al usuario del grafo (cuenta eliminada).
+        """
+        usuario_id = int(usuario_id)
+        with self._lock:
+            self._generacion += 1
+            entrada = self._vecinos.pop(usuario_id, None)
+            if entrada is None:
+                # No sabemos quienes eran sus amigos
+                self._vecinos.clear()
+                return
+            for amigo in entrada[0]:
+                self._cambiar(amigo, usuario_id, False)
+
+    def limpiar(self):
+        with self._lock:
+            self._generacion += 1
+            self._vecinos.clear()
+
+    def __len__(self):
+        return len(self._vecinos)
+
+    def _cambiar(self, usuario_id, amigo_id, agregar):
+        entrada = self._vecinos.get(usuario_id)
+        if entrada is None:
+            return
+        ids = entrada[0]
+        i = bisect_left(ids, amigo_id)
+        presente = i < len(ids) and ids[i] == amigo_id
+        if agregar == presente:
+            return
+        # Copia: quien ya tenga el array lo puede estar recorriendo
+        nuevo = array('i', ids)
+        if agregar:
+            nuevo.insert(i, amigo_id)
+        else:
+            del nuevo[i]
+        self._vecinos[usuario_id] = (nuevo, entrada[1])
@@ -0,0 +1,8 @@
+def marca_lectura(leido_hasta, ultimo_id, hasta_id=None):
+    """
+    Nueva marca de lectura de una conversacion: hasta `hasta_id` (o hasta
+    el ultimo mensaje), sin pasar de `ultimo_id` y sin retroceder nunca de
+    `leido_hasta`, aunque llegue tarde una confirmacion antigua.
+    """
+    hasta = ultimo_id if hasta_id is None else min(hasta_id, ultimo_id)
+    return max(leido_hasta, hasta)
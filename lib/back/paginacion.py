@@ -0,0 +1,42 @@
+import base64
+import datetime
+
+
+def codificar_cursor(fecha, pub_id):
+    """
+    Cursor opaco (fecha, id) de la ultima publicacion devuelta.
+    """
+    crudo = f"{fecha.strftime('%Y-%m-%d %H:%M:%S')}|{pub_id}"
+    return base64.urlsafe_b64encode(crudo.encode('utf-8')).decode('ascii')
+
+
+def decodificar_cursor(cursor):
+    """
+    Devuelve (fecha, id) o lanza ValueError si el cursor no es valido.
+    """
+    try:
+        crudo = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        fecha, pub_id = crudo.split('|')
+        return datetime.datetime.strptime(fecha, '%Y-%m-%d %H:%M:%S'), int(pub_id)
+    except Exception:
+        raise ValueError('Cursor inválido')
+
+
+def leer_limite(valor, por_defecto, maximo):
+    try:
+        limite = int(valor) if valor is not None else por_defecto
+    except (TypeError, ValueError):
+        return por_defecto
+    return max(1, min(limite, maximo))
+
+
+def leer_id(valor):
+    """
+    Id de usuario (entero o cadena de digitos) de un cuerpo JSON, o None.
+    """
+    if isinstance(valor, int) and not isinstance(valor, bool):
+        return valor
+    # isdigit() tambien acepta '²' o '①', que int() no sabe convertir
+    if isinstance(valor, str) and valor.isascii() and valor.isdigit():
+        return int(valor)
+    return None
@@ -0,0 +1,97 @@
+import datetime
+
+# Particion que recoge todo lo posterior a la ultima mensual
+PARTICION_FUTURO = 'p_futuro'
+
+
+def inicio_mes(fecha):
+    return datetime.datetime(fecha.year, fecha.month, 1)
+
+
+def sumar_meses(fecha, meses):
+    """
+    Primer dia del mes `meses` despues (o antes, si es negativo) de `fecha`.
+    """
+    indice = fecha.year * 12 + fecha.month - 1 + meses
+    return datetime.datetime(indice // 12, indice % 12 + 1, 1)
+
+
+def nombre_particion(mes):
+    """
+    Particion con los datos del mes que empieza en `mes`: 'p202610'.
+    """
+    return f"p{mes.year:04d}{mes.month:02d}"
+
+
+def listar_particiones(cur, tabla):
+    """
+    [(nombre, limite)] en orden; `limite` es el UNIX_TIMESTAMP hasta el que
+    llega la particion (sin incluirlo) o None para MAXVALUE.
+    """
+    cur.execute("""
+        SELECT PARTITION_NAME, PARTITION_DESCRIPTION
+        FROM information_schema.PARTITIONS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL
+        ORDER BY PARTITION_ORDINAL_POSITION
+    """, (tabla,))
+    return [(nombre, None if limite == 'MAXVALUE' else int(limite)) for nombre, limite in cur.fetchall()]
+
+
+def crear_particiones(cur, tabla, hasta):
+    """
+    Parte PARTICION_FUTURO en una particion por mes hasta el mes de `hasta`
+    incluido. Si esta vacia (lo normal, si se ejecuta con antelacion) es
+    una operacion instantanea. Devuelve los nombres creados.
+    """
+    particiones = listar_particiones(cur, tabla)
+    limites = [limite for _, limite in particiones if limite is not None]
+    if not limites:
+        raise ValueError(f'{tabla} no tiene particiones mensuales')
+
+    cur.execute("SELECT FROM_UNIXTIME(%s)", (max(limites),))
+    mes = cur.fetchone()[0]
+    ultimo = inicio_mes(hasta)
+    nuevas = []
+    while mes <= ultimo:
+        siguiente = sumar_meses(mes, 1)
+        nuevas.append((nombre_particion(mes), siguiente))
+        mes = siguiente
+    if not nuevas:
+        return []
+
+    definiciones = ', '.join(
+        f"PARTITION {nombre} VALUES LESS THAN (UNIX_TIMESTAMP('{limite:%Y-%m-%d %H:%M:%S}'))"
+        for nombre, limite in nuevas
+    )
+    cur.execute(f"""
+        ALTER TABLE {tabla} REORGANIZE PARTITION {PARTICION_FUTURO} INTO (
+            {definiciones},
+            PARTITION {PARTICION_FUTURO} VALUES LESS THAN MAXVALUE
+        )
+    """)
+    return [nombre for nombre, _ in nuevas]
+
+
+def archivar_particiones(cur, tabla, tabla_archivo, columnas, antes_de):
+    """
+    Copia a `tabla_archivo` cada particion que acaba antes de `antes_de` y
+    la elimina (DROP PARTITION: sin DELETE fila a fila ni huecos en la
+    tabla caliente). Si se corta a medias, volver a ejecutarlo es seguro.
+    Devuelve [(particion, filas copiadas)].
+    """
+    cur.execute("SELECT UNIX_TIMESTAMP(%s)", (antes_de,))
+    corte = cur.fetchone()[0]
+    lista = ', '.join(columnas)
+    archivadas = []
+    for nombre, limite in listar_particiones(cur, tabla):
+        if limite is None or limite > corte:
+            break
+        cur.execute(f"""
+            INSERT IGNORE INTO {tabla_archivo} ({lista})
+            SELECT {lista} FROM {tabla} PARTITION ({nombre})
+        """)
+        filas = cur.rowcount
+        # El ALTER hace commit implicito de la copia
+        cur.execute(f"ALTER TABLE {tabla} DROP PARTITION {nombre}")
+        archivadas.append((nombre, filas))
+    return archivadas
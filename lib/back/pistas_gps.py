@@ -0,0 +1,526 @@
+"""
+Formato binario compacto para las pistas GPS de las publicaciones.
+
+Cada pista se guarda como una cabecera fija seguida de arrays enteros
+delta-codificados y comprimidos con zlib:
+
+    lat, lon  -> int32 en 1e-7 grados (~1 cm)
+    ele       -> int32 en decimetros
+    tiempo    -> int64 en milisegundos desde el primer punto (t0 va en la cabecera)
+
+La version 1 guardaba el tiempo en int32, que se desborda si la pista
+abarca mas de ~24.8 dias; se sigue pudiendo leer.
+
+Una pista de 20k puntos ocupa del orden de 100 KB frente a ~1.8 MB en JSON.
+"""
+import datetime
+import struct
+import zlib
+from array import array
+from collections import namedtuple
+from xml.parsers import expat
+
+import numpy as np
+
+MAGIC = b'HGT1'
+VERSION = 2
+# Versiones que sabe leer decodificar_pista
+_VERSIONES = (1, 2)
+
+# Cabecera: magic, version, flags, num_puntos, t0 (ms desde epoch)
+_CABECERA = struct.Struct('<4sBBIq')
+
+_CON_ELE = 0x01
+_CON_TIEMPO = 0x02
+_MASCARA_ELE = 0x04
+_MASCARA_TIEMPO = 0x08
+
+ESCALA_GRADOS = 10_000_000
+ESCALA_ELE = 10
+
+Pista = namedtuple('Pista', ['lat', 'lon', 'ele', 'tiempo'])
+Pista.__doc__ = """
+lat/lon en float64, ele en float32 (NaN si falta) y tiempo en
+datetime64[ms] (NaT si falta). ele/tiempo son None si la pista no los tiene.
+"""
+
+
+class FormatoPistaInvalido(ValueError):
+    pass
+
+
+class GPXInvalido(ValueError):
+    pass
+
+
+def _deltas(valores, tipo=np.int32):
+    # En int32, cumsum en int32 deshace el desbordamiento; el tiempo va en int64
+    return np.diff(valores, prepend=np.int64(0)).astype(tipo)
+
+
+def _rellenar_huecos(valores, validos):
+    """
+    Sustituye los huecos por el ultimo valor valido para que los deltas
+    sigan siendo pequeños; la mascara indica cuales eran reales.
+    """
+    if validos.all():
+        return valores
+    indices = np.where(validos, np.arange(len(valores)), 0)
+    np.maximum.accumulate(indices, out=indices)
+    rellenos = valores[indices]
+    primero = np.argmax(validos)
+    rellenos[:primero] = valores[primero]
+    return rellenos
+
+
+def codificar_pista(lat, lon, ele=None, tiempo_ms=None):
+    """
+    Codifica arrays de lat/lon (grados), ele (metros, NaN si falta) y
+    tiempo_ms (ms desde epoch, valor negativo o NaN si falta).
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    n = len(lat)
+    if len(lon) != n:
+        raise ValueError('lat y lon deben tener la misma longitud')
+
+    flags = 0
+    t0 = 0
+    partes = [
+        _deltas(np.rint(lat * ESCALA_GRADOS).astype(np.int64)).tobytes(),
+        _deltas(np.rint(lon * ESCALA_GRADOS).astype(np.int64)).tobytes(),
+    ]
+    tiempos = []
+    mascaras = []
+
+    if ele is not None:
+        ele = np.asarray(ele, dtype=np.float64)
+        validos = ~np.isnan(ele)
+        if validos.any():
+            flags |= _CON_ELE
+            valores = np.rint(np.nan_to_num(ele) * ESCALA_ELE).astype(np.int64)
+            partes.append(_deltas(_rellenar_huecos(valores, validos)).tobytes())
+            if not validos.all():
+                flags |= _MASCARA_ELE
+                mascaras.append(np.packbits(validos).tobytes())
+
+    if tiempo_ms is not None:
+        tiempo = np.asarray(tiempo_ms, dtype=np.float64)
+        validos = ~np.isnan(tiempo) & (tiempo >= 0)
+        if validos.any():
+            flags |= _CON_TIEMPO
+            valores = np.where(validos, tiempo, 0).astype(np.int64)
+            valores = _rellenar_huecos(valores, validos)
+            t0 = int(valores[0])
+            tiempos.append(_deltas(valores - t0, np.int64).tobytes())
+            if not validos.all():
+                flags |= _MASCARA_TIEMPO
+                mascaras.append(np.packbits(validos).tobytes())
+
+    cuerpo = zlib.compress(b''.join(partes + tiempos + mascaras), 6)
+    return _CABECERA.pack(MAGIC, VERSION, flags, n, t0) + cuerpo
+
+
+def decodificar_pista(datos):
+    """
+    Devuelve una Pista con arrays de NumPy.
+    """
+    if len(datos) < _CABECERA.size:
+        raise FormatoPistaInvalido('Pista truncada')
+    magic, version, flags, n, t0 = _CABECERA.unpack_from(datos)
+    if magic != MAGIC or version not in _VERSIONES:
+        raise FormatoPistaInvalido('Formato de pista desconocido')
+
+    try:
+        crudo = zlib.decompress(datos[_CABECERA.size:])
+    except zlib.error as e:
+        raise FormatoPistaInvalido(f'Pista corrupta: {e}')
+
+    # En la version 1 el tiempo va con los demas arrays en int32
+    con_tiempo = bool(flags & _CON_TIEMPO)
+    tiempo_int64 = con_tiempo and version >= 2
+    num_arrays = 2 + bool(flags & _CON_ELE) + (con_tiempo and not tiempo_int64)
+    tam_mascara = (n + 7) // 8
+    esperado = num_arrays * 4 * n + tiempo_int64 * 8 * n
+    esperado += tam_mascara * (bool(flags & _MASCARA_ELE) + bool(flags & _MASCARA_TIEMPO))
+    if len(crudo) != esperado:
+        raise FormatoPistaInvalido('Pista con longitud inesperada')
+
+    arrays = np.frombuffer(crudo, dtype=np.int32, count=num_arrays * n).reshape(num_arrays, n)
+    desplazamiento = num_arrays * 4 * n
+    if tiempo_int64:
+        deltas_tiempo = np.frombuffer(crudo, dtype=np.int64, count=n, offset=desplazamiento)
+        desplazamiento += 8 * n
+
+    def leer_mascara():
+        nonlocal desplazamiento
+        bits = np.frombuffer(crudo, dtype=np.uint8, count=tam_mascara, offset=desplazamiento)
+        desplazamiento += tam_mascara
+        return np.unpackbits(bits, count=n).astype(bool)
+
+    acumulado = np.cumsum(arrays, axis=1, dtype=np.int32)
+    lat = acumulado[0] / ESCALA_GRADOS
+    lon = acumulado[1] / ESCALA_GRADOS
+    fila = 2
+
+    ele = None
+    if flags & _CON_ELE:
+        ele = acumulado[fila].astype(np.float32) / ESCALA_ELE
+        fila += 1
+        if flags & _MASCARA_ELE:
+            ele[~leer_mascara()] = np.nan
+
+    tiempo = None
+    if con_tiempo:
+        if tiempo_int64:
+            relativo = np.cumsum(deltas_tiempo, dtype=np.int64)
+        else:
+            relativo = acumulado[fila].astype(np.int64)
+        tiempo = (relativo + t0).astype('datetime64[ms]')
+        if flags & _MASCARA_TIEMPO:
+            tiempo[~leer_mascara()] = np.datetime64('NaT')
+
+    return Pista(lat, lon, ele, tiempo)
+
+
+def _tiempo_a_ms(valor):
+    if not valor:
+        return np.nan
+    instante = datetime.datetime.fromisoformat(valor.replace('Z', '+00:00'))
+    if instante.tzinfo is None:
+        instante = instante.replace(tzinfo=datetime.timezone.utc)
+    return instante.timestamp() * 1000
+
+
+def arrays_desde_puntos_json(puntos):
+    """
+    Arrays (lat, lon, ele, tiempo_ms) del formato antiguo: lista de
+    {"lat","lon","ele","time"}.
+    """
+    lat = np.array([p['lat'] for p in puntos], dtype=np.float64)
+    lon = np.array([p['lon'] for p in puntos], dtype=np.float64)
+    ele = np.array([np.nan if p.get('ele') is None else p['ele'] for p in puntos], dtype=np.float64)
+    tiempo = np.array([_tiempo_a_ms(p.get('time')) for p in puntos], dtype=np.float64)
+    return lat, lon, ele, tiempo
+
+
+def codificar_puntos_json(puntos):
+    return codificar_pista(*arrays_desde_puntos_json(puntos))
+
+
+def arrays_de_pista(pista):
+    """
+    Inverso de decodificar_pista: arrays listos para codificar_pista.
+    """
+    n = len(pista.lat)
+    ele = pista.ele.astype(np.float64) if pista.ele is not None else np.full(n, np.nan)
+    if pista.tiempo is not None:
+        tiempo = pista.tiempo.astype(np.int64).astype(np.float64)
+        tiempo[np.isnat(pista.tiempo)] = np.nan
+    else:
+        tiempo = np.full(n, np.nan)
+    return pista.lat, pista.lon, ele, tiempo
+
+
+def puntos_json(pista):
+    """
+    Convierte una Pista a la lista de dicts que espera la app.
+    """
+    return list(iterar_puntos_json(pista))
+
+
+def iterar_puntos_json(pista):
+    """
+    Como puntos_json pero generando los dicts de uno en uno, para poder
+    enviar la pista por trozos sin tenerla entera en memoria como JSON.
+    """
+    n = len(pista.lat)
+    lats = pista.lat.tolist()
+    lons = pista.lon.tolist()
+    eles = [None] * n
+    if pista.ele is not None:
+        eles = [None if e != e else round(e, 1) for e in pista.ele.tolist()]
+    tiempos = [None] * n
+    if pista.tiempo is not None:
+        ms = pista.tiempo.astype(np.int64).tolist()
+        nat = np.isnat(pista.tiempo).tolist()
+        tiempos = [
+            None if vacio else
+            datetime.datetime.fromtimestamp(t / 1000, datetime.timezone.utc).isoformat()
+            for t, vacio in zip(ms, nat)
+        ]
+    for la, lo, e, t in zip(lats, lons, eles, tiempos):
+        yield {'lat': la, 'lon': lo, 'ele': e, 'time': t}
+
+
+# ----------------------
+# NIVELES DE DETALLE
+# ----------------------
+RADIO_TIERRA_M = 6_371_000.0
+
+# (nivel, tolerancia en metros); el nivel 0 es siempre la pista completa
+NIVELES_DETALLE = ((1, 2.0), (2, 8.0), (3, 32.0), (4, 128.0))
+
+
+def proyectar_metros(lat, lon):
+    """
+    Proyeccion equirectangular local: suficiente para distancias cortas.
+    """
+    lat0 = np.radians(np.mean(lat)) if len(lat) else 0.0
+    x = np.radians(lon) * RADIO_TIERRA_M * np.cos(lat0)
+    y = np.radians(lat) * RADIO_TIERRA_M
+    return x, y
+
+
+def douglas_peucker(x, y, tolerancia):
+    """
+    Indices de los puntos que conserva Douglas-Peucker. Iterativo con pila
+    y con las distancias de cada tramo calculadas de golpe en NumPy.
+    """
+    n = len(x)
+    if n <= 2:
+        return np.arange(n)
+
+    conservar = np.zeros(n, dtype=bool)
+    conservar[0] = conservar[-1] = True
+    pila = [(0, n - 1)]
+    while pila:
+        i, j = pila.pop()
+        if j - i < 2:
+            continue
+        xs, ys = x[i + 1:j], y[i + 1:j]
+        dx, dy = x[j] - x[i], y[j] - y[i]
+        longitud2 = dx * dx + dy * dy
+        if longitud2 > 0:
+            # Distancia al segmento (no a la recta) para soportar ida y vuelta
+            t = np.clip(((xs - x[i]) * dx + (ys - y[i]) * dy) / longitud2, 0.0, 1.0)
+            distancias = np.hypot(xs - (x[i] + t * dx), ys - (y[i] + t * dy))
+        else:
+            distancias = np.hypot(xs - x[i], ys - y[i])
+        k = int(np.argmax(distancias))
+        if distancias[k] > tolerancia:
+            medio = i + 1 + k
+            conservar[medio] = True
+            pila.append((i, medio))
+            pila.append((medio, j))
+
+    return np.flatnonzero(conservar)
+
+
+def generar_niveles(lat, lon, ele, tiempo_ms):
+    """
+    Devuelve [(nivel, tolerancia, num_puntos, datos)] con cada nivel de
+    detalle ya codificado. Se omiten los niveles que no reducen la pista.
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    x, y = proyectar_metros(lat, lon)
+    niveles = []
+    anterior = len(lat)
+    for nivel, tolerancia in NIVELES_DETALLE:
+        indices = douglas_peucker(x, y, tolerancia)
+        if len(indices) >= anterior:
+            continue
+        anterior = len(indices)
+        datos = codificar_pista(
+            lat[indices], lon[indices],
+            None if ele is None else np.asarray(ele)[indices],
+            None if tiempo_ms is None else np.asarray(tiempo_ms)[indices],
+        )
+        niveles.append((nivel, tolerancia, len(indices), datos))
+    return niveles
+
+
+def metros_por_pixel(zoom):
+    # Teselas web mercator de 256 px, medido en el ecuador
+    return 156543.03392 / (2 ** zoom)
+
+
+# ----------------------
+# ESTADISTICAS
+# ----------------------
+VELOCIDAD_MINIMA_MOVIMIENTO = 0.5  # m/s; por debajo se considera parado
+VENTANA_ELEVACION = 5               # puntos para suavizar el ruido del altimetro
+VENTANA_VELOCIDAD = 5               # puntos para evitar picos de velocidad
+# m/s (~360 km/h); por encima es un salto del GPS, no un desplazamiento
+VELOCIDAD_MAXIMA_PLAUSIBLE = 100.0
+
+Estadisticas = namedtuple('Estadisticas', [
+    'distancia_m', 'duracion_s', 'tiempo_movimiento_s', 'desnivel_positivo_m',
+    'desnivel_negativo_m', 'velocidad_max_ms', 'velocidad_media_ms', 'parciales_km',
+])
+
+
+def distancias_haversine(lat, lon):
+    """
+    Distancia en metros entre cada par de puntos consecutivos.
+    """
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+    dlat = np.diff(lat)
+    dlon = np.diff(lon)
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(dlon / 2) ** 2
+    return 2 * RADIO_TIERRA_M * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def _desnivel(ele):
+    ele = ele[~np.isnan(ele)]
+    if len(ele) < 2:
+        return 0.0, 0.0
+    if len(ele) >= VENTANA_ELEVACION:
+        ele = np.convolve(ele, np.ones(VENTANA_ELEVACION) / VENTANA_ELEVACION, mode='valid')
+    cambios = np.diff(ele)
+    return float(cambios[cambios > 0].sum()), float(np.abs(cambios[cambios < 0].sum()))
+
+
+def calcular_estadisticas(lat, lon, ele=None, tiempo_ms=None):
+    """
+    Distancia, tiempos, desnivel, velocidades y parciales por kilometro.
+    Los valores que dependen del tiempo son None si la pista no lo tiene.
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    if len(lat) < 2:
+        return Estadisticas(0.0, None, None, 0.0, 0.0, None, None, [])
+
+    tramos = distancias_haversine(lat, lon)
+    acumulada = np.concatenate(([0.0], np.cumsum(tramos)))
+    distancia = float(acumulada[-1])
+
+    subida, bajada = (0.0, 0.0) if ele is None else _desnivel(np.asarray(ele, dtype=np.float64))
+
+    duracion = movimiento = vel_max = vel_media = None
+    parciales = []
+    if tiempo_ms is not None:
+        tiempo = np.asarray(tiempo_ms, dtype=np.float64)
+        validos = ~np.isnan(tiempo)
+        if validos.sum() >= 2:
+            t = tiempo[validos] / 1000.0
+            d = acumulada[validos]
+            duracion = float(t[-1] - t[0])
+
+            dt = np.diff(t)
+            dd = np.diff(d)
+            en_marcha = (dt > 0) & (dd >= VELOCIDAD_MINIMA_MOVIMIENTO * np.where(dt > 0, dt, 0))
+            movimiento = float(dt[en_marcha].sum())
+            vel_media = min(distancia / movimiento, VELOCIDAD_MAXIMA_PLAUSIBLE) if movimiento > 0 else 0.0
+
+            k = min(VENTANA_VELOCIDAD, len(t) - 1)
+            dt_ventana = t[k:] - t[:-k]
+            dd_ventana = d[k:] - d[:-k]
+            con_tiempo = dt_ventana > 0
+            velocidades = dd_ventana[con_tiempo] / dt_ventana[con_tiempo]
+            # Los saltos que sobreviven al suavizado se descartan
+            velocidades = velocidades[velocidades <= VELOCIDAD_MAXIMA_PLAUSIBLE]
+            vel_max = float(velocidades.max()) if len(velocidades) else 0.0
+
+            # Instante de paso por cada kilometro interpolando en la distancia
+            marcas = np.arange(1000.0, d[-1] + 1e-9, 1000.0)
+            if len(marcas):
+                creciente = np.concatenate(([True], np.diff(d) > 0))
+                pasos = np.interp(marcas, d[creciente], t[creciente])
+                parciales = np.diff(np.concatenate(([t[0]], pasos))).round(1).tolist()
+
+    return Estadisticas(
+        distancia, duracion, movimiento, subida, bajada, vel_max, vel_media, parciales,
+    )
+
+
+# ----------------------
+# LECTURA INCREMENTAL DE GPX
+# ----------------------
+GPX_TAMAÑO_BLOQUE = 64 * 1024
+
+
+def _fecha_gpx_a_ms(texto):
+    texto = texto.strip()
+    if texto.endswith('Z'):
+        texto = texto[:-1] + '+00:00'
+    instante = datetime.datetime.fromisoformat(texto)
+    if instante.tzinfo is None:
+        instante = instante.replace(tzinfo=datetime.timezone.utc)
+    return instante.timestamp() * 1000
+
+
+def leer_gpx(flujo, max_puntos):
+    """
+    Lee los <trkpt> de un GPX a medida que llegan los bytes, sin construir
+    el arbol XML, directamente a buffers numericos. Devuelve arrays de NumPy
+    (lat, lon, ele, tiempo_ms) con NaN donde falte ele/tiempo.
+
+    Lanza GPXInvalido si el XML esta mal formado, faltan coordenadas, no hay
+    puntos o se supera max_puntos.
+    """
+    lat, lon, ele, tiempo = array('d'), array('d'), array('d'), array('d')
+    estado = {'en_punto': False, 'campo': None, 'texto': []}
+    nan = float('nan')
+
+    def nombre_local(nombre):
+        return nombre.rsplit('}', 1)[-1]
+
+    def inicio(nombre, atributos):
+        local = nombre_local(nombre)
+        if local == 'trkpt':
+            n = len(lat) + 1
+            if n > max_puntos:
+                raise GPXInvalido(f'La pista supera el máximo de {max_puntos} puntos')
+            try:
+                lat.append(float(atributos['lat']))
+                lon.append(float(atributos['lon']))
+            except (KeyError, ValueError):
+                raise GPXInvalido(f'El punto {n} no tiene lat/lon válidos')
+            ele.append(nan)
+            tiempo.append(nan)
+            estado['en_punto'] = True
+        elif estado['en_punto'] and local in ('ele', 'time'):
+            estado['campo'] = local
+            estado['texto'] = []
+
+    def texto(datos):
+        if estado['campo']:
+            estado['texto'].append(datos)
+
+    def fin(nombre):
+        local = nombre_local(nombre)
+        if local == 'trkpt':
+            estado['en_punto'] = False
+        elif estado['campo'] == local:
+            valor = ''.join(estado['texto'])
+            estado['campo'] = None
+            try:
+                if local == 'ele':
+                    ele[-1] = float(valor)
+                else:
+                    tiempo[-1] = _fecha_gpx_a_ms(valor)
+            except ValueError:
+                raise GPXInvalido(f'Valor de <{local}> inválido en el punto {len(lat)}: {valor.strip()!r}')
+
+    def entidad(*args):
+        raise GPXInvalido('El GPX no puede declarar entidades')
+
+    parser = expat.ParserCreate(namespace_separator='}')
+    parser.StartElementHandler = inicio
+    parser.EndElementHandler = fin
+    parser.CharacterDataHandler = texto
+    parser.EntityDeclHandler = entidad
+    parser.SetParamEntityParsing(expat.XML_PARAM_ENTITY_PARSING_NEVER)
+
+    try:
+        while True:
+            bloque = flujo.read(GPX_TAMAÑO_BLOQUE)
+            if not bloque:
+                break
+            parser.Parse(bloque, False)
+        parser.Parse(b'', True)
+    except expat.ExpatError as e:
+        raise GPXInvalido(f'GPX mal formado (línea {e.lineno}): {expat.ErrorString(e.code)}')
+
+    if not lat:
+        raise GPXInvalido('El GPX no contiene puntos de recorrido')
+
+    return (
+        np.frombuffer(lat, dtype=np.float64),
+        np.frombuffer(lon, dtype=np.float64),
+        np.frombuffer(ele, dtype=np.float64),
+        np.frombuffer(tiempo, dtype=np.float64),
+    )
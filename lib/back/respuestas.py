@@ -0,0 +1,86 @@
+import gzip
+import json
+import zlib
+
+import brotli
+
+
+# Por debajo de este tamaño comprimir cuesta mas de lo que ahorra
+UMBRAL_COMPRESION = 1024  # bytes
+# Elementos serializados por cada trozo de una respuesta en streaming
+TAM_TROZO = 500
+
+CODIFICACIONES = ('br', 'gzip')
+
+
+def elegir_codificacion(aceptadas):
+    """
+    Devuelve 'br', 'gzip' o None segun la cabecera Accept-Encoding
+    (request.accept_encodings). Con la misma calidad se prefiere brotli.
+    """
+    return aceptadas.best_match(CODIFICACIONES)
+
+
+def comprimir(datos, codificacion, maxima=False):
+    """
+    Comprime un cuerpo completo. `maxima` usa el nivel mas alto: solo
+    compensa para respuestas que se comprimen una vez y se sirven muchas.
+    """
+    if codificacion == 'br':
+        return brotli.compress(datos, quality=11 if maxima else 5)
+    if codificacion == 'gzip':
+        return gzip.compress(datos, compresslevel=9 if maxima else 6)
+    return datos
+
+
+def comprimir_flujo(trozos, codificacion):
+    """
+    Comprime al vuelo una secuencia de trozos de bytes.
+    """
+    if codificacion == 'br':
+        compresor = brotli.Compressor(quality=5)
+        for trozo in trozos:
+            salida = compresor.process(trozo)
+            if salida:
+                yield salida
+        yield compresor.finish()
+    elif codificacion == 'gzip':
+        compresor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for trozo in trozos:
+            salida = compresor.compress(trozo)
+            if salida:
+                yield salida
+        yield compresor.flush()
+    else:
+        yield from trozos
+
+
+def _lotes(elementos, tam_trozo):
+    lote = []
+    for elemento in elementos:
+        lote.append(elemento)
+        if len(lote) == tam_trozo:
+            yield lote
+            lote = []
+    if lote:
+        yield lote
+
+
+def trozos_json(elementos, ndjson=False, tam_trozo=TAM_TROZO):
+    """
+    Serializa `elementos` por trozos: como un unico array JSON o, con
+    `ndjson`, un objeto por linea.
+    """
+    def volcar(elemento):
+        return json.dumps(elemento, ensure_ascii=False, separators=(',', ':'))
+
+    if ndjson:
+        for lote in _lotes(elementos, tam_trozo):
+            yield ''.join(volcar(e) + '\n' for e in lote).encode('utf-8')
+        return
+
+    separador = '['
+    for lote in _lotes(elementos, tam_trozo):
+        yield (separador + ','.join(volcar(e) for e in lote)).encode('utf-8')
+        separador = ','
+    yield b'[]' if separador == '[' else b']'
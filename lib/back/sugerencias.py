@@ -0,0 +1,62 @@
+import math
+from collections import Counter
+
+# Cuanto suma cada amigo en comun y cada zona en la que entrenan los dos
+PESO_AMIGO_COMUN = 10
+PESO_ZONA_COMUN = 3
+# Zonas: celdas de la rejilla de salidas de actividades (~11 km de lado)
+TAM_CELDA_GRADOS = 0.1
+# Un usuario con mas amigos que esto no cuenta como amigo en comun: sus
+# amigos no se conocen entre si y recorrerlos es lo mas caro
+MAX_AMIGOS_INTERMEDIO = 5000
+
+
+def celda(lat, lon):
+    return math.floor(lat / TAM_CELDA_GRADOS), math.floor(lon / TAM_CELDA_GRADOS)
+
+
+def puntuacion(amigos_comunes, zonas_comunes):
+    return amigos_comunes * PESO_AMIGO_COMUN + zonas_comunes * PESO_ZONA_COMUN
+
+
+def calcular_candidatos(usuario_id, amigos, zonas, maximo):
+    """
+    Amigos de amigos de `usuario_id` que aun no son amigos suyos, de mayor
+    a menor puntuacion. `amigos` y `zonas` son diccionarios usuario -> set
+    (de amigos y de celdas). Devuelve como mucho `maximo` tuplas
+    (candidato, amigos_comunes, zonas_comunes, puntuacion).
+    """
+    propios = amigos.get(usuario_id, set())
+    comunes = Counter()
+    for amigo in propios:
+        suyos = amigos.get(amigo, ())
+        if len(suyos) > MAX_AMIGOS_INTERMEDIO:
+            continue
+        for candidato in suyos:
+            if candidato != usuario_id and candidato not in propios:
+                comunes[candidato] += 1
+
+    mis_zonas = zonas.get(usuario_id, set())
+    candidatos = []
+    for candidato, n in comunes.items():
+        z = len(mis_zonas & zonas.get(candidato, set()))
+        candidatos.append((candidato, n, z, puntuacion(n, z)))
+    candidatos.sort(key=lambda c: (-c[3], c[0]))
+    return candidatos[:maximo]
+
+
+def nuevos_amigos_de_amigos(usuario_a, amigos_a, usuario_b, amigos_b):
+    """
+    Al hacerse amigos a y b, los amigos de cada uno pasan a tener al otro
+    como amigo de un amigo (y al reves). Devuelve los pares (usuario,
+    candidato) que ganan un amigo en comun.
+    """
+    pares = []
+    for nuevo, suyos, otros in ((usuario_b, amigos_b, amigos_a), (usuario_a, amigos_a, amigos_b)):
+        if len(otros) > MAX_AMIGOS_INTERMEDIO:
+            continue
+        for amigo in otros:
+            if amigo != nuevo and amigo not in suyos:
+                pares.append((amigo, nuevo))
+                pares.append((nuevo, amigo))
+    return pares
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Los modulos del backend se importan por nombre, como hace apis.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
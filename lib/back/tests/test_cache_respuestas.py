@@ -0,0 +1,138 @@
+import pytest
+
+import cache_respuestas
+from cache_respuestas import CacheRespuestas
+
+
+@pytest.fixture
+def reloj(monkeypatch):
+    """
+    Reloj monotono controlado por la prueba: reloj.ahora += segundos.
+    """
+    class Reloj:
+        ahora = 1000.0
+
+    monkeypatch.setattr(cache_respuestas.time, 'monotonic', lambda: Reloj.ahora)
+    return Reloj
+
+
+def test_guardar_y_obtener():
+    cache = CacheRespuestas()
+    cache.guardar('a', b'uno', 3)
+    assert cache.obtener('a') == b'uno'
+    assert cache.obtener('b') is None
+
+
+def test_caduca_tras_el_ttl(reloj):
+    cache = CacheRespuestas(ttl=60)
+    cache.guardar('a', b'uno', 3)
+
+    reloj.ahora += 60
+    assert cache.obtener('a') == b'uno'
+    reloj.ahora += 1
+    assert cache.obtener('a') is None
+    assert len(cache) == 0
+
+
+def test_expulsa_la_menos_usada_por_numero_de_entradas():
+    cache = CacheRespuestas(max_entradas=2)
+    cache.guardar('a', 1, 1)
+    cache.guardar('b', 2, 1)
+    cache.obtener('a')
+    cache.guardar('c', 3, 1)
+
+    assert cache.obtener('b') is None
+    assert cache.obtener('a') == 1
+    assert cache.obtener('c') == 3
+
+
+def test_expulsa_por_bytes():
+    cache = CacheRespuestas(max_bytes=10)
+    cache.guardar('a', 1, 4)
+    cache.guardar('b', 2, 4)
+    cache.guardar('c', 3, 4)
+
+    assert cache.obtener('a') is None
+    assert len(cache) == 2
+
+
+def test_no_guarda_lo_que_no_cabe():
+    cache = CacheRespuestas(max_bytes=10)
+    cache.guardar('a', 1, 4)
+    cache.guardar('grande', 2, 11)
+
+    assert cache.obtener('grande') is None
+    assert cache.obtener('a') == 1
+
+
+def test_reemplazar_no_cuenta_dos_veces_los_bytes():
+    cache = CacheRespuestas(max_bytes=10)
+    cache.guardar('a', 1, 6)
+    cache.guardar('a', 2, 6)
+
+    assert cache.obtener('a') == 2
+    assert cache._bytes == 6
+
+
+def test_invalidar_por_etiqueta():
+    cache = CacheRespuestas()
+    cache.guardar('feed:1', 1, 1, {('feed', 1), ('publicacion', 42)})
+    cache.guardar('feed:2', 2, 1, {('feed', 2), ('publicacion', 43)})
+
+    cache.invalidar(('publicacion', 42))
+
+    assert cache.obtener('feed:1') is None
+    assert cache.obtener('feed:2') == 2
+    assert ('feed', 1) not in cache._por_etiqueta
+
+
+def test_no_guarda_respuestas_calculadas_antes_de_invalidar():
+    cache = CacheRespuestas()
+    generacion = cache.generacion
+    cache.invalidar(('perfil', 7))
+
+    cache.guardar('perfil:7', 1, 1, {('perfil', 7)}, generacion)
+    assert cache.obtener('perfil:7') is None
+
+    cache.guardar('perfil:7', 1, 1, {('perfil', 7)}, cache.generacion)
+    assert cache.obtener('perfil:7') == 1
+
+
+def test_limpiar():
+    cache = CacheRespuestas()
+    cache.guardar('a', 1, 1, {('feed', 1)})
+    generacion = cache.generacion
+    cache.limpiar()
+
+    assert len(cache) == 0
+    assert cache.generacion != generacion
+
+
+def test_crecer_cuenta_los_bytes_añadidos_y_expulsa():
+    cache = CacheRespuestas(max_bytes=10)
+    cache.guardar('a', {}, 4)
+    cache.guardar('b', {}, 4)
+    cache.obtener('a')
+
+    cache.crecer('a', 2)
+    assert cache._bytes == 10
+    assert len(cache) == 2
+
+    cache.crecer('a', 1)
+    assert cache.obtener('b') is None
+    assert cache._bytes == 7
+
+
+def test_crecer_una_entrada_que_ya_no_esta():
+    cache = CacheRespuestas()
+    cache.crecer('a', 100)
+    assert cache._bytes == 0
+    assert len(cache) == 0
+
+
+def test_quitar_descuenta_lo_que_crecio():
+    cache = CacheRespuestas()
+    cache.guardar('a', {}, 4, {('feed', 1)})
+    cache.crecer('a', 3)
+    cache.invalidar(('feed', 1))
+    assert cache._bytes == 0
@@ -0,0 +1,126 @@
+import pytest
+
+from contadores import ContadoresPendientes
+
+
+class ConexionFalsa:
+    def __init__(self):
+        self.commits = 0
+
+    @property
+    def connection(self):
+        return self
+
+    def commit(self):
+        self.commits += 1
+
+
+class CursorFalso:
+    """
+    Guarda los executemany; `al_ejecutar` simula lo que pasa mientras
+    MySQL aplica el UPDATE.
+    """
+
+    def __init__(self, al_ejecutar=None):
+        self.lotes = []
+        self.al_ejecutar = al_ejecutar
+
+    def executemany(self, consulta, filas):
+        if self.al_ejecutar:
+            self.al_ejecutar()
+        self.lotes.append(sorted(filas, key=lambda fila: fila[2]))
+
+
+class CacheFalsa:
+    def __init__(self):
+        self.invalidadas = []
+
+    def invalidar(self, *etiquetas):
+        self.invalidadas.extend(etiquetas)
+
+
+@pytest.fixture
+def mysql():
+    return ConexionFalsa()
+
+
+@pytest.fixture
+def cache():
+    return CacheFalsa()
+
+
+@pytest.fixture
+def contadores(mysql, cache):
+    # Intervalo largo: el hilo de volcado no llega a despertar en la prueba
+    return ContadoresPendientes(None, mysql, cache, intervalo=3600)
+
+
+def test_sumar_acumula_por_publicacion(contadores):
+    contadores.sumar(1, likes=1)
+    contadores.sumar(1, likes=1, comentarios=1)
+    contadores.sumar(2, likes=-1)
+
+    assert contadores.pendientes(1) == (2, 1)
+    assert contadores.pendientes(2) == (-1, 0)
+    assert contadores.pendientes(3) == (0, 0)
+
+
+def test_volcar_aplica_los_incrementos_e_invalida(contadores, mysql, cache):
+    contadores.sumar(1, likes=2)
+    contadores.sumar(2, comentarios=1)
+    contadores.sumar(3, likes=1)
+    contadores.sumar(3, likes=-1)
+    cur = CursorFalso()
+
+    assert contadores.volcar(cur) == 2
+
+    assert cur.lotes == [[(2, 0, 1), (0, 1, 2)]]
+    assert mysql.commits == 1
+    assert sorted(cache.invalidadas) == [('publicacion', 1), ('publicacion', 2)]
+    assert contadores.pendientes(1) == (0, 0)
+    assert contadores.volcar(CursorFalso()) == 0
+    assert mysql.commits == 1
+
+
+def test_los_incrementos_en_vuelo_siguen_contando(contadores):
+    contadores.sumar(1, likes=2)
+    vistos = []
+
+    def durante_el_update():
+        # Antes del commit lo volcado aun no se lee de MySQL
+        vistos.append(contadores.pendientes(1))
+        contadores.sumar(1, likes=1)
+        vistos.append(contadores.pendientes(1))
+
+    contadores.volcar(CursorFalso(durante_el_update))
+
+    assert vistos == [(2, 0), (3, 0)]
+    # Tras el commit solo queda lo que llego durante el volcado
+    assert contadores.pendientes(1) == (1, 0)
+
+
+def test_un_volcado_fallido_devuelve_los_incrementos(contadores, mysql, cache):
+    contadores.sumar(1, likes=2)
+
+    def falla():
+        contadores.sumar(1, comentarios=1)
+        raise RuntimeError('MySQL caido')
+
+    with pytest.raises(RuntimeError):
+        contadores.volcar(CursorFalso(falla))
+
+    assert contadores.pendientes(1) == (2, 1)
+    assert mysql.commits == 0
+    assert cache.invalidadas == []
+
+    cur = CursorFalso()
+    contadores.volcar(cur)
+    assert cur.lotes == [[(2, 1, 1)]]
+
+
+def test_descartar(contadores):
+    contadores.sumar(1, likes=1)
+    contadores.descartar(1)
+
+    assert contadores.pendientes(1) == (0, 0)
+    assert contadores.volcar(CursorFalso()) == 0
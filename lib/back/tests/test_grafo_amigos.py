@@ -0,0 +1,92 @@
+import grafo_amigos
+from grafo_amigos import GrafoAmistades
+
+
+class Amistades:
+    """
+    Fuente de datos falsa: cuenta cuantas veces se consulta cada usuario.
+    """
+
+    def __init__(self, pares):
+        self.amigos = {}
+        for a, b in pares:
+            self.amigos.setdefault(a, set()).add(b)
+            self.amigos.setdefault(b, set()).add(a)
+        self.cargas = []
+
+    def __call__(self, usuario_id):
+        self.cargas.append(usuario_id)
+        return list(self.amigos.get(usuario_id, ()))
+
+
+def test_amigos_ordenados_y_cargados_una_vez():
+    fuente = Amistades([(1, 5), (1, 3), (1, 9)])
+    grafo = GrafoAmistades(fuente)
+
+    assert list(grafo.amigos(1)) == [3, 5, 9]
+    assert list(grafo.amigos('1')) == [3, 5, 9]
+    assert fuente.cargas == [1]
+
+
+def test_son_amigos_y_mutuos():
+    grafo = GrafoAmistades(Amistades([(1, 2), (1, 3), (1, 4), (5, 3), (5, 4), (5, 6)]))
+
+    assert grafo.son_amigos(1, 2)
+    assert not grafo.son_amigos(1, 5)
+    assert grafo.mutuos(1, 5) == [3, 4]
+
+
+def test_agregar_y_quitar_actualizan_los_dos_lados():
+    grafo = GrafoAmistades(Amistades([(1, 2)]))
+    grafo.amigos(1), grafo.amigos(3)
+
+    grafo.agregar(1, 3)
+    assert grafo.son_amigos(1, 3) and grafo.son_amigos(3, 1)
+
+    grafo.quitar(1, 2)
+    assert list(grafo.amigos(1)) == [3]
+
+
+def test_agregar_no_cambia_el_array_ya_entregado():
+    grafo = GrafoAmistades(Amistades([(1, 2)]))
+    antes = grafo.amigos(1)
+
+    grafo.agregar(1, 3)
+
+    assert list(antes) == [2]
+    assert list(grafo.amigos(1)) == [2, 3]
+
+
+def test_olvidar_quita_al_usuario_de_sus_amigos():
+    grafo = GrafoAmistades(Amistades([(1, 2), (2, 3)]))
+    grafo.amigos(1), grafo.amigos(2)
+
+    grafo.olvidar(2)
+
+    assert list(grafo.amigos(1)) == []
+
+
+def test_expulsa_al_menos_usado():
+    fuente = Amistades([(1, 2), (3, 4), (5, 6)])
+    grafo = GrafoAmistades(fuente, max_usuarios=2)
+    grafo.amigos(1), grafo.amigos(3)
+    grafo.amigos(1)
+    grafo.amigos(5)
+
+    assert len(grafo) == 2
+    grafo.amigos(1)
+    grafo.amigos(3)
+    assert fuente.cargas == [1, 3, 5, 3]
+
+
+def test_caduca_tras_el_ttl(monkeypatch):
+    ahora = [100.0]
+    monkeypatch.setattr(grafo_amigos.time, 'monotonic', lambda: ahora[0])
+    fuente = Amistades([(1, 2)])
+    grafo = GrafoAmistades(fuente, ttl=10)
+
+    grafo.amigos(1)
+    ahora[0] += 11
+    grafo.amigos(1)
+
+    assert fuente.cargas == [1, 1]
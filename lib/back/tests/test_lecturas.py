@@ -0,0 +1,27 @@
+import itertools
+
+import pytest
+
+from lecturas import marca_lectura
+
+
+@pytest.mark.parametrize('leido_hasta, ultimo_id, hasta_id, esperado', [
+    (0, 10, None, 10),
+    (3, 10, 7, 7),
+    (3, 10, 50, 10),
+    (7, 10, 3, 7),  # confirmacion antigua que llega tarde
+    (7, 10, 7, 7),
+    (10, 10, None, 10),
+])
+def test_marca_lectura(leido_hasta, ultimo_id, hasta_id, esperado):
+    assert marca_lectura(leido_hasta, ultimo_id, hasta_id) == esperado
+
+
+def test_la_marca_nunca_retrocede():
+    # Confirmaciones en cualquier orden mientras llegan mensajes nuevos
+    for confirmaciones in itertools.permutations([None, 2, 5, 9, 14]):
+        marca = 0
+        for ultimo_id, hasta_id in zip([4, 8, 12, 16, 20], confirmaciones):
+            nueva = marca_lectura(marca, ultimo_id, hasta_id)
+            assert marca <= nueva <= max(marca, ultimo_id)
+            marca = nueva
@@ -0,0 +1,63 @@
+import datetime
+
+import pytest
+
+from paginacion import codificar_cursor, decodificar_cursor, leer_limite, leer_id
+
+
+def test_cursor_ida_y_vuelta():
+    fecha = datetime.datetime(2026, 10, 18, 17, 30, 5)
+    cursor = codificar_cursor(fecha, 42)
+
+    assert decodificar_cursor(cursor) == (fecha, 42)
+
+
+def test_cursor_descarta_los_microsegundos():
+    fecha = datetime.datetime(2026, 10, 18, 17, 30, 5, 123456)
+    assert decodificar_cursor(codificar_cursor(fecha, 1)) == (fecha.replace(microsecond=0), 1)
+
+
+@pytest.mark.parametrize('cursor', [
+    '',
+    'no es base64!',
+    codificar_cursor(datetime.datetime(2026, 1, 1), 'x'),
+    'MjAyNi0xMC0xOA==',  # '2026-10-18' sin id
+    'w6k=',  # 'é': ni fecha ni id
+])
+def test_cursor_invalido(cursor):
+    with pytest.raises(ValueError):
+        decodificar_cursor(cursor)
+
+
+@pytest.mark.parametrize('valor, esperado', [
+    (None, 20),
+    ('50', 50),
+    (50, 50),
+    ('1000', 100),
+    ('0', 1),
+    ('-5', 1),
+    ('diez', 20),
+    ('', 20),
+    ([], 20),
+    ({'limite': 5}, 20),
+    (7.9, 7),
+])
+def test_leer_limite(valor, esperado):
+    assert leer_limite(valor, 20, 100) == esperado
+
+
+@pytest.mark.parametrize('valor, esperado', [
+    (7, 7),
+    ('7', 7),
+    ('007', 7),
+    (True, None),
+    (None, None),
+    ('', None),
+    ('-7', None),
+    ('7.0', None),
+    (7.0, None),
+    ('²', None),
+    ('①', None),
+])
+def test_leer_id(valor, esperado):
+    assert leer_id(valor) == esperado
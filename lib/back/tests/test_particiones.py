@@ -0,0 +1,103 @@
+import datetime
+
+import pytest
+
+from particiones import (
+    inicio_mes, sumar_meses, nombre_particion, crear_particiones, archivar_particiones,
+    PARTICION_FUTURO
+)
+
+
+def ts(anio, mes):
+    return int(datetime.datetime(anio, mes, 1, tzinfo=datetime.timezone.utc).timestamp())
+
+
+class CursorFalso:
+    """
+    Responde a las consultas de particiones.py con una lista de particiones
+    [(nombre, limite)] y FROM_UNIXTIME/UNIX_TIMESTAMP en UTC.
+    """
+
+    def __init__(self, particiones, filas_copiadas=0):
+        self.particiones = particiones
+        self.rowcount = filas_copiadas
+        self.consultas = []
+        self._resultado = None
+
+    def execute(self, consulta, args=()):
+        consulta = ' '.join(consulta.split())
+        self.consultas.append(consulta)
+        if 'information_schema.PARTITIONS' in consulta:
+            self._resultado = [(nombre, 'MAXVALUE' if limite is None else str(limite))
+                               for nombre, limite in self.particiones]
+        elif consulta.startswith('SELECT FROM_UNIXTIME'):
+            fecha = datetime.datetime.fromtimestamp(args[0], datetime.timezone.utc)
+            self._resultado = [(fecha.replace(tzinfo=None),)]
+        elif consulta.startswith('SELECT UNIX_TIMESTAMP'):
+            self._resultado = [(int(args[0].replace(tzinfo=datetime.timezone.utc).timestamp()),)]
+
+    def fetchall(self):
+        return self._resultado
+
+    def fetchone(self):
+        return self._resultado[0]
+
+
+def test_inicio_mes():
+    assert inicio_mes(datetime.datetime(2026, 10, 18, 17, 30)) == datetime.datetime(2026, 10, 1)
+
+
+@pytest.mark.parametrize('fecha, meses, esperado', [
+    (datetime.datetime(2026, 10, 18), 0, datetime.datetime(2026, 10, 1)),
+    (datetime.datetime(2026, 10, 18), 3, datetime.datetime(2027, 1, 1)),
+    (datetime.datetime(2026, 12, 31), 1, datetime.datetime(2027, 1, 1)),
+    (datetime.datetime(2026, 1, 1), -1, datetime.datetime(2025, 12, 1)),
+    (datetime.datetime(2026, 3, 31), -14, datetime.datetime(2025, 1, 1)),
+])
+def test_sumar_meses(fecha, meses, esperado):
+    assert sumar_meses(fecha, meses) == esperado
+
+
+def test_nombre_particion():
+    assert nombre_particion(datetime.datetime(2026, 1, 1)) == 'p202601'
+    assert nombre_particion(datetime.datetime(2026, 10, 1)) == 'p202610'
+
+
+def test_crear_particiones_hasta_el_mes_pedido():
+    cur = CursorFalso([('p202609', ts(2026, 10)), ('p202610', ts(2026, 11)), (PARTICION_FUTURO, None)])
+
+    nuevas = crear_particiones(cur, 'mensajes', datetime.datetime(2027, 1, 15))
+
+    assert nuevas == ['p202611', 'p202612', 'p202701']
+    alter = cur.consultas[-1]
+    assert f'REORGANIZE PARTITION {PARTICION_FUTURO}' in alter
+    assert "PARTITION p202701 VALUES LESS THAN (UNIX_TIMESTAMP('2027-02-01 00:00:00'))" in alter
+    assert alter.endswith(f'PARTITION {PARTICION_FUTURO} VALUES LESS THAN MAXVALUE )')
+
+
+def test_crear_particiones_sin_nada_que_crear():
+    cur = CursorFalso([('p202610', ts(2026, 11)), (PARTICION_FUTURO, None)])
+
+    assert crear_particiones(cur, 'mensajes', datetime.datetime(2026, 10, 31)) == []
+    assert not any('ALTER' in consulta for consulta in cur.consultas)
+
+
+def test_crear_particiones_sin_particiones_mensuales():
+    with pytest.raises(ValueError):
+        crear_particiones(CursorFalso([(PARTICION_FUTURO, None)]), 'mensajes', datetime.datetime(2026, 10, 1))
+
+
+def test_archivar_solo_las_particiones_anteriores_al_corte():
+    cur = CursorFalso(
+        [('p202608', ts(2026, 9)), ('p202609', ts(2026, 10)), ('p202610', ts(2026, 11)), (PARTICION_FUTURO, None)],
+        filas_copiadas=5
+    )
+
+    archivadas = archivar_particiones(cur, 'mensajes', 'mensajes_archivo', ('id', 'mensaje'),
+                                      datetime.datetime(2026, 10, 1))
+
+    assert archivadas == [('p202608', 5), ('p202609', 5)]
+    borradas = [consulta for consulta in cur.consultas if 'DROP PARTITION' in consulta]
+    assert borradas == ['ALTER TABLE mensajes DROP PARTITION p202608', 'ALTER TABLE mensajes DROP PARTITION p202609']
+    assert 'INSERT IGNORE INTO mensajes_archivo (id, mensaje) SELECT id, mensaje FROM mensajes PARTITION (p202608)' \
+        in cur.consultas
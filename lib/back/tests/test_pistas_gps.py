@@ -0,0 +1,156 @@
+import io
+import struct
+import zlib
+
+import numpy as np
+import pytest
+
+from pistas_gps import (
+    codificar_pista, decodificar_pista, arrays_de_pista, leer_gpx, calcular_estadisticas,
+    FormatoPistaInvalido, GPXInvalido, MAGIC, VERSION, VELOCIDAD_MAXIMA_PLAUSIBLE
+)
+
+T0 = 1_760_000_000_000  # ms desde epoch
+DIA_MS = 86_400_000
+
+
+def pista_de_prueba(n=500, duracion_ms=3_600_000):
+    lat = 40.4 + np.cumsum(np.full(n, 1e-4))
+    lon = -3.7 + np.cumsum(np.full(n, -5e-5))
+    ele = 650 + 20 * np.sin(np.linspace(0, 6, n))
+    tiempo = T0 + np.linspace(0, duracion_ms, n).round()
+    return lat, lon, ele, tiempo
+
+
+def test_ida_y_vuelta_conserva_la_precision():
+    lat, lon, ele, tiempo = pista_de_prueba()
+    pista = decodificar_pista(codificar_pista(lat, lon, ele, tiempo))
+
+    np.testing.assert_allclose(pista.lat, lat, atol=1e-7)
+    np.testing.assert_allclose(pista.lon, lon, atol=1e-7)
+    np.testing.assert_allclose(pista.ele, ele, atol=0.05)
+    np.testing.assert_array_equal(pista.tiempo.astype(np.int64), tiempo.astype(np.int64))
+
+
+def test_pista_de_30_dias_no_desborda():
+    lat, lon, ele, _ = pista_de_prueba(n=4)
+    tiempo = np.array([0, DIA_MS, 25 * DIA_MS, 30 * DIA_MS], dtype=np.float64) + T0
+
+    pista = decodificar_pista(codificar_pista(lat, lon, ele, tiempo))
+
+    np.testing.assert_array_equal(pista.tiempo.astype(np.int64), tiempo.astype(np.int64))
+
+
+def test_huecos_de_ele_y_tiempo():
+    lat, lon, ele, tiempo = pista_de_prueba(n=6)
+    ele[[0, 3]] = np.nan
+    tiempo[[2, 5]] = np.nan
+
+    pista = decodificar_pista(codificar_pista(lat, lon, ele, tiempo))
+
+    np.testing.assert_array_equal(np.isnan(pista.ele), np.isnan(ele))
+    np.testing.assert_array_equal(np.isnat(pista.tiempo), np.isnan(tiempo))
+    validos = ~np.isnan(tiempo)
+    np.testing.assert_array_equal(pista.tiempo[validos].astype(np.int64), tiempo[validos].astype(np.int64))
+
+
+def test_sin_ele_ni_tiempo():
+    lat, lon, _, _ = pista_de_prueba(n=10)
+    pista = decodificar_pista(codificar_pista(lat, lon))
+    assert pista.ele is None
+    assert pista.tiempo is None
+
+
+def test_arrays_de_pista_es_el_inverso():
+    lat, lon, ele, tiempo = pista_de_prueba(n=50)
+    datos = codificar_pista(lat, lon, ele, tiempo)
+    assert codificar_pista(*arrays_de_pista(decodificar_pista(datos))) == datos
+
+
+def test_lee_la_version_1():
+    # Tiempo en int32 junto a los demas arrays
+    lat = np.array([10_000_000, 10_000_010], dtype=np.int64)
+    lon = np.array([20_000_000, 19_999_990], dtype=np.int64)
+    tiempo = np.array([0, 1500], dtype=np.int64)
+    cuerpo = b''.join(np.diff(a, prepend=0).astype(np.int32).tobytes() for a in (lat, lon, tiempo))
+    datos = struct.pack('<4sBBIq', MAGIC, 1, 0x02, 2, T0) + zlib.compress(cuerpo)
+
+    pista = decodificar_pista(datos)
+
+    np.testing.assert_allclose(pista.lat, [1.0, 1.000001])
+    np.testing.assert_array_equal(pista.tiempo.astype(np.int64), [T0, T0 + 1500])
+
+
+@pytest.mark.parametrize('datos', [
+    b'',
+    b'XXXX' + bytes(14),
+    struct.pack('<4sBBIq', MAGIC, 99, 0, 0, 0),
+    struct.pack('<4sBBIq', MAGIC, VERSION, 0, 3, 0) + zlib.compress(b'corto'),
+    struct.pack('<4sBBIq', MAGIC, VERSION, 0, 3, 0) + b'no es zlib',
+])
+def test_datos_invalidos(datos):
+    with pytest.raises(FormatoPistaInvalido):
+        decodificar_pista(datos)
+
+
+def test_lat_y_lon_de_distinta_longitud():
+    with pytest.raises(ValueError):
+        codificar_pista([1.0, 2.0], [1.0])
+
+
+GPX = b"""<?xml version="1.0"?>
+<gpx xmlns="http://www.topografix.com/GPX/1/1">
+  <trk><trkseg>
+    <trkpt lat="40.1" lon="-3.1"><ele>600.5</ele><time>2026-10-01T08:00:00Z</time></trkpt>
+    <trkpt lat="40.2" lon="-3.2"><time>2026-10-01T08:00:05Z</time></trkpt>
+  </trkseg></trk>
+</gpx>"""
+
+
+def test_leer_gpx():
+    lat, lon, ele, tiempo = leer_gpx(io.BytesIO(GPX), 10)
+
+    np.testing.assert_array_equal(lat, [40.1, 40.2])
+    np.testing.assert_array_equal(lon, [-3.1, -3.2])
+    assert ele[0] == 600.5 and np.isnan(ele[1])
+    assert tiempo[1] - tiempo[0] == 5000
+
+
+@pytest.mark.parametrize('gpx, maximo', [
+    (GPX, 1),
+    (b'<gpx><trk><trkseg><trkpt lon="1"/></trkseg></trk></gpx>', 10),
+    (b'<gpx></gpx>', 10),
+    (b'<gpx><trk>', 10),
+])
+def test_leer_gpx_invalido(gpx, maximo):
+    with pytest.raises(GPXInvalido):
+        leer_gpx(io.BytesIO(gpx), maximo)
+
+
+def test_estadisticas_de_una_pista_regular():
+    # 0.001 grados de latitud cada 10 s: ~11 m/s
+    n = 100
+    lat = 40.0 + np.arange(n) * 0.001
+    lon = np.full(n, -3.0)
+    tiempo = T0 + np.arange(n) * 10_000.0
+
+    est = calcular_estadisticas(lat, lon, None, tiempo)
+
+    assert est.distancia_m == pytest.approx(99 * 111.2, rel=0.01)
+    assert est.duracion_s == 990
+    assert est.velocidad_max_ms == pytest.approx(11.12, rel=0.01)
+    assert len(est.parciales_km) == 11
+
+
+def test_los_saltos_del_gps_no_cuentan_como_velocidad():
+    n = 100
+    lat = 40.0 + np.arange(n) * 0.001
+    lon = np.full(n, -3.0)
+    lon[50:] += 5.0  # ~425 km en un segundo
+    tiempo = T0 + np.arange(n) * 10_000.0
+    tiempo[50:] -= 9_000.0
+
+    est = calcular_estadisticas(lat, lon, None, tiempo)
+
+    assert est.velocidad_max_ms == pytest.approx(11.12, rel=0.01)
+    assert est.velocidad_media_ms <= VELOCIDAD_MAXIMA_PLAUSIBLE
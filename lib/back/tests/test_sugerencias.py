@@ -0,0 +1,42 @@
+import sugerencias
+from sugerencias import calcular_candidatos, celda, nuevos_amigos_de_amigos, puntuacion
+
+
+def test_celda():
+    assert celda(40.45, -3.71) == (404, -38)
+    assert celda(40.41, -3.69) == (404, -37)
+
+
+def test_candidatos_por_amigos_y_zonas_comunes():
+    amigos = {
+        1: {2, 3},
+        2: {1, 4, 5},
+        3: {1, 4},
+        4: {2, 3},
+        5: {2},
+    }
+    zonas = {1: {(0, 0), (1, 1)}, 4: {(5, 5)}, 5: {(0, 0), (1, 1)}}
+
+    candidatos = calcular_candidatos(1, amigos, zonas, 10)
+
+    # 4: dos amigos en comun (20); 5: uno y dos zonas (10 + 6)
+    assert candidatos == [(4, 2, 0, puntuacion(2, 0)), (5, 1, 2, puntuacion(1, 2))]
+    assert calcular_candidatos(1, amigos, zonas, 1) == candidatos[:1]
+
+
+def test_candidatos_empatados_por_id():
+    amigos = {1: {2}, 2: {1, 9, 7}}
+    assert [c[0] for c in calcular_candidatos(1, amigos, {}, 10)] == [7, 9]
+
+
+def test_intermedios_con_demasiados_amigos_no_cuentan(monkeypatch):
+    monkeypatch.setattr(sugerencias, 'MAX_AMIGOS_INTERMEDIO', 2)
+    amigos = {1: {2}, 2: {1, 3, 4}}
+    assert calcular_candidatos(1, amigos, {}, 10) == []
+
+
+def test_nuevos_amigos_de_amigos():
+    # 1 y 2 se hacen amigos; 3 ya era amigo de los dos
+    pares = nuevos_amigos_de_amigos(1, {2, 3, 4}, 2, {1, 3, 5})
+
+    assert sorted(pares) == [(1, 5), (2, 4), (4, 2), (5, 1)]
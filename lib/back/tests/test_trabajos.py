@@ -0,0 +1,199 @@
+import json
+
+import pytest
+
+from trabajos import ColaTrabajos, ErrorDefinitivo
+
+
+class TablaTrabajos:
+    """
+    La tabla `trabajos` en memoria, con un NOW() que avanza a mano. Entiende
+    solo las consultas que hace trabajos.py.
+    """
+
+    def __init__(self):
+        self.filas = {}
+        self.ahora = 0
+        self.commits = 0
+
+    def añadir(self, tipo, carga, max_intentos=3):
+        trabajo_id = len(self.filas) + 1
+        self.filas[trabajo_id] = {
+            'tipo': tipo, 'carga': json.dumps(carga), 'estado': 'pendiente', 'intentos': 0,
+            'max_intentos': max_intentos, 'error': None, 'disponible_en': self.ahora,
+        }
+        return trabajo_id
+
+    # Interfaz de flask_mysqldb: mysql.connection.cursor()/commit()/rollback()
+    @property
+    def connection(self):
+        return self
+
+    def cursor(self):
+        return CursorTrabajos(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+
+class CursorTrabajos:
+    def __init__(self, tabla):
+        self.tabla = tabla
+        self._resultado = None
+
+    def execute(self, consulta, args=()):
+        consulta = ' '.join(consulta.split())
+        filas = self.tabla.filas
+        if consulta.startswith('SELECT id, tipo, carga'):
+            disponibles = [i for i, f in sorted(filas.items())
+                           if f['estado'] in ('pendiente', 'en_curso') and f['disponible_en'] <= self.tabla.ahora]
+            self._resultado = None
+            if disponibles:
+                f = filas[disponibles[0]]
+                self._resultado = (disponibles[0], f['tipo'], f['carga'], f['estado'], f['intentos'],
+                                   f['max_intentos'])
+        elif "estado = 'error', error = 'Concesion vencida" in consulta:
+            filas[args[0]].update(estado='error', error='Concesion vencida tras agotar los intentos')
+        elif "estado = 'en_curso'" in consulta:
+            concesion, trabajo_id = args
+            f = filas[trabajo_id]
+            f.update(estado='en_curso', intentos=f['intentos'] + 1, disponible_en=self.tabla.ahora + concesion)
+        elif "estado = 'hecho'" in consulta:
+            filas[args[0]].update(estado='hecho', error=None)
+        elif "SET estado = 'error', error = %s" in consulta:
+            error, trabajo_id = args
+            filas[trabajo_id].update(estado='error', error=error)
+        elif 'IF(intentos < max_intentos' in consulta:
+            espera, error, trabajo_id = args
+            f = filas[trabajo_id]
+            f.update(estado='pendiente' if f['intentos'] < f['max_intentos'] else 'error',
+                     disponible_en=self.tabla.ahora + espera * f['intentos'], error=error)
+        else:
+            raise AssertionError(f'Consulta inesperada: {consulta}')
+
+    def fetchone(self):
+        return self._resultado
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def tabla():
+    return TablaTrabajos()
+
+
+@pytest.fixture
+def cola(tabla):
+    return ColaTrabajos(app=None, mysql=tabla, concesion=600, espera_reintento=30)
+
+
+def test_trabajo_hecho_y_despues(tabla, cola):
+    llamadas = []
+
+    @cola.tarea('sumar')
+    def sumar(cur, carga, trabajo_id):
+        llamadas.append((carga, trabajo_id))
+        return lambda: llamadas.append('despues')
+
+    trabajo_id = tabla.añadir('sumar', {'a': 1})
+
+    assert cola._procesar_uno()
+    assert llamadas == [({'a': 1}, trabajo_id), 'despues']
+    assert tabla.filas[trabajo_id]['estado'] == 'hecho'
+    assert tabla.filas[trabajo_id]['intentos'] == 1
+    assert not cola._procesar_uno()
+
+
+def test_reintenta_con_espera_creciente_y_falla_al_agotar(tabla, cola):
+    fallados = []
+
+    @cola.tarea('roto', al_fallar=fallados.append)
+    def roto(cur, carga, trabajo_id):
+        raise RuntimeError('sin red')
+
+    trabajo_id = tabla.añadir('roto', {'clave': 'pendientes/1/x.gpx'})
+    fila = tabla.filas[trabajo_id]
+
+    assert cola._procesar_uno()
+    assert (fila['estado'], fila['intentos'], fila['disponible_en']) == ('pendiente', 1, 30)
+    assert not cola._procesar_uno()
+
+    tabla.ahora = 30
+    assert cola._procesar_uno()
+    assert (fila['estado'], fila['intentos'], fila['disponible_en']) == ('pendiente', 2, 90)
+    assert fallados == []
+
+    tabla.ahora = 90
+    assert cola._procesar_uno()
+    assert (fila['estado'], fila['intentos'], fila['error']) == ('error', 3, 'sin red')
+    assert fallados == [{'clave': 'pendientes/1/x.gpx'}]
+
+
+def test_error_definitivo_no_se_reintenta(tabla, cola):
+    fallados = []
+
+    @cola.tarea('gpx', al_fallar=fallados.append)
+    def gpx(cur, carga, trabajo_id):
+        raise ErrorDefinitivo('GPX mal formado')
+
+    trabajo_id = tabla.añadir('gpx', {'n': 1})
+
+    assert cola._procesar_uno()
+    assert tabla.filas[trabajo_id]['estado'] == 'error'
+    assert tabla.filas[trabajo_id]['intentos'] == 1
+    assert tabla.filas[trabajo_id]['error'] == 'GPX mal formado'
+    assert fallados == [{'n': 1}]
+
+
+def test_concesion_vencida_se_vuelve_a_reclamar(tabla, cola):
+    hechos = []
+
+    @cola.tarea('lento')
+    def lento(cur, carga, trabajo_id):
+        hechos.append(trabajo_id)
+
+    trabajo_id = tabla.añadir('lento', {})
+    # Otro proceso lo reclamo y murio
+    tabla.filas[trabajo_id].update(estado='en_curso', intentos=1, disponible_en=600)
+
+    assert not cola._procesar_uno()
+    tabla.ahora = 600
+    assert cola._procesar_uno()
+    assert hechos == [trabajo_id]
+    assert tabla.filas[trabajo_id]['intentos'] == 2
+
+
+def test_concesion_vencida_en_el_ultimo_intento(tabla, cola):
+    fallados = []
+    hechos = []
+
+    @cola.tarea('lento', al_fallar=fallados.append)
+    def lento(cur, carga, trabajo_id):
+        hechos.append(trabajo_id)
+
+    muerto = tabla.añadir('lento', {'n': 1})
+    tabla.filas[muerto].update(estado='en_curso', intentos=3, disponible_en=0)
+    siguiente = tabla.añadir('lento', {'n': 2})
+
+    assert cola._procesar_uno()
+    assert tabla.filas[muerto]['estado'] == 'error'
+    assert fallados == [{'n': 1}]
+    assert hechos == [siguiente]
+
+
+def test_un_error_al_limpiar_no_rompe_la_cola(tabla, cola):
+    def al_fallar(carga):
+        raise OSError('no se pudo borrar')
+
+    @cola.tarea('gpx', al_fallar=al_fallar)
+    def gpx(cur, carga, trabajo_id):
+        raise ErrorDefinitivo('mal')
+
+    trabajo_id = tabla.añadir('gpx', {})
+
+    assert cola._procesar_uno()
+    assert tabla.filas[trabajo_id]['estado'] == 'error'
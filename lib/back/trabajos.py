@@ -0,0 +1,181 @@
+import json
+import threading
+import time
+import traceback
+
+
+class ErrorDefinitivo(Exception):
+    """
+    Error que no se arregla reintentando (p. ej. un archivo mal formado):
+    el trabajo pasa directamente a 'error'.
+    """
+
+
+class ColaTrabajos:
+    """
+    Cola de trabajos respaldada por la tabla `trabajos` de MySQL con un
+    grupo de hilos que la consumen. Varios procesos pueden compartir la
+    cola: cada trabajo se reclama con SELECT ... FOR UPDATE SKIP LOCKED.
+
+    Un trabajo reclamado queda bloqueado `concesion` segundos; si el proceso
+    muere a medias, vuelve a estar disponible al vencer la concesion, salvo
+    que ya haya agotado sus intentos: entonces pasa a 'error'.
+    """
+
+    def __init__(self, app, mysql, num_hilos=2, intervalo=1.0, concesion=600, espera_reintento=30):
+        self.app = app
+        self.mysql = mysql
+        self.num_hilos = num_hilos
+        self.intervalo = intervalo
+        self.concesion = concesion
+        self.espera_reintento = espera_reintento
+        self._tareas = {}
+        self._hilos = []
+        self._aviso = threading.Event()
+        self._lock = threading.Lock()
+
+    def tarea(self, tipo, al_fallar=None):
+        """
+        Registra la funcion que procesa los trabajos de `tipo`. Recibe
+        (cur, carga, trabajo_id) y puede devolver una funcion que se ejecuta
+        tras el commit (p. ej. invalidar caches).
+
+        `al_fallar(carga)` se llama cuando el trabajo queda en 'error' y ya
+        no se va a reintentar (p. ej. borrar los archivos pendientes).
+        """
+        def registrar(funcion):
+            self._tareas[tipo] = (funcion, al_fallar)
+            return funcion
+        return registrar
+
+    def encolar(self, cur, tipo, carga, clave, usuario_id=None, publicacion_id=None, max_intentos=3):
+        """
+        Inserta el trabajo dentro de la transaccion del llamador. `clave` es
+        unica: encolar dos veces lo mismo devuelve el id del trabajo existente.
+        """
+        cur.execute("""
+            INSERT INTO trabajos (tipo, carga, clave, usuario_fk, publicacion_fk, max_intentos)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id)
+        """, (tipo, json.dumps(carga), clave, usuario_id, publicacion_id, max_intentos))
+        self.arrancar()
+        return cur.lastrowid
+
+    def avisar(self):
+        # Despierta a los hilos sin esperar al siguiente sondeo
+        self._aviso.set()
+
+    def arrancar(self):
+        with self._lock:
+            if self._hilos:
+                return
+            for i in range(self.num_hilos):
+                hilo = threading.Thread(target=self._bucle, name=f"trabajos-{i}", daemon=True)
+                hilo.start()
+                self._hilos.append(hilo)
+
+    def _bucle(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    while True:
+                        if not self._procesar_uno():
+                            self._aviso.wait(self.intervalo)
+                            self._aviso.clear()
+            except Exception as e:
+                print(f"Error en la cola de trabajos: {e}")
+                time.sleep(self.intervalo)
+
+    def _reclamar(self, cur):
+        agotados = []
+        while True:
+            cur.execute("""
+                SELECT id, tipo, carga, estado, intentos, max_intentos FROM trabajos
+                WHERE estado IN ('pendiente', 'en_curso') AND disponible_en <= NOW()
+                ORDER BY id
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            """)
+            fila = cur.fetchone()
+            if not fila:
+                break
+            trabajo_id, tipo, carga, estado, intentos, max_intentos = fila
+            if estado == 'en_curso' and intentos >= max_intentos:
+                # Concesion vencida en el ultimo intento: el proceso murio con
+                # el trabajo entre manos tantas veces como se permitia
+                cur.execute("""
+                    UPDATE trabajos
+                    SET estado = 'error', error = 'Concesion vencida tras agotar los intentos'
+                    WHERE id = %s
+                """, (trabajo_id,))
+                agotados.append((tipo, carga))
+                continue
+            cur.execute("""
+                UPDATE trabajos
+                SET estado = 'en_curso', intentos = intentos + 1,
+                    disponible_en = NOW() + INTERVAL %s SECOND
+                WHERE id = %s
+            """, (self.concesion, trabajo_id))
+            fila = (trabajo_id, tipo, carga, intentos + 1 >= max_intentos)
+            break
+        self.mysql.connection.commit()
+        for tipo, carga in agotados:
+            self._fallar(tipo, carga)
+        return fila
+
+    def _fallar(self, tipo, carga):
+        al_fallar = self._tareas.get(tipo, (None, None))[1]
+        if not al_fallar:
+            return
+        try:
+            al_fallar(json.loads(carga))
+        except Exception as e:
+            print(f"Error al limpiar un trabajo {tipo} fallido: {e}")
+
+    def _procesar_uno(self):
+        cur = self.mysql.connection.cursor()
+        try:
+            fila = self._reclamar(cur)
+            if not fila:
+                return False
+            trabajo_id, tipo, carga, ultimo_intento = fila
+            despues = None
+            try:
+                tarea = self._tareas[tipo][0]
+                despues = tarea(cur, json.loads(carga), trabajo_id)
+                cur.execute("""
+                    UPDATE trabajos SET estado = 'hecho', error = NULL WHERE id = %s
+                """, (trabajo_id,))
+                self.mysql.connection.commit()
+            except ErrorDefinitivo as e:
+                self.mysql.connection.rollback()
+                cur.execute("""
+                    UPDATE trabajos SET estado = 'error', error = %s WHERE id = %s
+                """, (str(e)[:1000], trabajo_id))
+                self.mysql.connection.commit()
+                self._fallar(tipo, carga)
+                return True
+            except Exception as e:
+                self.mysql.connection.rollback()
+                traceback.print_exc()
+                # Reintento con espera creciente hasta agotar max_intentos
+                cur.execute("""
+                    UPDATE trabajos
+                    SET estado = IF(intentos < max_intentos, 'pendiente', 'error'),
+                        disponible_en = NOW() + INTERVAL (%s * intentos) SECOND,
+                        error = %s
+                    WHERE id = %s
+                """, (self.espera_reintento, str(e)[:1000], trabajo_id))
+                self.mysql.connection.commit()
+                if ultimo_intento:
+                    self._fallar(tipo, carga)
+                return True
+
+            if despues:
+                try:
+                    despues()
+                except Exception as e:
+                    print(f"Error tras el trabajo {trabajo_id}: {e}")
+            return True
+        finally:
+            cur.close()
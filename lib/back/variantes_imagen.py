@@ -0,0 +1,76 @@
+import os
+import threading
+import uuid
+
+from PIL import Image, ImageOps
+
+
+class ImagenInvalida(Exception):
+    pass
+
+
+# Lado mayor en pixeles de cada variante, de mayor a menor
+TAMAÑOS_PUBLICACION = (('grande', 1600), ('media', 640), ('mini', 160))
+TAMAÑOS_AVATAR = (('grande', 512), ('media', 256), ('mini', 96))
+TAMAÑO_POR_DEFECTO = 'grande'
+
+FORMATOS = (('webp', 'WEBP', {'quality': 80, 'method': 4}),
+            ('jpg', 'JPEG', {'quality': 82, 'optimize': True, 'progressive': True}))
+
+# Fotos de camara de hasta ~50 MP; por encima Pillow lo trata como bomba
+Image.MAX_IMAGE_PIXELS = 50_000_000
+
+# Redimensionar es lo mas caro del servidor: como mucho N a la vez
+MAX_PROCESOS_SIMULTANEOS = 2
+_limite = threading.BoundedSemaphore(MAX_PROCESOS_SIMULTANEOS)
+
+
+def nombre_variante(nombre, tamaño, extension):
+    """
+    '3f2a.jpg' -> '3f2a_mini.webp'
+    """
+    return f"{os.path.splitext(nombre)[0]}_{tamaño}.{extension}"
+
+
+def generar_variantes(origen, carpeta, nombre, tamaños=TAMAÑOS_PUBLICACION):
+    """
+    Decodifica `origen` una sola vez y escribe en `carpeta` cada tamaño en
+    WebP y JPEG. Se aplica la orientacion EXIF y despues se descartan todos
+    los metadatos (EXIF, GPS de la camara...). Devuelve los nombres escritos.
+    """
+    with _limite:
+        try:
+            with Image.open(origen) as imagen:
+                # En JPEG decodifica directamente a escala reducida (DCT)
+                lado = tamaños[0][1]
+                imagen.draft('RGB', (lado, lado))
+                imagen = ImageOps.exif_transpose(imagen)
+                imagen = _a_rgb(imagen)
+                imagen.info = {}
+        except (OSError, SyntaxError, Image.DecompressionBombError) as e:
+            raise ImagenInvalida(str(e))
+
+        os.makedirs(carpeta, exist_ok=True)
+        escritos = []
+        # Cada tamaño se reduce desde el anterior, no desde el original
+        for tamaño, lado in tamaños:
+            imagen.thumbnail((lado, lado), Image.Resampling.LANCZOS)
+            for extension, formato, opciones in FORMATOS:
+                destino = nombre_variante(nombre, tamaño, extension)
+                # Temporal unico: dos subidas iguales pueden generarse a la vez
+                temporal = os.path.join(carpeta, f"{destino}.{uuid.uuid4().hex}.tmp")
+                imagen.save(temporal, formato, **opciones)
+                os.replace(temporal, os.path.join(carpeta, destino))
+                escritos.append(destino)
+        return escritos
+
+
+def _a_rgb(imagen):
+    if imagen.mode in ('RGBA', 'LA', 'P'):
+        imagen = imagen.convert('RGBA')
+        fondo = Image.new('RGB', imagen.size, (255, 255, 255))
+        fondo.paste(imagen, mask=imagen.getchannel('A'))
+        return fondo
+    if imagen.mode != 'RGB':
+        return imagen.convert('RGB')
+    return imagen